@@ -0,0 +1,349 @@
+import argparse
+import json
+import os
+import shutil
+import threading
+import time
+from generate_video_story import generate_video_story, add_pipeline_arguments, configure_pipeline, get_hls_folder_path, WORK_FOLDER_PATH
+from src.job_manifest import JobManifest
+from src.mock_openai_server import MockOpenAIServer, MockOpenAISettings
+from src.rate_limiter import RATE_LIMITS, configure_rate_limit
+from src.response_cache import set_cache
+from src.video_utils import merge_image_audio, merge_video_segments, render_video_story
+from src.logger import get_logger, log_function_call
+
+logger = get_logger(__file__)
+
+BENCHMARK_FOLDER_PATH = os.path.join(WORK_FOLDER_PATH, 'benchmarks')
+
+class BENCHMARK_SETTINGS :
+    # maximum growth of the peak memory use of the final render and re-encode from the smallest to the largest story
+    MEMORY_TOLERANCE_MB = 64
+
+# stages of the run report kept in the benchmark results
+REPORTED_STAGES = ('generate_story', 'add_speech_annotations', 'add_segment_annotations', 'stream_segment_annotations', 'get_visual_descriptions', 'get_dall_e_prompt',
+                   'get_generated_image_url', 'save_image', 'generate_speech', 'merge_image_audio', 'merge_video_segments', 'render_video_story')
+
+def _get_stage_timings(report_path) :
+    with open(report_path) as report_file :
+        stages = json.load(report_file)['stages']
+    return {
+        stage: {key: stages[stage][key] for key in ('calls', 'total_seconds', 'p50_seconds', 'p95_seconds')}
+        for stage in REPORTED_STAGES if stage in stages
+    }
+
+@log_function_call(logger)
+def benchmark_generate_video_story(server, segments, **pipeline_options) :
+    """
+    Times a whole generate_video_story run against the mock server.
+
+    Args:
+        server (MockOpenAIServer): The running mock server.
+        segments (int): Number of segments of the story.
+        **pipeline_options: Options passed to generate_video_story (max_workers, single_pass_render, b64_images, structured_story, stream_segments, hls_output, merge_speech_lines).
+
+    Returns:
+        dict: The duration of the run, the timings of its stages (from its run report) and the number of requests per endpoint.
+    """
+    server.settings.segments = segments
+    server.request_counts.clear()
+    job_id = JobManifest.new_job_id()
+    output_file_name = f'benchmark_{job_id}.mp4'
+
+    started_at = time.perf_counter()
+    generate_video_story(
+        'sk-benchmark', 'A benchmark story', 'cartoon', None, None, None, output_file_name, job_id=job_id, **pipeline_options
+    )
+    duration = time.perf_counter() - started_at
+
+    os.remove(os.path.join(WORK_FOLDER_PATH, output_file_name))
+    shutil.rmtree(get_hls_folder_path(output_file_name), ignore_errors=True)
+    return {
+        'seconds': round(duration, 3),
+        'stages': _get_stage_timings(os.path.join(WORK_FOLDER_PATH, 'reports', f'{job_id}.json')),
+        'requests': dict(server.request_counts)
+    }
+
+@log_function_call(logger)
+def benchmark_encoding(server, segments, assets_folder) :
+    """
+    Times merge_image_audio on a synthetic image and speech, then merge_video_segments on as many clips as segments.
+
+    Args:
+        server (MockOpenAIServer): The mock server, used to generate the synthetic assets.
+        segments (int): Number of clips merged.
+        assets_folder (str): Folder of the synthetic assets and clips.
+
+    Returns:
+        dict: The durations of merge_image_audio and merge_video_segments in seconds.
+    """
+    image_path = os.path.join(assets_folder, 'image.png')
+    with open(image_path, 'wb') as image_file :
+        image_file.write(server.get_png('benchmark'))
+    audio_paths = []
+    for line in range(server.settings.lines_per_segment) :
+        audio_paths.append(os.path.join(assets_folder, f'speech_{line}.mp3'))
+        with open(audio_paths[-1], 'wb') as audio_file :
+            audio_file.write(server.get_mp3())
+
+    started_at = time.perf_counter()
+    clip = os.path.join(assets_folder, merge_image_audio(image_path, audio_paths, assets_folder))
+    merge_image_audio_duration = time.perf_counter() - started_at
+
+    started_at = time.perf_counter()
+    merge_video_segments([clip] * segments, os.path.join(assets_folder, 'merged.mp4'))
+    merge_video_segments_duration = time.perf_counter() - started_at
+
+    return {'merge_image_audio_seconds': round(merge_image_audio_duration, 3), 'merge_video_segments_seconds': round(merge_video_segments_duration, 3)}
+
+def _get_rss_mb(pid = 'self') :
+    try :
+        with open(f'/proc/{pid}/status') as status_file :
+            return next(int(line.split()[1]) for line in status_file if line.startswith('VmRSS:')) / 1024
+    except (OSError, StopIteration) :
+        # the process has exited (or has no memory left)
+        return 0
+
+def _get_ffmpeg_pids() :
+    pids = []
+    for thread_id in os.listdir('/proc/self/task') :
+        try :
+            with open(f'/proc/self/task/{thread_id}/children') as children_file :
+                pids += children_file.read().split()
+        except OSError :
+            continue
+    # the encode pool workers are children too
+    ffmpeg_pids = []
+    for pid in pids :
+        try :
+            with open(f'/proc/{pid}/comm') as comm_file :
+                if comm_file.read().startswith('ffmpeg') :
+                    ffmpeg_pids.append(pid)
+        except OSError :
+            continue
+    return ffmpeg_pids
+
+def _measure_peak_rss(function, *args) :
+    """
+    Calls a function while sampling the RSS of the process and of its ffmpeg child processes every 20ms (Linux only).
+    getrusage is not used, the peak RSS it reports for a child includes the memory of the process it was forked from.
+
+    Returns:
+        dict: The peak increase of the RSS of the Python process and the peak total RSS of its children, in MB.
+    """
+    rss_before = _get_rss_mb()
+    peaks = {'python_rss_increase_mb': 0, 'ffmpeg_peak_rss_mb': 0}
+    done = threading.Event()
+
+    def sample() :
+        while not done.wait(0.02) :
+            peaks['python_rss_increase_mb'] = max(peaks['python_rss_increase_mb'], _get_rss_mb() - rss_before)
+            peaks['ffmpeg_peak_rss_mb'] = max(peaks['ffmpeg_peak_rss_mb'], sum(_get_rss_mb(pid) for pid in _get_ffmpeg_pids()))
+
+    sampler = threading.Thread(target=sample, daemon=True)
+    sampler.start()
+    try :
+        function(*args)
+    finally :
+        done.set()
+        sampler.join()
+    return {name: round(peak, 1) for name, peak in peaks.items()}
+
+@log_function_call(logger)
+def benchmark_render_memory(server, segments, assets_folder) :
+    """
+    Measures the peak memory use of render_video_story and of the re-encoding merge_video_segments on a story of synthetic
+    segments. The peaks should not grow with the number of segments.
+
+    Args:
+        server (MockOpenAIServer): The mock server, used to generate the synthetic assets.
+        segments (int): Number of segments.
+        assets_folder (str): Folder of the synthetic assets and videos.
+
+    Returns:
+        dict: The peak RSS increase of the Python process and the peak RSS of the ffmpeg processes in MB, for each function.
+    """
+    image_path = os.path.join(assets_folder, 'memory_image.png')
+    with open(image_path, 'wb') as image_file :
+        image_file.write(server.get_png('memory'))
+    audio_path = os.path.join(assets_folder, 'memory_speech.mp3')
+    with open(audio_path, 'wb') as audio_file :
+        audio_file.write(server.get_mp3())
+    clip = os.path.join(assets_folder, merge_image_audio(image_path, [audio_path], assets_folder))
+
+    return {
+        'render_video_story': _measure_peak_rss(render_video_story, [(image_path, [audio_path])] * segments, os.path.join(assets_folder, 'rendered.mp4')),
+        'merge_video_segments_reencode': _measure_peak_rss(merge_video_segments, [clip] * segments, os.path.join(assets_folder, 'reencoded.mp4'), False)
+    }
+
+def check_render_memory(results, tolerance_mb = BENCHMARK_SETTINGS.MEMORY_TOLERANCE_MB) :
+    """
+    Compares the peak memory use of the final render and re-encode of the smallest and of the largest story size.
+
+    Args:
+        results (list): The results of run_benchmark (with at least two story sizes).
+        tolerance_mb (float): Maximum growth of each peak in MB.
+
+    Returns:
+        list: The errors, one per peak growing more than the tolerance.
+    """
+    # the highest peak of the repeats of each size
+    peaks = {}
+    for result in results :
+        for function, function_peaks in result['memory'].items() :
+            for name, peak in function_peaks.items() :
+                key = (result['segments'], function, name)
+                peaks[key] = max(peaks.get(key, 0), peak)
+    smallest_size, largest_size = min(result['segments'] for result in results), max(result['segments'] for result in results)
+    errors = []
+    for (segments, function, name), peak in peaks.items() :
+        if segments == largest_size :
+            growth = peak - peaks[(smallest_size, function, name)]
+            if growth > tolerance_mb :
+                errors.append(f'{function} {name} grows by {growth:.1f}MB from {smallest_size} to {largest_size} segments, the tolerance is {tolerance_mb}MB')
+    return errors
+
+@log_function_call(logger)
+def run_benchmark(server, sizes, repeats, output_path, memory_only = False, **pipeline_options) :
+    """
+    Runs the benchmarks for every story size and writes the results as JSON.
+
+    Args:
+        server (MockOpenAIServer): The running mock server.
+        sizes (list): The numbers of segments of the benchmarked stories.
+        repeats (int): Number of runs per size.
+        output_path (str): Path of the JSON results.
+        memory_only (bool): If True, only the peak memory use of the final render and re-encode is measured.
+        **pipeline_options: Options passed to generate_video_story.
+
+    Returns:
+        list: One result per size and run.
+    """
+    assets_folder = os.path.join(BENCHMARK_FOLDER_PATH, 'assets')
+    results = []
+    for segments in sizes :
+        for repeat in range(repeats) :
+            os.makedirs(assets_folder, exist_ok=True)
+            try :
+                result = {'segments': segments, 'repeat': repeat}
+                if not memory_only :
+                    result['generate_video_story'] = benchmark_generate_video_story(server, segments, **pipeline_options)
+                    result.update(benchmark_encoding(server, segments, assets_folder))
+                result['memory'] = benchmark_render_memory(server, segments, assets_folder)
+            finally :
+                shutil.rmtree(assets_folder)
+            results.append(result)
+            if memory_only :
+                print(f"{segments:>4} segments", end='')
+            else :
+                print(f"{segments:>4} segments | generate_video_story {result['generate_video_story']['seconds']:>8.2f}s"
+                      f" | merge_image_audio {result['merge_image_audio_seconds']:>6.2f}s | merge_video_segments {result['merge_video_segments_seconds']:>6.2f}s", end='')
+            print(f" | render peak RSS {result['memory']['render_video_story']['ffmpeg_peak_rss_mb']:>6.1f}MB"
+                  f" | re-encode peak RSS {result['memory']['merge_video_segments_reencode']['ffmpeg_peak_rss_mb']:>6.1f}MB")
+
+    os.makedirs(os.path.dirname(output_path) or '.', exist_ok=True)
+    with open(output_path, 'w') as output_file :
+        json.dump({'settings': vars(server.settings), 'pipeline_options': pipeline_options, 'results': results}, output_file, indent=2)
+    return results
+
+
+if __name__ == "__main__":
+    '''
+    usage: python3 -m benchmark [-h] [--sizes SIZES] [--repeats REPEATS] [--output OUTPUT]
+                               [--chat_latency CHAT_LATENCY] [--image_latency IMAGE_LATENCY]
+                               [--speech_latency SPEECH_LATENCY] [--error_rate ERROR_RATE]
+                               [--speech_duration SPEECH_DURATION] [--lines_per_segment LINES_PER_SEGMENT]
+                               [--use_cache] [--memory_only] [--memory_tolerance_mb MEMORY_TOLERANCE_MB]
+                               [--max_workers MAX_WORKERS] [--single_pass_render] [--b64_images] [--structured_story] [--stream_segments] [--hls] [--merge_speech_lines]
+                               [--asset_index] [--asset_index_folder ASSET_INDEX_FOLDER] [--asset_similarity ASSET_SIMILARITY]
+                               [--encode_workers ENCODE_WORKERS] [--encode_preset ENCODE_PRESET] [--encode_crf ENCODE_CRF]
+                               [--encode_threads ENCODE_THREADS] [--json_logs] [--rate_limit MODEL:RPM[:TPM]]
+
+    Benchmarks the pipeline offline against a local mock of the OpenAI API (no API key or credits needed)
+
+    optional arguments:
+    -h, --help            show this help message and exit
+    --sizes SIZES         Comma separated numbers of segments of the benchmarked stories (optional, default 3,10,30,100)
+    --repeats REPEATS     Number of runs per story size (optional, default 1)
+    --output OUTPUT       Path of the JSON results (optional, default work_folder/benchmarks/results.json)
+    --chat_latency CHAT_LATENCY
+                            Latency of the mock chat completions in seconds (optional, default 0.5)
+    --image_latency IMAGE_LATENCY
+                            Latency of the mock image generations in seconds (optional, default 2)
+    --speech_latency SPEECH_LATENCY
+                            Latency of the mock speeches in seconds (optional, default 0.5)
+    --error_rate ERROR_RATE
+                            Probability of a mock request failing with a retryable error (optional, default 0)
+    --speech_duration SPEECH_DURATION
+                            Duration of the mock speeches in seconds (optional, default 2)
+    --lines_per_segment LINES_PER_SEGMENT
+                            Number of speech lines per segment (optional, default 2)
+    --use_cache           Reuse the cached responses (disabled by default, a cache hit skips the mock latency)
+    --memory_only         Only measure the peak memory use of the final render and re-encode
+    --memory_tolerance_mb MEMORY_TOLERANCE_MB
+                            Maximum growth in MB of the peak memory use from the smallest to the largest size, the benchmark
+                            exits with an error above it (optional, default 64)
+    The other options are the pipeline options of generate_video_story, the rate limits are unlimited by default.
+    '''
+
+    parser = argparse.ArgumentParser(description="Benchmarks the pipeline offline against a local mock of the OpenAI API (no API key or credits needed)")
+
+    parser.add_argument("--sizes", type=str, default='3,10,30,100', help="Comma separated numbers of segments of the benchmarked stories (optional, default 3,10,30,100)")
+    parser.add_argument("--repeats", type=int, default=1, help="Number of runs per story size (optional, default 1)")
+    parser.add_argument("--output", type=str, default=os.path.join(BENCHMARK_FOLDER_PATH, 'results.json'), help="Path of the JSON results (optional, default work_folder/benchmarks/results.json)")
+    parser.add_argument("--chat_latency", type=float, default=0.5, help="Latency of the mock chat completions in seconds (optional, default 0.5)")
+    parser.add_argument("--image_latency", type=float, default=2, help="Latency of the mock image generations in seconds (optional, default 2)")
+    parser.add_argument("--speech_latency", type=float, default=0.5, help="Latency of the mock speeches in seconds (optional, default 0.5)")
+    parser.add_argument("--error_rate", type=float, default=0, help="Probability of a mock request failing with a retryable error (optional, default 0)")
+    parser.add_argument("--speech_duration", type=float, default=2, help="Duration of the mock speeches in seconds (optional, default 2)")
+    parser.add_argument("--lines_per_segment", type=int, default=2, help="Number of speech lines per segment (optional, default 2)")
+    parser.add_argument("--use_cache", action="store_true", help="Reuse the cached responses (disabled by default, a cache hit skips the mock latency)")
+    parser.add_argument("--memory_only", action="store_true", help="Only measure the peak memory use of the final render and re-encode")
+    parser.add_argument("--memory_tolerance_mb", type=float, default=BENCHMARK_SETTINGS.MEMORY_TOLERANCE_MB, help="Maximum growth in MB of the peak memory use from the smallest to the largest size, the benchmark exits with an error above it (optional, default 64)")
+    add_pipeline_arguments(parser)
+
+    args = parser.parse_args()
+
+    try :
+        sizes = [int(size) for size in args.sizes.split(',')]
+    except ValueError :
+        print(f'Invalid sizes {args.sizes}, expected comma separated integers')
+        exit(1)
+
+    if len(set(sizes)) < 2 and args.memory_only :
+        print('The memory check needs at least two sizes')
+        exit(1)
+
+    if not 0 <= args.error_rate < 1 :
+        print('Error rate should be between 0 and 1')
+        exit(1)
+
+    # the mock server has no rate limits, the --rate_limit options still apply
+    for model in RATE_LIMITS.DEFAULTS :
+        configure_rate_limit(model, 1000000)
+    configure_pipeline(args)
+    if not args.use_cache :
+        set_cache(None)
+
+    server = MockOpenAIServer(MockOpenAISettings(
+        lines_per_segment=args.lines_per_segment,
+        chat_latency=args.chat_latency,
+        image_latency=args.image_latency,
+        speech_latency=args.speech_latency,
+        error_rate=args.error_rate,
+        speech_duration=args.speech_duration
+    )).start()
+    # read by the OpenAI clients when they are created
+    os.environ['OPENAI_BASE_URL'] = server.base_url
+
+    try :
+        results = run_benchmark(server, sizes, args.repeats, args.output, args.memory_only, max_workers=args.max_workers, single_pass_render=args.single_pass_render, b64_images=args.b64_images, structured_story=args.structured_story, stream_segments=args.stream_segments, hls_output=args.hls, merge_speech_lines=args.merge_speech_lines)
+    finally :
+        server.stop()
+    print(f'Results : {args.output}')
+
+    if len(set(sizes)) > 1 :
+        errors = check_render_memory(results, args.memory_tolerance_mb)
+        for error in errors :
+            print(f'FAILED : {error}')
+        exit(1 if errors else 0)
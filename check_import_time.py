@@ -0,0 +1,120 @@
+import argparse
+import re
+import subprocess
+import sys
+
+"""
+This file contains the startup regression check of the command line scripts.
+Each script module is imported in a fresh interpreter with -X importtime: the check fails if an import is slower than
+the budget, or if a heavy dependency (the openai SDK, PIL...) is imported before it is needed, these are imported
+at their point of use so that --help, invalid arguments and short-lived workers start in milliseconds.
+"""
+
+class IMPORT_TIME_SETTINGS :
+    MODULES = ('generate_video_story', 'generate_video_batch', 'job_service')
+    # imported lazily by the functions using them
+    DEFERRED_MODULES = ('moviepy', 'numpy', 'imageio', 'openai', 'httpx', 'PIL', 'pydantic')
+    BUDGET_MS = 300
+    SLOWEST_IMPORTS = 10
+
+IMPORT_TIME_PATTERN = re.compile(r'^import time:\s*(\d+) \|\s*(\d+) \|( *)(\S+)$')
+
+def measure_import_time(module) :
+    """
+    Imports a module in a new interpreter with -X importtime.
+
+    Args:
+        module (str): The name of the module.
+
+    Returns:
+        list: The (module name, self microseconds, cumulative microseconds, depth) of every module imported, in import order.
+    """
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'], capture_output=True, text=True)
+    if result.returncode != 0 :
+        raise RuntimeError(f'Import of {module} failed : {result.stderr.strip()}')
+    imports = []
+    for line in result.stderr.splitlines() :
+        match = IMPORT_TIME_PATTERN.match(line)
+        if match :
+            self_time, cumulative_time, indentation, name = match.groups()
+            imports.append((name, int(self_time), int(cumulative_time), len(indentation) // 2))
+    return imports
+
+def check_module(module, budget_ms = IMPORT_TIME_SETTINGS.BUDGET_MS, deferred_modules = IMPORT_TIME_SETTINGS.DEFERRED_MODULES) :
+    """
+    Checks the import time of a module and the dependencies it imports.
+
+    Args:
+        module (str): The name of the module.
+        budget_ms (float): Maximum import time in milliseconds.
+        deferred_modules (tuple): Top-level packages which must not be imported.
+
+    Returns:
+        tuple: The import time in milliseconds, the list of the errors and the list of the slowest (name, cumulative ms) imports.
+    """
+    imports = measure_import_time(module)
+    total_ms = next(cumulative_time for name, _, cumulative_time, _ in imports if name == module) / 1000
+    errors = []
+    if total_ms > budget_ms :
+        errors.append(f'{module} takes {total_ms:.0f}ms to import, the budget is {budget_ms}ms')
+    imported_packages = {name.split('.')[0] for name, _, _, _ in imports}
+    for deferred_module in deferred_modules :
+        if deferred_module in imported_packages :
+            importer = _find_importer(imports, deferred_module)
+            errors.append(f'{module} imports {deferred_module}' + (f' (through {importer})' if importer else ''))
+    # the direct imports of the project are the ones to look at first
+    slowest_imports = sorted(
+        ((name, cumulative_time / 1000) for name, _, cumulative_time, depth in imports if depth == 1),
+        key=lambda entry : entry[1], reverse=True
+    )[:IMPORT_TIME_SETTINGS.SLOWEST_IMPORTS]
+    return total_ms, errors, slowest_imports
+
+def _find_importer(imports, package) :
+    # -X importtime prints a module after its dependencies: the parent of a module is the next module with a lower depth,
+    # the importer of the package is its first ancestor outside of the package
+    for index, (name, _, _, depth) in enumerate(imports) :
+        if name == package :
+            for importer, _, _, importer_depth in imports[index + 1:] :
+                if importer_depth < depth :
+                    if importer.split('.')[0] != package :
+                        return importer
+                    depth = importer_depth
+            return None
+    return None
+
+
+if __name__ == "__main__":
+    '''
+    usage: python3 -m check_import_time [-h] [--modules MODULES] [--budget_ms BUDGET_MS]
+
+    Checks that the command line scripts import quickly and without their heavy dependencies
+
+    optional arguments:
+    -h, --help            show this help message and exit
+    --modules MODULES     Comma separated modules to check (optional, default generate_video_story,generate_video_batch,job_service)
+    --budget_ms BUDGET_MS
+                            Maximum import time of each module in milliseconds (optional, default 300)
+    '''
+
+    parser = argparse.ArgumentParser(description="Checks that the command line scripts import quickly and without their heavy dependencies")
+
+    parser.add_argument("--modules", type=str, default=','.join(IMPORT_TIME_SETTINGS.MODULES), help="Comma separated modules to check (optional, default generate_video_story,generate_video_batch,job_service)")
+    parser.add_argument("--budget_ms", type=float, default=IMPORT_TIME_SETTINGS.BUDGET_MS, help="Maximum import time of each module in milliseconds (optional, default 300)")
+
+    args = parser.parse_args()
+
+    failed = False
+    for module in args.modules.split(',') :
+        try :
+            total_ms, errors, slowest_imports = check_module(module, args.budget_ms)
+        except RuntimeError as e :
+            print(e)
+            failed = True
+            continue
+        print(f'{module} : {total_ms:.0f}ms')
+        for name, cumulative_ms in slowest_imports :
+            print(f'    {name:<40} {cumulative_ms:>8.1f}ms')
+        for error in errors :
+            print(f'  FAILED : {error}')
+        failed = failed or bool(errors)
+    exit(1 if failed else 0)
@@ -0,0 +1,184 @@
+import argparse
+import csv
+import hashlib
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from generate_video_story import generate_video_story, add_pipeline_arguments, configure_pipeline, WORK_FOLDER_PATH
+from src.concurrency import set_concurrency_budget
+from src.metrics import start_prometheus_server
+from src.logger import get_logger, log_function_call
+
+logger = get_logger(__file__)
+
+# Before running the script make sure to set your OpenAI API key
+# export OPENAI_API_KEY=<your_api_key>
+
+STORY_SPEC_FIELDS = ('plot', 'illustration_style', 'geo_time_setting', 'additional_keywords', 'content_restrictions', 'output_file_name')
+REQUIRED_STORY_SPEC_FIELDS = ('plot', 'illustration_style', 'output_file_name')
+
+def load_story_specs(manifest_path) :
+    """
+    Loads the story specs of a batch manifest, a JSONL file (one JSON object per line) or a CSV file with a header.
+    Each spec has the fields plot, illustration_style and output_file_name, and optionally geo_time_setting,
+    additional_keywords and content_restrictions.
+
+    Args:
+        manifest_path (str): Path to the .jsonl or .csv manifest.
+
+    Returns:
+        list: The story specs (dict), missing and empty optional fields are None.
+
+    Raises:
+        ValueError: If a spec misses a required field, has an invalid output file name or the output file name of another spec
+                    (two jobs would write the same video, and identical specs would share one job folder).
+    """
+    with open(manifest_path, newline='') as manifest_file :
+        if manifest_path.lower().endswith('.csv') :
+            rows = list(csv.DictReader(manifest_file))
+        else :
+            rows = [json.loads(line) for line in manifest_file if line.strip()]
+
+    story_specs = []
+    output_file_lines = {}
+    for line, row in enumerate(rows, 1) :
+        story_spec = {field: (row.get(field) or None) for field in STORY_SPEC_FIELDS}
+        missing_fields = [field for field in REQUIRED_STORY_SPEC_FIELDS if not story_spec[field]]
+        if missing_fields :
+            raise ValueError(f'Story {line} of {manifest_path} misses the fields : {", ".join(missing_fields)}')
+        if not story_spec['output_file_name'].lower().endswith('.mp4') :
+            raise ValueError(f'Story {line} of {manifest_path} : output file name should end with .mp4')
+        if story_spec['output_file_name'] in output_file_lines :
+            raise ValueError(f'Story {line} of {manifest_path} : story {output_file_lines[story_spec["output_file_name"]]} already writes {story_spec["output_file_name"]}')
+        output_file_lines[story_spec['output_file_name']] = line
+        story_specs.append(story_spec)
+    return story_specs
+
+def get_story_job_id(story_spec) :
+    """
+    Returns the job id of a story spec. It only depends on the spec, so running a batch again resumes its unfinished jobs.
+    """
+    serialized = json.dumps(story_spec, sort_keys=True)
+    return hashlib.sha256(serialized.encode('utf-8')).hexdigest()[:12]
+
+def _write_report(report, report_path) :
+    tmp_path = report_path + '.tmp'
+    with open(tmp_path, 'w') as report_file :
+        json.dump(report, report_file, indent=2)
+    os.replace(tmp_path, report_path)
+
+@log_function_call(logger)
+def generate_video_batch(open_ai_api_key, story_specs, report_path, max_jobs = 1, **pipeline_options) :
+    """
+    Generates the videos of many stories in one process: the pooled OpenAI clients, the rate limiters, the response cache
+    and the concurrency budget are shared by all the jobs.
+    The report (one entry per story with its job id, status, error and duration) is rewritten every time a job ends.
+
+    Args:
+        open_ai_api_key (str): The API key for OpenAI.
+        story_specs (list): The story specs, see load_story_specs.
+        report_path (str): Path of the JSON report.
+        max_jobs (int): Maximum number of stories processed concurrently.
+        **pipeline_options: Options passed to generate_video_story (max_workers, single_pass_render, b64_images, structured_story, stream_segments, hls_output, merge_speech_lines).
+
+    Returns:
+        list: The report entries.
+    """
+    report = [
+        {'job_id': get_story_job_id(story_spec), 'output_file_name': story_spec['output_file_name'], 'status': 'queued', 'error': None, 'duration_seconds': None}
+        for story_spec in story_specs
+    ]
+    report_lock = threading.Lock()
+    _write_report(report, report_path)
+
+    def run_job(index) :
+        entry = report[index]
+        with report_lock :
+            entry['status'] = 'running'
+            _write_report(report, report_path)
+        started_at = time.monotonic()
+        try :
+            generate_video_story(open_ai_api_key, **story_specs[index], job_id=entry['job_id'], **pipeline_options)
+            status, error = 'succeeded', None
+        except Exception as e :
+            logger.exception(f'Job {entry["job_id"]} failed')
+            status, error = 'failed', str(e)
+        with report_lock :
+            entry.update(status=status, error=error, duration_seconds=round(time.monotonic() - started_at, 3))
+            _write_report(report, report_path)
+
+    with ThreadPoolExecutor(max_workers=max_jobs) as executor :
+        for future in as_completed([executor.submit(run_job, index) for index in range(len(story_specs))]) :
+            future.result()
+    return report
+
+
+if __name__ == "__main__":
+    '''
+    usage: python3 -m generate_video_batch [-h] --manifest MANIFEST [--report REPORT] [--max_jobs MAX_JOBS]
+                               [--concurrency_budget CONCURRENCY_BUDGET] [--metrics_port METRICS_PORT]
+                               [--max_workers MAX_WORKERS] [--cache_folder CACHE_FOLDER]
+                               [--cache_max_size_mb CACHE_MAX_SIZE_MB] [--no_cache]
+                               [--single_pass_render] [--b64_images] [--structured_story] [--stream_segments] [--hls] [--merge_speech_lines]
+                               [--asset_index] [--asset_index_folder ASSET_INDEX_FOLDER] [--asset_similarity ASSET_SIMILARITY] [--encode_workers ENCODE_WORKERS]
+                               [--encode_preset ENCODE_PRESET] [--encode_crf ENCODE_CRF] [--encode_threads ENCODE_THREADS] [--json_logs]
+                               [--rate_limit MODEL:RPM[:TPM]]
+
+    Generates the videos of all the stories of a manifest in one long-lived process
+
+    optional arguments:
+    -h, --help            show this help message and exit
+    --manifest MANIFEST   JSONL or CSV file of story specs (plot, illustration_style, geo_time_setting,
+                            additional_keywords, content_restrictions, output_file_name)
+    --report REPORT       Path of the JSON status report (optional, default work_folder/batch_report.json)
+    --max_jobs MAX_JOBS   Maximum number of stories processed concurrently (optional, default 2)
+    --concurrency_budget CONCURRENCY_BUDGET
+                            Maximum number of API calls and encodes running at the same time across all the jobs (optional)
+    --metrics_port METRICS_PORT
+                            Serve the per-stage metrics in the Prometheus format on http://0.0.0.0:METRICS_PORT/metrics (optional)
+    The other options are the pipeline options of generate_video_story.
+    '''
+
+    parser = argparse.ArgumentParser(description="Generates the videos of all the stories of a manifest in one long-lived process")
+
+    parser.add_argument("--manifest", type=str, required=True, help="JSONL or CSV file of story specs (plot, illustration_style, geo_time_setting, additional_keywords, content_restrictions, output_file_name)")
+    parser.add_argument("--report", type=str, default=os.path.join(WORK_FOLDER_PATH, 'batch_report.json'), help="Path of the JSON status report (optional, default work_folder/batch_report.json)")
+    parser.add_argument("--max_jobs", type=int, default=2, help="Maximum number of stories processed concurrently (optional, default 2)")
+    parser.add_argument("--concurrency_budget", type=int, help="Maximum number of API calls and encodes running at the same time across all the jobs (optional)")
+    parser.add_argument("--metrics_port", type=int, help="Serve the per-stage metrics in the Prometheus format on http://0.0.0.0:METRICS_PORT/metrics (optional)")
+    add_pipeline_arguments(parser)
+
+    args = parser.parse_args()
+
+    openai_key =  os.environ.get('OPENAI_API_KEY')
+    if not openai_key :
+        print('No OpenAI API KEY found.')
+        exit(1)
+
+    try :
+        story_specs = load_story_specs(args.manifest)
+    except (OSError, ValueError) as e :
+        print(f'Invalid manifest : {e}')
+        exit(1)
+
+    if args.max_jobs < 1 :
+        print('Max jobs should be at least 1')
+        exit(1)
+
+    cache = configure_pipeline(args)
+    set_concurrency_budget(args.concurrency_budget)
+    if args.metrics_port :
+        start_prometheus_server(args.metrics_port)
+
+    report = generate_video_batch(
+        openai_key, story_specs, args.report, args.max_jobs,
+        max_workers=args.max_workers, single_pass_render=args.single_pass_render, b64_images=args.b64_images, structured_story=args.structured_story, stream_segments=args.stream_segments, hls_output=args.hls, merge_speech_lines=args.merge_speech_lines
+    )
+    logger.info(f'Response cache stats : {cache.get_stats()}')
+
+    failed_jobs = [entry for entry in report if entry['status'] != 'succeeded']
+    print(f'{len(report) - len(failed_jobs)}/{len(report)} videos generated, report : {args.report}')
+    if failed_jobs :
+        exit(1)
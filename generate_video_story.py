@@ -1,20 +1,205 @@
 import argparse
 from src.openai_processor import *
 from src.video_utils import *
-from src.logger import get_logger, log_function_call
+from src.logger import get_logger, log_function_call, configure_logging
+from src.response_cache import ResponseCache, set_cache
+from src.job_manifest import JobManifest
+from src.rate_limiter import configure_rate_limit
+from src.concurrency import run_encode, set_encode_workers, submit_in_context
+from src.metrics import record_run
+from src.stage_graph import StageGraph
+from src.story_parser import SegmentParser
+from src.hls_playlist import HlsPlaylist, HLS_SETTINGS
+from src.speech_batching import SpeechDeduplicator
+from src.asset_index import AssetIndex, set_asset_index, get_asset_index, summarize_asset_reuse
+import contextvars
 import shutil
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, wait as wait_futures
+import time
 
 logger = get_logger(__file__)
 
 # Before running the script make sure to set your OpenAI API key 
 # export OPENAI_API_KEY=<your_api_key>
 
+WORK_FOLDER_PATH = 'work_folder'
+
+@log_function_call(logger)
+def _process_segment(job, index, segment, illustration_style, visual_descriptions, open_ai_api_key, speech_deduplicator, single_pass_render = False, b64_images = False) :
+    """
+    Generates the image and the voiceovers of a story segment and merges them into a mp4 clip (unless single_pass_render).
+    The speech lines of the segment are synthesized concurrently through the speech deduplicator, the lines already
+    submitted by another segment reuse its audio file.
+    Each step is a stage of the job (segments/<index>/prompt, image, clip, and speech/<line key> for the speech lines),
+    completed stages are not run again.
+
+    Args:
+        job (JobManifest): The manifest of the job.
+        index (int): The index of the segment in the story.
+        segment (Segment): The segment of the story (with its speech lines).
+        illustration_style (str): The style of the illustrations.
+        visual_descriptions (str): The visual descriptions of the characters and places of the story
+                                   (or a future of them, awaited before the DALL-E prompt).
+        open_ai_api_key (str): The API key for OpenAI.
+        speech_deduplicator (SpeechDeduplicator): Submitter of the text-to-speech requests of the story.
+        single_pass_render (bool): If True, no clip is encoded, the image and audio files are returned for the final render.
+        b64_images (bool): If True, the images are received as base64 JSON instead of being downloaded from their URL.
+
+    Returns:
+        str: Path of the segment mp4 clip, or tuple (image path, list of audio paths) if single_pass_render.
+    """
+    stage = f'segments/{index}'
+    job_folder_path = job.job_folder_path
+    if not single_pass_render and job.is_completed(f'{stage}/clip', is_file=True) :
+        return os.path.join(job_folder_path, job.get_output(f'{stage}/clip'))
+
+    speech_futures = speech_deduplicator.submit_lines(segment.speech_lines)
+
+    if isinstance(visual_descriptions, Future) :
+        visual_descriptions = visual_descriptions.result()
+    dall_e_prompt = job.run_stage(f'{stage}/prompt', lambda : get_dall_e_prompt(segment.text, illustration_style, visual_descriptions, open_ai_api_key))
+    # the image is fetched while the speech lines are synthesized
+    image = job.run_stage(
+        f'{stage}/image',
+        lambda : save_image(get_generated_image_url(dall_e_prompt, open_ai_api_key, job_folder_path if b64_images else None), job_folder_path),
+        is_file=True
+    )
+
+    audios = [os.path.join(job_folder_path, future.result()) for future in speech_futures]
+    if single_pass_render :
+        return os.path.join(job_folder_path, image), audios
+
+    # CPU-bound, encoded in the process pool while the network stages go on in the threads
+    clip = job.run_stage(f'{stage}/clip', lambda : run_encode(merge_image_audio, os.path.join(job_folder_path, image), audios, job_folder_path, get_encoding_profile()), is_file=True)
+    return os.path.join(job_folder_path, clip)
+
+def _stream_segments(job, annotated_story, open_ai_api_key) :
+    """
+    Yields the segments of the segment_annotations stage as soon as they are streamed, the stage is completed once the stream ends.
+    """
+    if job.is_completed('segment_annotations') :
+        yield from parse_segments(job.get_output('segment_annotations'))
+        return
+    parser = SegmentParser()
+    yield from stream_segment_annotations(annotated_story, open_ai_api_key, parser)
+    job.set_output('segment_annotations', parser.text.strip())
+
 @log_function_call(logger)
-def generate_video_story(open_ai_api_key, plot, illustration_style, geo_time_setting, additional_keywords, content_restrictions, output_file_name):
+def _run_stages(job, open_ai_api_key, max_workers, single_pass_render, b64_images, structured_story, stream_segments, hls_output, merge_speech_lines) :
+    """
+    Runs the stages of a job which are not completed yet, see generate_video_story.
+    """
+    plot, illustration_style, geo_time_setting, additional_keywords, content_restrictions, output_file_name = (
+        job.parameters[name] for name in ('plot', 'illustration_style', 'geo_time_setting', 'additional_keywords', 'content_restrictions', 'output_file_name')
+    )
+
+    # Segments and speech lines use separate executors: a segment worker waits on its speech futures,
+    # sharing one pool could deadlock once every worker is busy waiting.
+    with ThreadPoolExecutor(max_workers=max_workers) as segment_executor, ThreadPoolExecutor(max_workers=max_workers) as speech_executor, ThreadPoolExecutor(max_workers=1) as description_executor :
+        # each stage starts as soon as its inputs are ready: the visual descriptions only need the story,
+        # they are generated while the story is annotated
+        graph = StageGraph(f'job {job.job_id}')
+        if structured_story :
+            # one request instead of the four below
+            graph.add_stage('structured_story', lambda : job.run_stage('structured_story', lambda : generate_structured_story(open_ai_api_key, plot, geo_time_setting, additional_keywords, content_restrictions)))
+            story, segments, visual_descriptions = get_structured_story_outputs(graph.run()['structured_story'])
+        elif stream_segments :
+            # the media of each segment are generated as soon as the segment is streamed,
+            # the segments wait for the visual descriptions (a future) only before their DALL-E prompt.
+            # The stages are run here and recorded in the graph for the critical path.
+            stage_started_at = time.perf_counter()
+            story = job.run_stage('story', lambda : generate_story(open_ai_api_key,  plot, geo_time_setting, additional_keywords, content_restrictions))
+            graph.record_stage('story', stage_started_at, time.perf_counter())
+            descriptions_started_at = time.perf_counter()
+            visual_descriptions = submit_in_context(description_executor, job.run_stage, 'visual_descriptions', lambda : get_visual_descriptions(story, open_ai_api_key))
+            visual_descriptions.add_done_callback(lambda _ : graph.record_stage('visual_descriptions', descriptions_started_at, time.perf_counter(), ['story']))
+            stage_started_at = time.perf_counter()
+            annotated_story = job.run_stage('speech_annotations', lambda : add_speech_annotations(story, open_ai_api_key))
+            graph.record_stage('speech_annotations', stage_started_at, time.perf_counter(), ['story'])
+            segmentation_started_at = time.perf_counter()
+            segments = _stream_segments(job, annotated_story, open_ai_api_key)
+        else :
+            graph.add_stage('story', lambda : job.run_stage('story', lambda : generate_story(open_ai_api_key,  plot, geo_time_setting, additional_keywords, content_restrictions)))
+            graph.add_stage('speech_annotations', lambda story : job.run_stage('speech_annotations', lambda : add_speech_annotations(story, open_ai_api_key)), ['story'])
+            graph.add_stage('segment_annotations', lambda annotated_story : job.run_stage('segment_annotations', lambda : add_segment_annotations(annotated_story, open_ai_api_key)), ['speech_annotations'])
+            graph.add_stage('visual_descriptions', lambda story : job.run_stage('visual_descriptions', lambda : get_visual_descriptions(story, open_ai_api_key)), ['story'])
+            outputs = graph.run()
+            visual_descriptions = outputs['visual_descriptions']
+            segments = parse_segments(outputs['segment_annotations'])
+
+        # the identical speech lines of the story are synthesized once
+        speech_deduplicator = SpeechDeduplicator(
+            speech_executor,
+            lambda key, speech_line : job.run_stage(f'speech/{key}', lambda : generate_speech(speech_line, open_ai_api_key, job.job_folder_path), True),
+            merge_speech_lines
+        )
+        playlist = HlsPlaylist(get_hls_folder_path(output_file_name)) if hls_output else None
+
+        # the futures are read in story order whatever the completion order is
+        segment_futures = []
+        segment_outputs = []
+        publish_lock = threading.Lock()
+
+        def collect_segment_outputs(wait = False, raise_errors = True) :
+            # each output is collected (and published) as soon as it and the segments before it are done,
+            # while the segments are still dispatched (the streamed segmentation may not be over)
+            while True :
+                with publish_lock :
+                    if len(segment_outputs) == len(segment_futures) :
+                        return
+                    future = segment_futures[len(segment_outputs)]
+                    if future.done() :
+                        if not raise_errors and future.exception() :
+                            return
+                        output = future.result()
+                        if playlist :
+                            playlist.add_clip(output)
+                        segment_outputs.append(output)
+                        continue
+                    if not wait :
+                        return
+                # waited without the lock: the done-callbacks of the segment threads take it,
+                # the next segments would not start while they are blocked
+                wait_futures([future])
+
+        started_at = time.perf_counter()
+        for segment in segments :
+            if not segment_futures :
+                logger.info(f'First segment dispatched after {time.perf_counter() - started_at:.2f}s')
+            future = submit_in_context(segment_executor, _process_segment, job, segment.index, segment, illustration_style, visual_descriptions, open_ai_api_key, speech_deduplicator, single_pass_render, b64_images)
+            segment_futures.append(future)
+            # an error is raised by the dispatch loop, the callbacks of the segment threads only collect the outputs
+            # (in a copy of the run context, the playlist stage is still counted in the run report)
+            future.add_done_callback(lambda _, context = contextvars.copy_context() : context.run(collect_segment_outputs, raise_errors=False))
+            collect_segment_outputs()
+        if stream_segments and not structured_story :
+            # the segmentation stream ends with the dispatch loop
+            graph.record_stage('segment_annotations', segmentation_started_at, time.perf_counter(), ['speech_annotations'])
+        collect_segment_outputs(wait=True)
+        if stream_segments and not structured_story :
+            wait_futures([visual_descriptions])
+            graph.log_critical_path()
+        if playlist :
+            playlist.end()
+        speech_deduplicator.log_summary()
+    
+    if single_pass_render :
+        render_video_story(segment_outputs, os.path.join(WORK_FOLDER_PATH, output_file_name))
+    else :
+        merge_video_segments(segment_outputs, os.path.join(WORK_FOLDER_PATH, output_file_name))
+
+@log_function_call(logger)
+def generate_video_story(open_ai_api_key, plot, illustration_style, geo_time_setting, additional_keywords, content_restrictions, output_file_name, max_workers = 1, job_id = None, single_pass_render = False, b64_images = False, structured_story = False, stream_segments = False, hls_output = False, merge_speech_lines = False):
     """
     Generates a video story based on the provided plot and other parameters using OpenAI API for story generation, 
     speech annotations, segment annotations, and image generation.
 
+    Every stage output is recorded in the job manifest (work_folder/jobs/<job_id>/manifest.json). Calling the function again
+    with the id of an unfinished job resumes it: the completed stages and segments are skipped.
+    The latency (p50/p95), token usage, bytes, characters and retries of each stage of the run are written to
+    work_folder/reports/<job_id>.json, with the hits and saved cost of the asset index if one is set (see configure_pipeline).
+
     Parameters:
     open_ai_api_key (str): The API key for accessing OpenAI services.
     plot (str): A short description of the story.
@@ -23,21 +208,35 @@ def generate_video_story(open_ai_api_key, plot, illustration_style, geo_time_set
     additional_keywords (str): Additional keywords for the story.
     content_restrictions (str): Any content restrictions.
     output_file_name (str): The name of the output video file.
+    max_workers (int): Maximum number of segments (and of text-to-speech requests) processed concurrently. 
+                       1 processes the segments one after another.
+    job_id (str): The id of the job to create or resume (a new one is generated if None).
+    single_pass_render (bool): If True, the segments are not encoded into intermediate videos, 
+                               the whole story is rendered into the output video in one encoding pass.
+    b64_images (bool): If True, the images are received as base64 JSON in the DALL-E response instead of being downloaded from their URL.
+    structured_story (bool): If True, steps 2 to 6 are done by a single request returning the story, its segments, voices and 
+                             visual descriptions as JSON (see generate_structured_story).
+    stream_segments (bool): If True, the segment annotations are streamed and the media of each segment are generated as soon as
+                            the segment is received (ignored if structured_story).
+    hls_output (bool): If True, each segment clip is also published as soon as it is encoded in a HLS playlist
+                       (work_folder/<output file name>_hls/playlist.m3u8), not compatible with single_pass_render.
+    merge_speech_lines (bool): If True, the consecutive speech lines of the same voice in a segment are synthesized in one request.
 
     Steps:
-    1. Create a temporary folder for processing video segments.
+    1. Create (or load) the job folder and manifest.
     2. Generate the story text based on the plot and other parameters.
     3. Add speech annotations to the generated story.
     4. Add segment annotations to the annotated story.
-    5. Get visual descriptions for the story.
+    5. Get visual descriptions for the story (concurrently with steps 3 and 4, the critical path of steps 2 to 5 is logged).
     6. Extract segments from the annotated story.
-    7. For each segment:
+    7. For each segment (up to max_workers segments concurrently):
        - Extract speech data.
-       - Generate DALL-E prompt and obtain the image URL.
-       - Generate speech audio files.
-       - Merge the image and audio files to create video segments.
-    8. Merge all video segments into the final output video.
-    9. Clean up the temporary folder.
+       - Generate speech audio files (concurrently, each distinct line of the story once).
+       - Generate DALL-E prompt, generate the image and fetch it in the job folder (while the speech is generated).
+       - Merge the image and audio files to create video segments in the encode process pool (skipped if single_pass_render).
+    8. Merge all video segments, in story order, into the final output video 
+       (or render all the images and audio files in one pass if single_pass_render).
+    9. Clean up the job folder.
 
     Returns:
     None
@@ -50,35 +249,121 @@ def generate_video_story(open_ai_api_key, plot, illustration_style, geo_time_set
         geo_time_setting="Medieval Europe",
         additional_keywords="fantasy, knights, dragons",
         content_restrictions="PG-13",
-        work_folder_path="/path/to/work_folder",
-        output_file_name="final_video.mp4"
+        output_file_name="final_video.mp4",
+        max_workers=4
     )
     """
 
-    tmp_folder_path = os.path.join('work_folder', "tmp_video_processing_output")
-    os.makedirs(tmp_folder_path, exist_ok=True)
+    parameters = {
+        'plot': plot,
+        'illustration_style': illustration_style,
+        'geo_time_setting': geo_time_setting,
+        'additional_keywords': additional_keywords,
+        'content_restrictions': content_restrictions,
+        'output_file_name': output_file_name
+    }
+    job = JobManifest.open(WORK_FOLDER_PATH, job_id or JobManifest.new_job_id(), parameters)
+    logger.info(f'Job id : {job.job_id}')
 
-    story = generate_story(open_ai_api_key,  plot, geo_time_setting, additional_keywords, content_restrictions)
-    annotated_story = add_speech_annotations(story, open_ai_api_key)
-    annotated_story = add_segment_annotations(annotated_story, open_ai_api_key)
-   
-    visual_descriptions = get_visual_descriptions(story, open_ai_api_key)
-    
-    segments = extract_segments(annotated_story)
-
-    segment_videos = []
-   
-    for segment in segments :
-        speech_data = extract_speech_data(segment) 
-        dall_e_prompt = get_dall_e_prompt(segment, illustration_style, visual_descriptions, open_ai_api_key)
-        url = get_generated_image_url(dall_e_prompt, open_ai_api_key)
-    
-        audios = [ os.path.join(tmp_folder_path,generate_speech(data, open_ai_api_key, tmp_folder_path)) for data in speech_data]
-        
-        segment_videos.append(os.path.join(tmp_folder_path, merge_image_audio(url, audios, tmp_folder_path)))
-    
-    merge_video_segments(segment_videos, os.path.join('work_folder', output_file_name))
-    shutil.rmtree(tmp_folder_path)
+    with record_run() as run_metrics :
+        try :
+            _run_stages(job, open_ai_api_key, max_workers, single_pass_render, b64_images, structured_story, stream_segments, hls_output, merge_speech_lines)
+        finally :
+            run_metrics.write_report(os.path.join(WORK_FOLDER_PATH, 'reports', f'{job.job_id}.json'))
+            if get_asset_index() :
+                logger.info(f'Asset reuse : {summarize_asset_reuse(run_metrics.get_report())}')
+    shutil.rmtree(job.job_folder_path)
+
+def get_hls_folder_path(output_file_name) :
+    """
+    Returns:
+        str: The folder of the HLS playlist of an output video.
+    """
+    return os.path.join(WORK_FOLDER_PATH, os.path.splitext(output_file_name)[0] + '_hls')
+
+def add_pipeline_arguments(parser) :
+    """
+    Adds the pipeline options shared by the command line scripts (concurrency, cache, rendering, rate limits) to a parser.
+
+    Args:
+        parser (argparse.ArgumentParser): The parser.
+    """
+    parser.add_argument("--max_workers", type=int, default=1, help="Maximum number of segments processed concurrently (optional, default 1)")
+    parser.add_argument("--cache_folder", type=str, default=os.path.join('work_folder', 'cache'), help="Folder of the OpenAI response cache (optional, default work_folder/cache)")
+    parser.add_argument("--cache_max_size_mb", type=int, default=1024, help="Maximum size of the OpenAI response cache in MB (optional, default 1024)")
+    parser.add_argument("--no_cache", action="store_true", help="Do not reuse cached OpenAI responses (new responses are still cached)")
+    parser.add_argument("--single_pass_render", action="store_true", help="Render the whole video in one encoding pass, without intermediate segment videos")
+    parser.add_argument("--b64_images", action="store_true", help="Receive the generated images in the DALL-E response instead of downloading them from their URL")
+    parser.add_argument("--structured_story", action="store_true", help="Generate the story, its segments, voices and visual descriptions in a single structured request")
+    parser.add_argument("--stream_segments", action="store_true", help="Generate the media of each segment as soon as it is streamed by the segmentation request")
+    parser.add_argument("--hls", action="store_true", help="Also publish each segment in a HLS playlist as soon as it is encoded (work_folder/<output name>_hls/playlist.m3u8)")
+    parser.add_argument("--merge_speech_lines", action="store_true", help="Synthesize the consecutive speech lines of the same voice in a segment in one request")
+    parser.add_argument("--asset_index", action="store_true", help="Reuse the visual descriptions, DALL-E prompts and images generated for previous stories")
+    parser.add_argument("--asset_index_folder", type=str, default=os.path.join('work_folder', 'asset_index'), help="Folder of the asset index (optional, default work_folder/asset_index)")
+    parser.add_argument("--asset_similarity", type=float, help="Also reuse the assets of texts at least this similar, between 0 and 1 (optional, default only the same texts)")
+    parser.add_argument("--encode_workers", type=int, default=os.cpu_count(), help="Number of processes encoding the segment videos, 0 to encode in the pipeline threads (optional, default number of cores)")
+    parser.add_argument("--encode_preset", type=str, default='veryfast', choices=EncodingProfile.PRESETS, metavar='ENCODE_PRESET', help="libx264 preset of the segment videos, ultrafast to placebo (optional, default veryfast)")
+    parser.add_argument("--encode_crf", type=int, default=28, help="libx264 constant rate factor of the segment videos between 0 and 51, higher is smaller (optional, default 28)")
+    parser.add_argument("--encode_threads", type=int, default=1, help="Threads of each segment video encode, 0 for automatic (optional, default 1)")
+    parser.add_argument("--json_logs", action="store_true", help="Write the logs as JSON lines")
+    parser.add_argument("--rate_limit", type=str, action="append", default=[], metavar="MODEL:RPM[:TPM]", help="Requests (and tokens) per minute allowed for an OpenAI model, can be repeated (optional)")
+
+def configure_pipeline(args) :
+    """
+    Validates the pipeline options added by add_pipeline_arguments, then configures the rate limits, the response cache and the asset index.
+    Exits the program if an option is invalid.
+
+    Args:
+        args (argparse.Namespace): The parsed arguments.
+
+    Returns:
+        ResponseCache: The response cache.
+    """
+    if args.max_workers < 1 :
+        print('Max workers should be at least 1')
+        exit(1)
+
+    if args.hls and args.single_pass_render :
+        print('HLS output needs the segment videos, it can not be used with single pass render')
+        exit(1)
+
+    if args.json_logs :
+        configure_logging(json_lines=True)
+
+    if args.encode_workers < 0 :
+        print('Encode workers should be at least 0')
+        exit(1)
+    if not 0 <= args.encode_crf <= EncodingProfile.MAX_CRF :
+        print(f'Encode CRF should be between 0 and {EncodingProfile.MAX_CRF}')
+        exit(1)
+    if args.encode_threads < 0 :
+        print('Encode threads should be at least 0')
+        exit(1)
+    set_encode_workers(args.encode_workers)
+    # the HLS chunks are cut on the keyframes of the segment videos
+    keyframe_interval = HLS_SETTINGS.TARGET_DURATION if args.hls else EncodingProfile().keyframe_interval
+    set_encoding_profile(EncodingProfile(preset=args.encode_preset, crf=args.encode_crf, threads=args.encode_threads, keyframe_interval=keyframe_interval))
+
+    for rate_limit in args.rate_limit :
+        model, _, limits = rate_limit.partition(':')
+        try :
+            limits = [int(limit) for limit in limits.split(':')]
+            if min(limits) < 1 :
+                print(f'Rate limits should be at least 1, got {rate_limit}')
+                exit(1)
+            configure_rate_limit(model, *limits)
+        except (ValueError, TypeError) :
+            print(f'Invalid rate limit {rate_limit}, expected MODEL:RPM[:TPM]')
+            exit(1)
+
+    if args.asset_similarity is not None and not 0 < args.asset_similarity <= 1 :
+        print('Asset similarity should be between 0 and 1')
+        exit(1)
+    set_asset_index(AssetIndex(args.asset_index_folder, args.asset_similarity) if args.asset_index else None)
+
+    cache = ResponseCache(args.cache_folder, args.cache_max_size_mb * 1024 * 1024, bypass=args.no_cache)
+    set_cache(cache)
+    return cache
 
 
 if __name__ == "__main__":
@@ -88,6 +373,7 @@ if __name__ == "__main__":
                                [--additional_keywords ADDITIONAL_KEYWORDS]
                                [--content_restrictions CONTENT_RESTRICTIONS]
                                --output_file_name OUTPUT_FILE_NAME
+           python3 -m generate_video_story [-h] --resume JOB_ID
 
     A Python script that leverages OpenAI's API to generate a story and transform it into a
     video with only one command line
@@ -105,31 +391,89 @@ if __name__ == "__main__":
                             Any content restrictions (optional)
     --output_file_name OUTPUT_FILE_NAME
                             The name of the output file (should en by .mp4)
+    --max_workers MAX_WORKERS
+                            Maximum number of segments processed concurrently (optional, default 1)
+    --cache_folder CACHE_FOLDER
+                            Folder of the OpenAI response cache (optional, default work_folder/cache)
+    --cache_max_size_mb CACHE_MAX_SIZE_MB
+                            Maximum size of the OpenAI response cache in MB (optional, default 1024)
+    --no_cache            Do not reuse cached OpenAI responses (new responses are still cached)
+    --encode_workers ENCODE_WORKERS
+                            Number of processes encoding the segment videos, 0 to encode in the pipeline threads (optional, default number of cores)
+    --encode_preset ENCODE_PRESET
+                            libx264 preset of the segment videos, ultrafast to placebo (optional, default veryfast)
+    --encode_crf ENCODE_CRF
+                            libx264 constant rate factor of the segment videos between 0 and 51, higher is smaller (optional, default 28)
+    --encode_threads ENCODE_THREADS
+                            Threads of each segment video encode, 0 for automatic (optional, default 1)
+    --json_logs           Write the logs as JSON lines
+    --rate_limit MODEL:RPM[:TPM]
+                            Requests (and tokens) per minute allowed for an OpenAI model, can be repeated (optional)
+    --resume JOB_ID       Resume an unfinished job, its completed stages are skipped (the story arguments are read from the job)
+    --single_pass_render  Render the whole video in one encoding pass, without intermediate segment videos
+    --b64_images          Receive the generated images in the DALL-E response instead of downloading them from their URL
+    --structured_story    Generate the story, its segments, voices and visual descriptions in a single structured request
+    --stream_segments     Generate the media of each segment as soon as it is streamed by the segmentation request
+    --hls                 Also publish each segment in a HLS playlist as soon as it is encoded (work_folder/<output name>_hls/playlist.m3u8)
+    --merge_speech_lines  Synthesize the consecutive speech lines of the same voice in a segment in one request
+    --asset_index         Reuse the visual descriptions, DALL-E prompts and images generated for previous stories
+    --asset_index_folder ASSET_INDEX_FOLDER
+                            Folder of the asset index (optional, default work_folder/asset_index)
+    --asset_similarity ASSET_SIMILARITY
+                            Also reuse the assets of texts at least this similar, between 0 and 1 (optional, default only the same texts)
     '''
 
     parser = argparse.ArgumentParser(description="A Python script that leverages OpenAI's API to generate a story and transform it into a video with only one command line")
 
-    parser.add_argument("--illustration_style", type=str, required=True, help="The style of the illustrations (e.g., anime, realistic, cartoon)")
-    parser.add_argument("--plot", type=str, required=True, help="A short description of the story")
+    parser.add_argument("--illustration_style", type=str, help="The style of the illustrations (e.g., anime, realistic, cartoon)")
+    parser.add_argument("--plot", type=str, help="A short description of the story")
     parser.add_argument("--geo_time_setting", type=str, help="The geographical and temporal setting of the story (optional)")
     parser.add_argument("--additional_keywords", type=str, help="Additional keywords for the story (optional)")
     parser.add_argument("--content_restrictions", type=str, help="Any content restrictions (optional)")
-    parser.add_argument("--output_file_name", type=str, required=True, help="The name of the output file")
+    parser.add_argument("--output_file_name", type=str, help="The name of the output file")
+    add_pipeline_arguments(parser)
+    parser.add_argument("--resume", type=str, metavar="JOB_ID", help="Resume an unfinished job, its completed stages are skipped (the story arguments are read from the job)")
 
     args = parser.parse_args()
 
+    if args.resume :
+        try :
+            parameters = JobManifest.load(WORK_FOLDER_PATH, args.resume).parameters
+        except FileNotFoundError :
+            print(f'No job found with id {args.resume}.')
+            exit(1)
+        job_id = args.resume
+    else :
+        missing_arguments = [f'--{name}' for name in ('illustration_style', 'plot', 'output_file_name') if not getattr(args, name)]
+        if missing_arguments :
+            parser.error(f'the following arguments are required: {", ".join(missing_arguments)}')
+        parameters = {
+            'plot': args.plot,
+            'illustration_style': args.illustration_style,
+            'geo_time_setting': args.geo_time_setting,
+            'additional_keywords': args.additional_keywords,
+            'content_restrictions': args.content_restrictions,
+            'output_file_name': args.output_file_name
+        }
+        job_id = JobManifest.new_job_id()
+
     openai_key =  os.environ.get('OPENAI_API_KEY')
     if not openai_key :
         print('No OpenAI API KEY found.')
         exit(1)
     
-    if not args.output_file_name.lower().endswith('.mp4') :
+    if not parameters['output_file_name'].lower().endswith('.mp4') :
         print('Output file name should end with .mp4 ')
         exit(1)
 
+    cache = configure_pipeline(args)
+
     try : 
-        generate_video_story(openai_key, args.plot, args.illustration_style, args.geo_time_setting, args.additional_keywords, args.content_restrictions, args.output_file_name)
+        generate_video_story(openai_key, **parameters, max_workers=args.max_workers, job_id=job_id, single_pass_render=args.single_pass_render, b64_images=args.b64_images, structured_story=args.structured_story, stream_segments=args.stream_segments, hls_output=args.hls, merge_speech_lines=args.merge_speech_lines)
     except Exception as e : 
         print('Program failed.')
         print(f'Error : {e}')
-        exit(1)
\ No newline at end of file
+        print(f'Resume the job with : python3 -m generate_video_story --resume {job_id}')
+        exit(1)
+    finally :
+        logger.info(f'Response cache stats : {cache.get_stats()}')
\ No newline at end of file
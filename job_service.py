@@ -0,0 +1,364 @@
+import argparse
+import multiprocessing
+import os
+import shutil
+import signal
+import threading
+import time
+from generate_video_story import generate_video_story, add_pipeline_arguments, configure_pipeline, WORK_FOLDER_PATH
+from generate_video_batch import load_story_specs, STORY_SPEC_FIELDS
+from src.job_manifest import JobManifest
+from src.job_queue import JobQueue, QueueFullError, JOB_STATUSES, JOB_QUEUE_SETTINGS
+from src.story_parser import parse_segments
+from src.concurrency import set_concurrency_budget, shutdown_encode_pool
+from src.logger import get_logger, log_function_call, set_log_folder, stop_logging, LOGGING_SETTINGS
+
+logger = get_logger(__file__)
+
+# Before running the script make sure to set your OpenAI API key
+# export OPENAI_API_KEY=<your_api_key>
+
+"""
+This file contains the job service: a bounded queue of video generation jobs (see src/job_queue.py) and the workers running them.
+The service runs each job in its own spawned process, at most --workers at a time. A job process has its own job folder
+(work_folder/jobs/<job_id>), its own log folder (logging_output/jobs/<job_id>) and its own process group (its encode
+workers and ffmpeg processes), so cancelling a running job stops all of them at once and the jobs never share a file.
+On SIGTERM or SIGINT the service stops claiming jobs and waits for the running ones (drain), a second signal stops the running
+jobs and puts them back in the queue, they resume from their completed stages when the service is started again.
+"""
+
+class JOB_SERVICE_SETTINGS :
+    DATABASE_PATH = os.path.join(WORK_FOLDER_PATH, JOB_QUEUE_SETTINGS.DATABASE_FILE_NAME)
+    # seconds between two checks of the queue and of the cancel requests
+    POLL_INTERVAL = 1
+    # seconds between two progress updates of a running job
+    PROGRESS_INTERVAL = 2
+    # seconds between two attempts of a submit waiting for room in the queue
+    SUBMIT_RETRY_INTERVAL = 5
+
+def get_job_progress(job, single_pass_render = False) :
+    """
+    Returns the progress of a job from the stages recorded in its manifest.
+
+    Args:
+        job (JobManifest): The manifest of the job.
+        single_pass_render (bool): If True, a segment is completed once its image is fetched (no clip is encoded).
+
+    Returns:
+        dict: The number of completed stages, of completed segments and of segments (None until the story is segmented).
+    """
+    last_segment_stage = '/image' if single_pass_render else '/clip'
+    segments_completed = sum(1 for stage in job.stages if stage.startswith('segments/') and stage.endswith(last_segment_stage))
+    segments = None
+    if 'structured_story' in job.stages :
+        segments = len(job.get_output('structured_story')['segments'])
+    elif 'segment_annotations' in job.stages :
+        segments = len(parse_segments(job.get_output('segment_annotations')))
+    return {'completed_stages': len(job.stages), 'segments_completed': segments_completed, 'segments': segments}
+
+def _report_progress(job_queue, job_id, single_pass_render, stopped) :
+    while not stopped.wait(JOB_SERVICE_SETTINGS.PROGRESS_INTERVAL) :
+        try :
+            job = JobManifest.load(WORK_FOLDER_PATH, job_id)
+        except (OSError, ValueError) :
+            # not created yet, or removed at the end of the job
+            continue
+        job_queue.set_progress(job_id, get_job_progress(job, single_pass_render))
+
+def run_job(database_path, job_id, parameters, args) :
+    """
+    Runs a job of the queue, in a process spawned by the service, and records its status.
+
+    Args:
+        database_path (str): Path of the queue database.
+        job_id (str): The id of the job.
+        parameters (dict): The story parameters of the job.
+        args (argparse.Namespace): The pipeline options of the service.
+    """
+    # its own process group: the service stops the job, its encode workers and their ffmpeg processes with one signal,
+    # and a Ctrl-C in the terminal of the service does not reach them
+    os.setpgrp()
+    set_log_folder(os.path.join(LOGGING_SETTINGS.LOG_FOLDER_PATH, 'jobs', job_id))
+    configure_pipeline(args)
+    set_concurrency_budget(args.concurrency_budget)
+    job_queue = JobQueue(database_path)
+
+    stopped = threading.Event()
+    progress_thread = threading.Thread(target=_report_progress, args=(job_queue, job_id, args.single_pass_render, stopped), daemon=True)
+    progress_thread.start()
+    try :
+        generate_video_story(
+            os.environ.get('OPENAI_API_KEY'), **parameters, job_id=job_id,
+            max_workers=args.max_workers, single_pass_render=args.single_pass_render, b64_images=args.b64_images, structured_story=args.structured_story, stream_segments=args.stream_segments, hls_output=args.hls, merge_speech_lines=args.merge_speech_lines
+        )
+        status, error = JOB_STATUSES.SUCCEEDED, None
+    except Exception as e :
+        logger.exception(f'Job {job_id} failed')
+        status, error = JOB_STATUSES.FAILED, str(e)
+    finally :
+        # a spawned process does not run the exit handlers of the main process, the encode pool and the log listener are stopped here
+        shutdown_encode_pool()
+        stopped.set()
+        progress_thread.join()
+    job_queue.finish(job_id, status, error)
+    stop_logging()
+
+class JobService :
+    """
+    Runs the jobs of a queue with a bounded number of worker processes.
+
+    Args:
+        job_queue (JobQueue): The queue.
+        args (argparse.Namespace): The pipeline options passed to the jobs.
+        workers (int): Maximum number of jobs running at the same time.
+        exit_when_empty (bool): If True, the service stops once the queue is empty and no job is running.
+    """
+    def __init__(self, job_queue, args, workers = 1, exit_when_empty = False) :
+        self.job_queue = job_queue
+        self.args = args
+        self.workers = workers
+        self.exit_when_empty = exit_when_empty
+        self.draining = False
+        self.aborting = False
+        self._processes = {}
+        self._context = multiprocessing.get_context('spawn')
+
+    def _on_signal(self, signal_number, frame) :
+        if self.draining :
+            logger.info('Stopping the running jobs, they are put back in the queue')
+            self.aborting = True
+        else :
+            logger.info(f'Draining : no new job is started, waiting for {len(self._processes)} running jobs (signal again to stop them)')
+            self.draining = True
+
+    def _recover_jobs(self) :
+        # the jobs still running in the queue were left by a service which did not stop cleanly
+        for job in self.job_queue.list_jobs(JOB_STATUSES.RUNNING) :
+            if job['cancel_requested'] :
+                self._finish_cancelled(job['id'])
+            else :
+                self.job_queue.requeue(job['id'])
+
+    def _start_job(self, job) :
+        process = self._context.Process(target=run_job, args=(self.job_queue.database_path, job['id'], job['parameters'], self.args), name=f'job-{job["id"]}')
+        process.start()
+        self.job_queue.set_worker_pid(job['id'], process.pid)
+        self._processes[job['id']] = process
+        logger.info(f'Job {job["id"]} started (pid {process.pid}) : {job["parameters"]["output_file_name"]}')
+
+    def _stop_job(self, job_id) :
+        process = self._processes[job_id]
+        try :
+            os.killpg(process.pid, signal.SIGTERM)
+        except ProcessLookupError :
+            # the process has not created its group yet
+            process.terminate()
+
+    def _finish_cancelled(self, job_id) :
+        if self.job_queue.finish(job_id, JOB_STATUSES.CANCELLED) :
+            shutil.rmtree(JobManifest.get_job_folder_path(WORK_FOLDER_PATH, job_id), ignore_errors=True)
+            logger.info(f'Job {job_id} cancelled')
+
+    def _reap_jobs(self) :
+        for job_id, process in list(self._processes.items()) :
+            if process.is_alive() :
+                continue
+            process.join()
+            del self._processes[job_id]
+            job = self.job_queue.get_job(job_id)
+            if job['status'] != JOB_STATUSES.RUNNING :
+                logger.info(f'Job {job_id} {job["status"]}')
+            elif job['cancel_requested'] :
+                self._finish_cancelled(job_id)
+            elif self.aborting :
+                self.job_queue.requeue(job_id)
+            else :
+                # killed or crashed before recording its status
+                self.job_queue.finish(job_id, JOB_STATUSES.FAILED, f'Job process exited with code {process.exitcode}')
+                logger.error(f'Job {job_id} process exited with code {process.exitcode}')
+
+    @log_function_call(logger)
+    def run(self) :
+        """
+        Runs the jobs until a stop signal (or until the queue is empty if exit_when_empty), then waits for the running jobs.
+        """
+        previous_handlers = {signal_number: signal.signal(signal_number, self._on_signal) for signal_number in (signal.SIGTERM, signal.SIGINT)}
+        self._recover_jobs()
+        logger.info(f'Job service started with {self.workers} workers, queue : {self.job_queue.database_path}')
+        stopping = set()
+        try :
+            while True :
+                self._reap_jobs()
+                for job_id in self._processes :
+                    if job_id not in stopping and (self.aborting or self.job_queue.get_job(job_id)['cancel_requested']) :
+                        self._stop_job(job_id)
+                        stopping.add(job_id)
+
+                while not self.draining and len(self._processes) < self.workers :
+                    job = self.job_queue.claim()
+                    if job is None :
+                        break
+                    self._start_job(job)
+
+                if not self._processes and (self.draining or (self.exit_when_empty and not self.job_queue.count_jobs().get(JOB_STATUSES.QUEUED))) :
+                    break
+                time.sleep(JOB_SERVICE_SETTINGS.POLL_INTERVAL)
+        finally :
+            for signal_number, handler in previous_handlers.items() :
+                signal.signal(signal_number, handler)
+        logger.info(f'Job service stopped, jobs : {self.job_queue.count_jobs()}')
+
+def _format_job(job) :
+    progress = job['progress'] if job['status'] == JOB_STATUSES.RUNNING else None
+    if progress and progress['segments'] :
+        progress = f"{progress['segments_completed']}/{progress['segments']} segments"
+    elif progress :
+        progress = f"{progress['completed_stages']} stages"
+    line = f"{job['id']}  {job['status']:<10} {progress or '':<16} {job['parameters']['output_file_name']}"
+    if job['cancel_requested'] and job['status'] == JOB_STATUSES.RUNNING :
+        line += '  (cancelling)'
+    if job['error'] :
+        line += f"  error : {job['error']}"
+    return line
+
+def _submit_wait(job_queue, parameters) :
+    while True :
+        try :
+            return job_queue.submit(parameters)
+        except QueueFullError :
+            time.sleep(JOB_SERVICE_SETTINGS.SUBMIT_RETRY_INTERVAL)
+
+
+if __name__ == "__main__":
+    '''
+    usage: python3 -m job_service [-h] [--database DATABASE] {serve,submit,status,cancel} ...
+
+    Queue of video generation jobs run by a pool of worker processes
+
+    optional arguments:
+    -h, --help            show this help message and exit
+    --database DATABASE   Path of the queue database (optional, default work_folder/job_queue.sqlite3)
+
+    python3 -m job_service serve [-h] [--workers WORKERS] [--max_queued MAX_QUEUED] [--concurrency_budget CONCURRENCY_BUDGET]
+                               [--exit_when_empty] [pipeline options]
+    --workers WORKERS     Maximum number of jobs running at the same time, each in its own process (optional, default 2)
+    --max_queued MAX_QUEUED
+                            Maximum number of waiting jobs, the submits beyond are refused (optional, default 100)
+    --concurrency_budget CONCURRENCY_BUDGET
+                            Maximum number of API calls and encodes running at the same time in each job (optional)
+    --exit_when_empty     Stop once the queue is empty and the running jobs are done
+    The other options are the pipeline options of generate_video_story, applied to every job.
+
+    python3 -m job_service submit [-h] (--manifest MANIFEST | --plot PLOT --illustration_style ILLUSTRATION_STYLE --output_file_name OUTPUT_FILE_NAME)
+                               [--geo_time_setting GEO_TIME_SETTING] [--additional_keywords ADDITIONAL_KEYWORDS]
+                               [--content_restrictions CONTENT_RESTRICTIONS] [--wait]
+    --manifest MANIFEST   JSONL or CSV file of story specs to submit (see generate_video_batch)
+    --wait                Wait for room in the queue instead of failing when it is full
+
+    python3 -m job_service status [-h] [--status STATUS] [--limit LIMIT] [JOB_ID]
+    JOB_ID                Show one job (optional, default the most recent jobs)
+    --status STATUS       Only show the jobs with this status (optional)
+    --limit LIMIT         Maximum number of jobs shown (optional, default 50)
+
+    python3 -m job_service cancel [-h] JOB_ID
+    JOB_ID                The job to cancel, a running job is stopped and its job folder removed
+    '''
+
+    parser = argparse.ArgumentParser(description="Queue of video generation jobs run by a pool of worker processes")
+    parser.add_argument("--database", type=str, default=JOB_SERVICE_SETTINGS.DATABASE_PATH, help="Path of the queue database (optional, default work_folder/job_queue.sqlite3)")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    serve_parser = subparsers.add_parser("serve", help="Run the queued jobs with a pool of worker processes")
+    serve_parser.add_argument("--workers", type=int, default=2, help="Maximum number of jobs running at the same time, each in its own process (optional, default 2)")
+    serve_parser.add_argument("--max_queued", type=int, default=JOB_QUEUE_SETTINGS.DEFAULT_MAX_QUEUED, help="Maximum number of waiting jobs, the submits beyond are refused (optional, default 100)")
+    serve_parser.add_argument("--concurrency_budget", type=int, help="Maximum number of API calls and encodes running at the same time in each job (optional)")
+    serve_parser.add_argument("--exit_when_empty", action="store_true", help="Stop once the queue is empty and the running jobs are done")
+    add_pipeline_arguments(serve_parser)
+
+    submit_parser = subparsers.add_parser("submit", help="Add jobs to the queue")
+    submit_parser.add_argument("--manifest", type=str, help="JSONL or CSV file of story specs to submit (see generate_video_batch)")
+    submit_parser.add_argument("--plot", type=str, help="A short description of the story")
+    submit_parser.add_argument("--illustration_style", type=str, help="The style of the illustrations (e.g., anime, realistic, cartoon)")
+    submit_parser.add_argument("--geo_time_setting", type=str, help="The geographical and temporal setting of the story (optional)")
+    submit_parser.add_argument("--additional_keywords", type=str, help="Additional keywords for the story (optional)")
+    submit_parser.add_argument("--content_restrictions", type=str, help="Any content restrictions (optional)")
+    submit_parser.add_argument("--output_file_name", type=str, help="The name of the output file")
+    submit_parser.add_argument("--wait", action="store_true", help="Wait for room in the queue instead of failing when it is full")
+
+    status_parser = subparsers.add_parser("status", help="Show the status and progress of the jobs")
+    status_parser.add_argument("job_id", type=str, nargs="?", metavar="JOB_ID", help="Show one job (optional, default the most recent jobs)")
+    status_parser.add_argument("--status", type=str, choices=(JOB_STATUSES.QUEUED, JOB_STATUSES.RUNNING, JOB_STATUSES.SUCCEEDED, JOB_STATUSES.FAILED, JOB_STATUSES.CANCELLED), help="Only show the jobs with this status (optional)")
+    status_parser.add_argument("--limit", type=int, default=50, help="Maximum number of jobs shown (optional, default 50)")
+
+    cancel_parser = subparsers.add_parser("cancel", help="Cancel a job")
+    cancel_parser.add_argument("job_id", type=str, metavar="JOB_ID", help="The job to cancel, a running job is stopped and its job folder removed")
+
+    args = parser.parse_args()
+
+    job_queue = JobQueue(args.database)
+
+    if args.command == "serve" :
+        if not os.environ.get('OPENAI_API_KEY') :
+            print('No OpenAI API KEY found.')
+            exit(1)
+        if args.workers < 1 :
+            print('Workers should be at least 1')
+            exit(1)
+        if args.max_queued < 1 :
+            print('Max queued should be at least 1')
+            exit(1)
+        # validates the pipeline options before any job is started, the jobs configure their own process
+        configure_pipeline(args)
+        job_queue.set_max_queued(args.max_queued)
+        JobService(job_queue, args, args.workers, args.exit_when_empty).run()
+
+    elif args.command == "submit" :
+        if args.manifest :
+            try :
+                story_specs = load_story_specs(args.manifest)
+            except (OSError, ValueError) as e :
+                print(f'Invalid manifest : {e}')
+                exit(1)
+        else :
+            missing_arguments = [f'--{name}' for name in ('illustration_style', 'plot', 'output_file_name') if not getattr(args, name)]
+            if missing_arguments :
+                submit_parser.error(f'the following arguments are required without --manifest: {", ".join(missing_arguments)}')
+            if not args.output_file_name.lower().endswith('.mp4') :
+                print('Output file name should end with .mp4 ')
+                exit(1)
+            story_specs = [{field: getattr(args, field) for field in STORY_SPEC_FIELDS}]
+
+        for index, story_spec in enumerate(story_specs) :
+            try :
+                job_id = _submit_wait(job_queue, story_spec) if args.wait else job_queue.submit(story_spec)
+            except (QueueFullError, ValueError) as e :
+                print(f'{e}, {index}/{len(story_specs)} jobs submitted.')
+                exit(1)
+            print(f'{job_id}  {story_spec["output_file_name"]}')
+
+    elif args.command == "status" :
+        if args.job_id :
+            job = job_queue.get_job(args.job_id)
+            if job is None :
+                print(f'No job found with id {args.job_id}.')
+                exit(1)
+            jobs = [job]
+        else :
+            jobs = job_queue.list_jobs(args.status, args.limit)
+        for job in jobs :
+            print(_format_job(job))
+        if not args.job_id :
+            print(f'Jobs : {job_queue.count_jobs()}, max queued : {job_queue.get_max_queued()}')
+
+    elif args.command == "cancel" :
+        status = job_queue.cancel(args.job_id)
+        if status is None :
+            print(f'No job found with id {args.job_id}.')
+            exit(1)
+        if status == JOB_STATUSES.RUNNING :
+            print(f'Job {args.job_id} is running, the service stops it.')
+        elif status == JOB_STATUSES.CANCELLED :
+            print(f'Job {args.job_id} cancelled.')
+        else :
+            print(f'Job {args.job_id} already {status}.')
+            exit(1)
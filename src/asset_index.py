@@ -0,0 +1,197 @@
+import difflib
+import hashlib
+import json
+import os
+import re
+import threading
+import uuid
+from src.logger import get_logger
+from src.metrics import add_counters
+
+logger = get_logger(__file__)
+
+"""
+This file contains the persistent index of the generated assets reused across stories (visual descriptions, DALL-E
+prompts and images). An asset is looked up by the normalized text it was generated from (lower case, no punctuation,
+single spaces) within a scope (e.g. the illustration style): first by the hash of the text, then, if a similarity
+threshold is set, by the most similar text of the scope (difflib ratio). A hit saves the request which generated
+the asset, its estimated cost is counted in the run report (asset_index_hits, saved_cost_usd).
+The index is an append-only JSON lines file, the images are stored next to it.
+"""
+
+class ASSET_COSTS :
+    # estimated prices in USD of the requests an asset replaces
+    IMAGE = 0.04
+    GPT4_INPUT_PER_TOKEN = 2.5 / 1000000
+    GPT4_OUTPUT_PER_TOKEN = 10 / 1000000
+    CHARACTERS_PER_TOKEN = 4
+
+def estimate_text_cost(input_text, output_text) :
+    """
+    Returns:
+        float: The estimated cost in USD of a GPT request, from the length of its input and output.
+    """
+    return (len(input_text) * ASSET_COSTS.GPT4_INPUT_PER_TOKEN + len(output_text) * ASSET_COSTS.GPT4_OUTPUT_PER_TOKEN) / ASSET_COSTS.CHARACTERS_PER_TOKEN
+
+def normalize_text(text) :
+    """
+    Returns:
+        str: The text in lower case, without punctuation and with single spaces.
+    """
+    return ' '.join(re.sub(r'[^\w\s]', ' ', text.lower()).split())
+
+class AssetIndex :
+    """
+    Thread-safe persistent index of the generated assets.
+
+    Args:
+        index_folder_path (str): Folder of the index file and of the asset files.
+        similarity_threshold (float): Minimum similarity (between 0 and 1) of the texts of a similar asset, None to only reuse
+                                      the assets generated from the same normalized text.
+    """
+    def __init__(self, index_folder_path, similarity_threshold = None) :
+        self.index_folder_path = index_folder_path
+        self.index_path = os.path.join(index_folder_path, 'index.jsonl')
+        self.similarity_threshold = similarity_threshold
+        self._entries = {}
+        self._scopes = {}
+        self._lock = threading.Lock()
+        os.makedirs(os.path.join(index_folder_path, 'assets'), exist_ok=True)
+        self._load()
+
+    def _load(self) :
+        if not os.path.exists(self.index_path) :
+            return
+        with open(self.index_path, encoding='utf-8') as index_file :
+            for line in index_file :
+                try :
+                    self._add_entry(json.loads(line))
+                except (ValueError, KeyError) :
+                    # line cut by a crash while it was appended
+                    continue
+
+    def _add_entry(self, entry) :
+        self._entries[entry['key']] = entry
+        self._scopes.setdefault((entry['kind'], entry['scope']), []).append(entry)
+
+    @staticmethod
+    def _make_key(kind, scope, normalized_text) :
+        return hashlib.sha256(json.dumps([kind, scope, normalized_text], ensure_ascii=False).encode('utf-8')).hexdigest()
+
+    def _is_available(self, entry) :
+        return entry.get('file') is None or os.path.exists(os.path.join(self.index_folder_path, entry['file']))
+
+    def _find_similar(self, kind, scope, normalized_text) :
+        best_entry, best_ratio = None, self.similarity_threshold
+        matcher = difflib.SequenceMatcher(autojunk=False)
+        matcher.set_seq2(normalized_text)
+        for entry in self._scopes.get((kind, scope), ()) :
+            matcher.set_seq1(entry['text'])
+            # the quick upper bounds rule most of the entries out before the exact ratio
+            if matcher.real_quick_ratio() >= best_ratio and matcher.quick_ratio() >= best_ratio :
+                ratio = matcher.ratio()
+                if ratio >= best_ratio and self._is_available(entry) :
+                    best_entry, best_ratio = entry, ratio
+        return best_entry
+
+    def lookup(self, kind, text, scope = '') :
+        """
+        Looks up the asset generated from a text, or from the most similar text if a similarity threshold is set.
+        The hit or miss is counted in the current stage (asset_index_hits, asset_index_similar_hits, asset_index_misses, saved_cost_usd).
+
+        Args:
+            kind (str): The kind of asset (e.g. image, dall_e_prompt).
+            text (str): The text the asset is generated from.
+            scope (str): Only the assets of the same scope are reused (e.g. the illustration style).
+
+        Returns:
+            dict: The entry of the asset (its value, or its file path for file assets), None on a miss.
+        """
+        normalized_text = normalize_text(text)
+        with self._lock :
+            entry = self._entries.get(self._make_key(kind, scope, normalized_text))
+            is_similar = False
+            if entry is not None and not self._is_available(entry) :
+                entry = None
+            if entry is None and self.similarity_threshold is not None :
+                entry = self._find_similar(kind, scope, normalized_text)
+                is_similar = entry is not None
+
+        if entry is None :
+            add_counters(asset_index_misses=1)
+            return None
+        add_counters(asset_index_hits=1, asset_index_similar_hits=int(is_similar), saved_cost_usd=entry['cost'])
+        if entry.get('file') :
+            return {**entry, 'file': os.path.join(self.index_folder_path, entry['file'])}
+        return entry
+
+    def add(self, kind, text, value = None, data = None, suffix = '', scope = '', cost = 0) :
+        """
+        Adds an asset to the index.
+
+        Args:
+            kind (str): The kind of asset.
+            text (str): The text the asset was generated from.
+            value (str): The asset, for text assets.
+            data (bytes): The content of the asset file, for file assets.
+            suffix (str): The file extension of the asset file.
+            scope (str): The scope of the asset.
+            cost (float): The estimated cost in USD of the request which generated the asset.
+
+        Returns:
+            str: The path of the asset file, None for text assets.
+        """
+        normalized_text = normalize_text(text)
+        entry = {'key': self._make_key(kind, scope, normalized_text), 'kind': kind, 'scope': scope, 'text': normalized_text, 'value': value, 'file': None, 'cost': cost}
+        if data is not None :
+            entry['file'] = os.path.join('assets', entry['key'] + suffix)
+            tmp_path = os.path.join(self.index_folder_path, f"{entry['file']}.{uuid.uuid4()}.tmp")
+            with open(tmp_path, 'wb') as tmp_file :
+                tmp_file.write(data)
+            os.replace(tmp_path, os.path.join(self.index_folder_path, entry['file']))
+
+        with self._lock :
+            # appended in one write, lines of concurrent processes do not interleave
+            with open(self.index_path, 'a', encoding='utf-8') as index_file :
+                index_file.write(json.dumps(entry, ensure_ascii=False) + '\n')
+            self._add_entry(entry)
+        return os.path.join(self.index_folder_path, entry['file']) if entry['file'] else None
+
+def summarize_asset_reuse(report) :
+    """
+    Sums the asset index counters of the stages of a run report (see src.metrics).
+
+    Args:
+        report (dict): The run report.
+
+    Returns:
+        dict: The number of lookups, hits (and similar hits), the hit rate and the estimated saved cost in USD.
+    """
+    totals = {name: sum(stage.get(name, 0) for stage in report['stages'].values()) for name in ('asset_index_hits', 'asset_index_similar_hits', 'asset_index_misses', 'saved_cost_usd')}
+    lookups = totals['asset_index_hits'] + totals['asset_index_misses']
+    return {
+        'lookups': lookups,
+        'hits': totals['asset_index_hits'],
+        'similar_hits': totals['asset_index_similar_hits'],
+        'hit_rate': round(totals['asset_index_hits'] / lookups, 3) if lookups else None,
+        'saved_cost_usd': round(totals['saved_cost_usd'], 4)
+    }
+
+_asset_index = None
+
+def set_asset_index(asset_index) :
+    """
+    Sets the asset index used by the requests of src.openai_processor.
+
+    Args:
+        asset_index (AssetIndex): The index, None disables the reuse.
+    """
+    global _asset_index
+    _asset_index = asset_index
+
+def get_asset_index() :
+    """
+    Returns:
+        AssetIndex: The asset index used by the requests, None if the reuse is disabled.
+    """
+    return _asset_index
@@ -0,0 +1,105 @@
+import contextlib
+import contextvars
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from src.metrics import measure_stage
+
+"""
+This file contains the global concurrency budget of the process.
+When a budget is set, every synchronous OpenAI request, asset download and video encode holds one slot of it while it runs,
+so the total number of in-flight API calls and encodes stays bounded whatever the number of jobs and segments processed concurrently.
+It also contains the shared process pool of the CPU-bound encodes, which keeps them off the threads driving the network stages.
+"""
+
+_budget = None
+_encode_workers = os.cpu_count()
+_encode_pool = None
+_encode_pool_lock = threading.Lock()
+
+def set_concurrency_budget(limit) :
+    """
+    Sets the global concurrency budget.
+
+    Args:
+        limit (int): Maximum number of API calls and encodes running at the same time, None for no limit.
+    """
+    global _budget
+    _budget = threading.BoundedSemaphore(limit) if limit else None
+
+@contextlib.contextmanager
+def concurrency_slot() :
+    """
+    Context manager holding one slot of the global concurrency budget (does nothing if no budget is set).
+    Slots must only be held by leaf operations (a request, an encode), never while waiting for other work.
+    """
+    budget = _budget
+    if budget is None :
+        yield
+        return
+    with budget :
+        yield
+
+def set_encode_workers(workers) :
+    """
+    Sets the size of the encode process pool, must be called before the first encode.
+
+    Args:
+        workers (int): Number of encode processes, 0 to encode in the calling thread.
+    """
+    global _encode_workers
+    _encode_workers = workers
+
+def _get_encode_pool() :
+    global _encode_pool
+    with _encode_pool_lock :
+        if _encode_pool is None and _encode_workers :
+            # spawned (not forked) workers: forking a process running threads can copy held locks,
+            # and the workers have no budget of their own, the parent holds the slot of each encode
+            _encode_pool = ProcessPoolExecutor(
+                max_workers=_encode_workers,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=set_concurrency_budget,
+                initargs=(None,)
+            )
+        return _encode_pool
+
+def run_encode(encode_function, *args) :
+    """
+    Runs a CPU-bound encode in the shared process pool and waits for its result, holding one slot of the concurrency budget.
+    Runs it in the calling thread if the pool is disabled.
+
+    Args:
+        encode_function (callable): Module-level (picklable) function.
+        *args: Arguments of the function (picklable).
+
+    Returns:
+        The result of the function.
+    """
+    encode_pool = _get_encode_pool()
+    if encode_pool is None :
+        return encode_function(*args)
+    # measured here, the metrics recorded in the worker process do not come back
+    with concurrency_slot(), measure_stage(encode_function.__name__) :
+        return encode_pool.submit(encode_function, *args).result()
+
+def submit_in_context(executor, function, *args) :
+    """
+    Submits a function to a thread executor with a copy of the current context, so the run metrics (see src.metrics)
+    keep recording the stages it runs.
+
+    Returns:
+        concurrent.futures.Future: The future of the call.
+    """
+    return executor.submit(contextvars.copy_context().run, function, *args)
+
+def shutdown_encode_pool() :
+    """
+    Shuts the encode process pool down, waiting for the running encodes.
+    """
+    global _encode_pool
+    with _encode_pool_lock :
+        if _encode_pool is not None :
+            _encode_pool.shutdown()
+            _encode_pool = None
@@ -196,4 +196,88 @@ class GPT_SYSTEM_COMMAND_PROMPTS :
     "Content Restrictions (Optional):\n"
     "Users may specify any content restrictions or limitations for the story, such as adult content, violence, or language. "
     "You should ensure that the generated story adheres to these restrictions."
-    "IMPORTANT : The final output is only the story, you should provide the other details (characters, places) should be incorporated naturally to the story.")
\ No newline at end of file
+    "IMPORTANT : The final output is only the story, you should provide the other details (characters, places) should be incorporated naturally to the story.")
+
+    STRUCTURED_STORY = ("You are an AI tasked with writing illustrated and narrated stories based on user input, in one response which follows the given JSON schema.\n\n"
+
+    "The user gives the overall theme of the story in a concise sentence and optionally its geo-time setting (e.g., 1200 BCE, in a house), "
+    "additional plot keywords and content restrictions (e.g., adult content, violence, language) the story must adhere to.\n\n"
+
+    "1. **Segments:** Write the story as a list of coherent semantic segments, each one is a distinct part of the story that can be illustrated by a picture. "
+    "Add as many segments as possible. For each segment, give the place where it takes place and the characters involved.\n\n"
+
+    "2. **Lines:** Write the text of each segment as lines attributed to a voice. Spoken lines are attributed to the voice of the speaking character, "
+    "narration, actions and attributions like he said are attributed to a consistent narrator voice. "
+    "The voices are Onyx (Male), Nova (Female) and Shimmer (Female), each character keeps the same voice. "
+    "The text must not contain single quotes ('), double quotes (\"), backslashes (\\) or square brackets.\n\n"
+
+    "3. **Characters:** Describe each character of the story in a concise sentence aligned with the theme and setting: sex, size, build, dress code, age, height, "
+    "eye color, hair color, hair style and ethnic appearance, and list all the ways they are referred to in the story (include the narrator if they are a character).\n\n"
+
+    "4. **Places:** Describe each place of the story in great detail: its atmosphere, architecture, notable features and any relevant element for visual representation."
+)
+
+class GPT_RESPONSE_FORMATS :
+    STRUCTURED_STORY = {
+        "type": "json_schema",
+        "json_schema": {
+            "name": "illustrated_story",
+            "strict": True,
+            "schema": {
+                "type": "object",
+                "additionalProperties": False,
+                "required": ["segments", "characters", "places"],
+                "properties": {
+                    "segments": {
+                        "type": "array",
+                        "items": {
+                            "type": "object",
+                            "additionalProperties": False,
+                            "required": ["place", "characters", "lines"],
+                            "properties": {
+                                "place": {"type": "string"},
+                                "characters": {"type": "array", "items": {"type": "string"}},
+                                "lines": {
+                                    "type": "array",
+                                    "items": {
+                                        "type": "object",
+                                        "additionalProperties": False,
+                                        "required": ["voice", "text"],
+                                        "properties": {
+                                            "voice": {"type": "string", "enum": ["Onyx", "Nova", "Shimmer"]},
+                                            "text": {"type": "string"}
+                                        }
+                                    }
+                                }
+                            }
+                        }
+                    },
+                    "characters": {
+                        "type": "array",
+                        "items": {
+                            "type": "object",
+                            "additionalProperties": False,
+                            "required": ["name", "description", "references"],
+                            "properties": {
+                                "name": {"type": "string"},
+                                "description": {"type": "string"},
+                                "references": {"type": "array", "items": {"type": "string"}}
+                            }
+                        }
+                    },
+                    "places": {
+                        "type": "array",
+                        "items": {
+                            "type": "object",
+                            "additionalProperties": False,
+                            "required": ["name", "description"],
+                            "properties": {
+                                "name": {"type": "string"},
+                                "description": {"type": "string"}
+                            }
+                        }
+                    }
+                }
+            }
+        }
+    }
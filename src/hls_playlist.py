@@ -0,0 +1,85 @@
+import os
+import shutil
+from src.logger import get_logger, log_function_call
+from src.video_utils import split_transport_stream
+
+logger = get_logger(__file__)
+
+"""
+This file contains the HLS output of the pipeline.
+Each segment clip is remuxed (without re-encoding) into MPEG-TS chunks of a fixed duration as soon as it is encoded and the chunks
+are appended to a rolling EVENT playlist, so a player can start the story after its first segment and follow it while the next
+ones are generated. The target duration of the playlist can not change once published (RFC 8216), the clips are cut into
+chunks of at most this duration (their keyframes must be at the multiples of it, see EncodingProfile.keyframe_interval).
+The playlist is ended (#EXT-X-ENDLIST) once the last segment is added.
+"""
+
+class HLS_SETTINGS :
+    # seconds, the target duration of the playlist and the maximum duration of its chunks
+    TARGET_DURATION = 6
+    # seconds, timestamp of the start of the story: the first timestamps are delayed by the B-frames, at 0 they would be
+    # negative and the muxer would shift the first chunk only
+    START_TIMESTAMP = 10
+
+class HlsPlaylist :
+    """
+    Rolling HLS playlist of a story, the clips must be added in story order.
+
+    Args:
+        output_folder_path (str): Folder of the playlist and its chunks, emptied first.
+        playlist_name (str): File name of the playlist.
+        target_duration (int): Maximum duration of the chunks in seconds.
+    """
+    def __init__(self, output_folder_path, playlist_name = 'playlist.m3u8', target_duration = HLS_SETTINGS.TARGET_DURATION) :
+        self.output_folder_path = output_folder_path
+        self.playlist_path = os.path.join(output_folder_path, playlist_name)
+        self.target_duration = target_duration
+        self.chunks = []
+        self.ended = False
+        shutil.rmtree(output_folder_path, ignore_errors=True)
+        os.makedirs(output_folder_path)
+
+    @property
+    def duration(self) :
+        return sum(duration for _, duration in self.chunks)
+
+    @log_function_call(logger)
+    def add_clip(self, video_path) :
+        """
+        Remuxes a segment clip into the next chunks and publishes them in the playlist.
+
+        Args:
+            video_path (str): Path to the mp4 clip of the segment.
+
+        Returns:
+            list: Paths of the chunks.
+        """
+        # the timestamps of the chunks continue the previous ones
+        chunks = split_transport_stream(video_path, self.output_folder_path, self.target_duration, len(self.chunks), HLS_SETTINGS.START_TIMESTAMP + self.duration)
+        for chunk_name, duration in chunks :
+            if round(duration) > self.target_duration :
+                # e.g. a clip encoded without keyframes at the multiples of the target duration
+                logger.warning(f'Chunk {chunk_name} lasts {duration:.3f}s, more than the target duration of the playlist ({self.target_duration}s)')
+        self.chunks += chunks
+        self._write()
+        return [os.path.join(self.output_folder_path, chunk_name) for chunk_name, _ in chunks]
+
+    def end(self) :
+        """
+        Marks the playlist as complete.
+        """
+        self.ended = True
+        self._write()
+
+    def _write(self) :
+        lines = ['#EXTM3U', '#EXT-X-VERSION:3', '#EXT-X-PLAYLIST-TYPE:EVENT', f'#EXT-X-TARGETDURATION:{self.target_duration}', '#EXT-X-MEDIA-SEQUENCE:0']
+        for chunk_name, duration in self.chunks :
+            lines += [f'#EXTINF:{duration:.3f},', chunk_name]
+        if self.ended :
+            lines.append('#EXT-X-ENDLIST')
+
+        # replaced atomically, a player never reads a partial playlist
+        tmp_path = self.playlist_path + '.tmp'
+        with open(tmp_path, 'w') as playlist_file :
+            playlist_file.write('\n'.join(lines) + '\n')
+        os.replace(tmp_path, self.playlist_path)
@@ -0,0 +1,161 @@
+import json
+import os
+import threading
+import time
+import uuid
+
+"""
+This file contains the job manifest of the video generation pipeline.
+Each job has its own folder (work_folder/jobs/<job_id>) holding the intermediate files and a manifest.json
+recording the output of every completed stage, so an interrupted job can be resumed without re-running them.
+"""
+
+MANIFEST_FILE_NAME = 'manifest.json'
+
+class JobManifest :
+    """
+    Records the parameters of a job and the outputs of its completed stages.
+    The manifest is written atomically after every completed stage, it is safe to run stages from several threads.
+
+    Args:
+        job_folder_path (str): Folder of the job (intermediate files and manifest).
+        job_id (str): The id of the job.
+        parameters (dict): The parameters the job was created with.
+        stages (dict): The outputs of the completed stages, by stage name.
+    """
+    def __init__(self, job_folder_path, job_id, parameters, stages = None) :
+        self.job_folder_path = job_folder_path
+        self.job_id = job_id
+        self.parameters = parameters
+        self.stages = stages or {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def new_job_id() :
+        """
+        Returns:
+            str: A new unique job id.
+        """
+        return uuid.uuid4().hex[:12]
+
+    @staticmethod
+    def get_job_folder_path(work_folder_path, job_id) :
+        return os.path.join(work_folder_path, 'jobs', job_id)
+
+    @classmethod
+    def load(cls, work_folder_path, job_id) :
+        """
+        Loads the manifest of an existing job.
+
+        Args:
+            work_folder_path (str): The work folder.
+            job_id (str): The id of the job.
+
+        Returns:
+            JobManifest: The manifest of the job.
+
+        Raises:
+            FileNotFoundError: If the job has no manifest.
+        """
+        job_folder_path = cls.get_job_folder_path(work_folder_path, job_id)
+        with open(os.path.join(job_folder_path, MANIFEST_FILE_NAME)) as manifest_file :
+            manifest = json.load(manifest_file)
+        return cls(job_folder_path, manifest['job_id'], manifest['parameters'], manifest['stages'])
+
+    @classmethod
+    def open(cls, work_folder_path, job_id, parameters) :
+        """
+        Loads the manifest of a job, or creates it if the job does not exist yet.
+
+        Args:
+            work_folder_path (str): The work folder.
+            job_id (str): The id of the job.
+            parameters (dict): The parameters of the job (JSON serializable, without secrets).
+
+        Returns:
+            JobManifest: The manifest of the job.
+
+        Raises:
+            ValueError: If the existing job was created with other parameters.
+        """
+        job_folder_path = cls.get_job_folder_path(work_folder_path, job_id)
+        if os.path.exists(os.path.join(job_folder_path, MANIFEST_FILE_NAME)) :
+            job = cls.load(work_folder_path, job_id)
+            if job.parameters != parameters :
+                raise ValueError(f'Job {job_id} was created with other parameters : {job.parameters}')
+            return job
+
+        os.makedirs(job_folder_path, exist_ok=True)
+        job = cls(job_folder_path, job_id, parameters)
+        job.save()
+        return job
+
+    def save(self) :
+        """
+        Writes the manifest atomically in the job folder.
+        """
+        with self._lock :
+            manifest = {'job_id': self.job_id, 'parameters': self.parameters, 'stages': dict(self.stages)}
+            manifest_path = os.path.join(self.job_folder_path, MANIFEST_FILE_NAME)
+            tmp_path = f'{manifest_path}.{uuid.uuid4()}.tmp'
+            with open(tmp_path, 'w') as manifest_file :
+                json.dump(manifest, manifest_file, indent=2)
+            os.replace(tmp_path, manifest_path)
+
+    def _files_exist(self, output) :
+        filenames = output if isinstance(output, list) else [output]
+        return all(os.path.exists(os.path.join(self.job_folder_path, filename)) for filename in filenames)
+
+    def is_completed(self, stage, is_file = False) :
+        """
+        Args:
+            stage (str): The name of the stage.
+            is_file (bool): If True, the stage output is a filename (or list of filenames) of the job folder
+                            and the stage is only completed if the files still exist.
+
+        Returns:
+            bool: True if the stage is completed.
+        """
+        with self._lock :
+            record = self.stages.get(stage)
+        if record is None :
+            return False
+        return not is_file or self._files_exist(record['output'])
+
+    def get_output(self, stage) :
+        """
+        Returns:
+            The output of a completed stage.
+        """
+        with self._lock :
+            return self.stages[stage]['output']
+
+    def set_output(self, stage, output) :
+        """
+        Records the output of a completed stage and saves the manifest.
+
+        Args:
+            stage (str): The name of the stage.
+            output: The output of the stage (JSON serializable).
+        """
+        with self._lock :
+            self.stages[stage] = {'output': output, 'completed_at': time.time()}
+        self.save()
+
+    def run_stage(self, stage, compute, is_file = False) :
+        """
+        Returns the output of a stage, computing and recording it only if the stage is not completed yet.
+
+        Args:
+            stage (str): The name of the stage.
+            compute (callable): Function without argument computing the output of the stage.
+            is_file (bool): If True, the output is a filename (or list of filenames) of the job folder, see is_completed.
+
+        Returns:
+            The output of the stage.
+        """
+        if self.is_completed(stage, is_file) :
+            return self.get_output(stage)
+        output = compute()
+        self.set_output(stage, output)
+        return output
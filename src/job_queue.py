@@ -0,0 +1,281 @@
+import contextlib
+import json
+import os
+import sqlite3
+import time
+import uuid
+from src.logger import get_logger
+
+logger = get_logger(__file__)
+
+"""
+This file contains the persistent queue of the job service (see job_service.py).
+The jobs are rows of a SQLite database (work_folder/job_queue.sqlite3) shared by the processes of the service and by
+the commands submitting, listing and cancelling jobs: every operation opens its own connection and the ones reading
+then writing run in an immediate transaction, so concurrent processes never claim the same job or overfill the queue.
+The queue is bounded: a job is refused (QueueFullError) while max_queued jobs are waiting, the submitters slow down
+instead of piling up work the workers can not keep up with.
+"""
+
+class JOB_STATUSES :
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    SUCCEEDED = 'succeeded'
+    FAILED = 'failed'
+    CANCELLED = 'cancelled'
+    ACTIVE = (QUEUED, RUNNING)
+
+class JOB_QUEUE_SETTINGS :
+    DATABASE_FILE_NAME = 'job_queue.sqlite3'
+    DEFAULT_MAX_QUEUED = 100
+    # seconds a connection waits for the lock held by another process
+    LOCK_TIMEOUT = 30
+
+class QueueFullError(Exception) :
+    """
+    Raised when a job is submitted while the queue holds its maximum number of waiting jobs.
+    """
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    parameters TEXT NOT NULL,
+    status TEXT NOT NULL,
+    progress TEXT,
+    error TEXT,
+    cancel_requested INTEGER NOT NULL DEFAULT 0,
+    worker_pid INTEGER,
+    submitted_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status);
+CREATE TABLE IF NOT EXISTS settings (
+    name TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+'''
+
+class JobQueue :
+    """
+    Process-safe persistent queue of video generation jobs.
+
+    Args:
+        database_path (str): Path of the SQLite database, created if needed.
+    """
+    def __init__(self, database_path) :
+        self.database_path = database_path
+        os.makedirs(os.path.dirname(database_path) or '.', exist_ok=True)
+        with self._connect() as connection :
+            # readers do not block the writer and the writer does not block readers
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.executescript(SCHEMA)
+
+    @contextlib.contextmanager
+    def _connect(self, immediate = False) :
+        connection = sqlite3.connect(self.database_path, timeout=JOB_QUEUE_SETTINGS.LOCK_TIMEOUT, isolation_level=None)
+        connection.row_factory = sqlite3.Row
+        try :
+            if immediate :
+                # the write lock is taken before reading, the checks and the update happen atomically
+                connection.execute('BEGIN IMMEDIATE')
+                try :
+                    yield connection
+                except BaseException :
+                    connection.execute('ROLLBACK')
+                    raise
+                connection.execute('COMMIT')
+            else :
+                yield connection
+        finally :
+            connection.close()
+
+    @staticmethod
+    def _to_job(row) :
+        if row is None :
+            return None
+        job = dict(row)
+        job['parameters'] = json.loads(job['parameters'])
+        job['progress'] = json.loads(job['progress']) if job['progress'] else None
+        job['cancel_requested'] = bool(job['cancel_requested'])
+        return job
+
+    def set_max_queued(self, max_queued) :
+        """
+        Sets the maximum number of waiting jobs, shared by all the processes using the queue.
+
+        Args:
+            max_queued (int): The maximum number of queued jobs.
+        """
+        with self._connect() as connection :
+            connection.execute('INSERT OR REPLACE INTO settings (name, value) VALUES (?, ?)', ('max_queued', str(max_queued)))
+
+    def get_max_queued(self) :
+        """
+        Returns:
+            int: The maximum number of waiting jobs.
+        """
+        with self._connect() as connection :
+            row = connection.execute('SELECT value FROM settings WHERE name = ?', ('max_queued',)).fetchone()
+        return int(row['value']) if row else JOB_QUEUE_SETTINGS.DEFAULT_MAX_QUEUED
+
+    def submit(self, parameters, job_id = None) :
+        """
+        Adds a job at the end of the queue.
+
+        Args:
+            parameters (dict): The story parameters of the job (plot, illustration_style, ..., output_file_name).
+            job_id (str): The id of the job (a new one is generated if None).
+
+        Returns:
+            str: The id of the job.
+
+        Raises:
+            QueueFullError: If the queue holds its maximum number of waiting jobs.
+            ValueError: If a waiting or running job writes the same output file.
+        """
+        job_id = job_id or uuid.uuid4().hex[:12]
+        max_queued = self.get_max_queued()
+        with self._connect(immediate=True) as connection :
+            queued = connection.execute('SELECT COUNT(*) FROM jobs WHERE status = ?', (JOB_STATUSES.QUEUED,)).fetchone()[0]
+            if queued >= max_queued :
+                raise QueueFullError(f'The queue is full ({queued} jobs waiting)')
+            # two jobs writing the same output file would overwrite each other
+            for row in connection.execute('SELECT id, parameters FROM jobs WHERE status IN (?, ?)', JOB_STATUSES.ACTIVE) :
+                if json.loads(row['parameters'])['output_file_name'] == parameters['output_file_name'] :
+                    raise ValueError(f'Job {row["id"]} already writes {parameters["output_file_name"]}')
+            connection.execute(
+                'INSERT INTO jobs (id, parameters, status, submitted_at) VALUES (?, ?, ?, ?)',
+                (job_id, json.dumps(parameters), JOB_STATUSES.QUEUED, time.time())
+            )
+        logger.info(f'Job {job_id} queued')
+        return job_id
+
+    def claim(self, worker_pid = None) :
+        """
+        Marks the oldest waiting job as running.
+
+        Args:
+            worker_pid (int): The id of the process running the job.
+
+        Returns:
+            dict: The job, None if no job is waiting.
+        """
+        with self._connect(immediate=True) as connection :
+            row = connection.execute('SELECT id FROM jobs WHERE status = ? ORDER BY rowid LIMIT 1', (JOB_STATUSES.QUEUED,)).fetchone()
+            if row is None :
+                return None
+            connection.execute(
+                'UPDATE jobs SET status = ?, worker_pid = ?, started_at = ?, progress = NULL, error = NULL WHERE id = ?',
+                (JOB_STATUSES.RUNNING, worker_pid, time.time(), row['id'])
+            )
+            return self._to_job(connection.execute('SELECT * FROM jobs WHERE id = ?', (row['id'],)).fetchone())
+
+    def set_worker_pid(self, job_id, worker_pid) :
+        """
+        Records the id of the process running a job.
+        """
+        with self._connect() as connection :
+            connection.execute('UPDATE jobs SET worker_pid = ? WHERE id = ?', (worker_pid, job_id))
+
+    def set_progress(self, job_id, progress) :
+        """
+        Records the progress of a running job.
+
+        Args:
+            job_id (str): The id of the job.
+            progress (dict): The progress (JSON serializable).
+        """
+        with self._connect() as connection :
+            connection.execute('UPDATE jobs SET progress = ? WHERE id = ? AND status = ?', (json.dumps(progress), job_id, JOB_STATUSES.RUNNING))
+
+    def finish(self, job_id, status, error = None) :
+        """
+        Records the end of a running job.
+
+        Args:
+            job_id (str): The id of the job.
+            status (str): The final status (succeeded, failed or cancelled).
+            error (str): The error of a failed job.
+
+        Returns:
+            bool: False if the job was not running (e.g. already finished by another process).
+        """
+        with self._connect() as connection :
+            cursor = connection.execute(
+                'UPDATE jobs SET status = ?, error = ?, finished_at = ? WHERE id = ? AND status = ?',
+                (status, error, time.time(), job_id, JOB_STATUSES.RUNNING)
+            )
+        return cursor.rowcount == 1
+
+    def requeue(self, job_id) :
+        """
+        Puts a running job back at the front of the queue (e.g. its worker stopped before the end), it resumes from its
+        completed stages when it is claimed again.
+
+        Args:
+            job_id (str): The id of the job.
+        """
+        with self._connect(immediate=True) as connection :
+            first_rowid = connection.execute('SELECT MIN(rowid) FROM jobs').fetchone()[0]
+            row = connection.execute('SELECT * FROM jobs WHERE id = ? AND status = ?', (job_id, JOB_STATUSES.RUNNING)).fetchone()
+            if row is None :
+                return
+            # the rowid gives the claim order, the job is moved before the oldest one
+            connection.execute('DELETE FROM jobs WHERE id = ?', (job_id,))
+            connection.execute(
+                'INSERT INTO jobs (rowid, id, parameters, status, progress, submitted_at) VALUES (?, ?, ?, ?, ?, ?)',
+                (first_rowid - 1, job_id, row['parameters'], JOB_STATUSES.QUEUED, row['progress'], row['submitted_at'])
+            )
+        logger.info(f'Job {job_id} requeued')
+
+    def cancel(self, job_id) :
+        """
+        Cancels a job: a waiting job is cancelled at once, a running job is flagged and stopped by the service.
+
+        Args:
+            job_id (str): The id of the job.
+
+        Returns:
+            str: The status of the job after the request, None if there is no such job.
+        """
+        with self._connect(immediate=True) as connection :
+            row = connection.execute('SELECT status FROM jobs WHERE id = ?', (job_id,)).fetchone()
+            if row is None :
+                return None
+            if row['status'] == JOB_STATUSES.QUEUED :
+                connection.execute('UPDATE jobs SET status = ?, finished_at = ? WHERE id = ?', (JOB_STATUSES.CANCELLED, time.time(), job_id))
+                return JOB_STATUSES.CANCELLED
+            if row['status'] == JOB_STATUSES.RUNNING :
+                connection.execute('UPDATE jobs SET cancel_requested = 1 WHERE id = ?', (job_id,))
+            return row['status']
+
+    def get_job(self, job_id) :
+        """
+        Returns:
+            dict: The job, None if there is no such job.
+        """
+        with self._connect() as connection :
+            return self._to_job(connection.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone())
+
+    def list_jobs(self, status = None, limit = None) :
+        """
+        Args:
+            status (str): Only list the jobs with this status (optional).
+            limit (int): Only list the most recent jobs (optional).
+
+        Returns:
+            list: The jobs, in queue order.
+        """
+        query = 'SELECT * FROM jobs' + (' WHERE status = ?' if status else '') + ' ORDER BY rowid DESC' + (' LIMIT ?' if limit else '')
+        parameters = [value for value in (status, limit) if value]
+        with self._connect() as connection :
+            return [self._to_job(row) for row in reversed(connection.execute(query, parameters).fetchall())]
+
+    def count_jobs(self) :
+        """
+        Returns:
+            dict: The number of jobs by status.
+        """
+        with self._connect() as connection :
+            return {row['status']: row['count'] for row in connection.execute('SELECT status, COUNT(*) AS count FROM jobs GROUP BY status')}
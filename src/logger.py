@@ -1,10 +1,162 @@
+import atexit
+import contextlib
+import hashlib
+import json
 import logging
-import functools 
-import os  
+import logging.handlers
+import functools
+import inspect
+import os
+import queue
+import threading
+import time
+from src.metrics import measure_stage, attribute_counters, record_latency
+
+"""
+This file contains the logging setup of the project.
+Loggers only put their records on a queue, a single QueueListener thread formats them and writes them to the console
+and to one log file per logger (logging_output/<logger_name>.log, see set_log_folder), so the I/O stays off the calling threads.
+The listener is started by the first record and each log file is opened by its first record, importing a module
+(or exiting on invalid arguments) starts no thread and opens no file.
+The records are formatted as text or as JSON lines (see configure_logging).
+"""
+
+class LOGGING_SETTINGS :
+    LOG_FOLDER_PATH = 'logging_output'
+    # logged values longer than this are truncated and hashed
+    MAX_VALUE_LENGTH = 200
+    # values of these arguments are never logged
+    SECRET_ARGUMENT_NAMES = {'open_ai_api_key', 'open_ai_api_kei', 'openai_key', 'api_key'}
+    SECRET_PREFIXES = ('sk-',)
+    JSON_LINES = os.environ.get('PLOT2VIDEO_LOG_FORMAT', 'text').lower() == 'json'
+
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+class JsonLinesFormatter(logging.Formatter) :
+    """
+    Formats a record as a JSON object on one line, with the fields added by log_function_call (function, duration, ...).
+    """
+    FIELDS = ('function', 'event', 'duration_seconds', 'arguments', 'output', 'error')
+
+    def format(self, record) :
+        entry = {
+            'time': self.formatTime(record),
+            'logger': record.name,
+            'level': record.levelname,
+            'message': record.getMessage()
+        }
+        for field in self.FIELDS :
+            if hasattr(record, field) :
+                entry[field] = getattr(record, field)
+        if record.exc_info :
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+class _LoggerFileHandler(logging.Handler) :
+    """
+    Dispatches the records to the log file of their logger, the files are opened on their first record.
+    """
+    def __init__(self) :
+        super().__init__()
+        self._file_handlers = {}
+
+    def setFormatter(self, formatter) :
+        super().setFormatter(formatter)
+        for file_handler in self._file_handlers.values() :
+            file_handler.setFormatter(formatter)
+
+    def emit(self, record) :
+        file_handler = self._file_handlers.get(record.name)
+        if file_handler is None :
+            file_handler = logging.FileHandler(os.path.join(LOGGING_SETTINGS.LOG_FOLDER_PATH, f"{record.name}.log"), delay=True)
+            file_handler.setFormatter(self.formatter)
+            self._file_handlers[record.name] = file_handler
+        file_handler.handle(record)
+
+    def close(self) :
+        for file_handler in self._file_handlers.values() :
+            file_handler.close()
+        super().close()
+
+class _LazyQueueHandler(logging.handlers.QueueHandler) :
+    """
+    Queue handler starting the listener thread on the first record.
+    """
+    def emit(self, record) :
+        if _listener is None :
+            with _setup_lock :
+                _start_listener()
+        super().emit(record)
+
+_queue = queue.SimpleQueue()
+_listener = None
+_output_handlers = []
+_setup_lock = threading.Lock()
+
+def _get_formatter() :
+    return JsonLinesFormatter() if LOGGING_SETTINGS.JSON_LINES else logging.Formatter(TEXT_FORMAT)
+
+def _start_listener() :
+    global _listener
+    if _listener is not None :
+        return
+    console_handler = logging.StreamHandler()
+    file_handler = _LoggerFileHandler()
+    for handler in (console_handler, file_handler) :
+        handler.setLevel(logging.INFO)
+        handler.setFormatter(_get_formatter())
+        _output_handlers.append(handler)
+    _listener = logging.handlers.QueueListener(_queue, *_output_handlers, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop_logging)
+
+def stop_logging() :
+    """
+    Flushes the queued records and stops the listener thread.
+    """
+    global _listener
+    with _setup_lock :
+        if _listener is None :
+            return
+        _listener.stop()
+        _listener = None
+        for handler in _output_handlers :
+            handler.close()
+        _output_handlers.clear()
+
+def set_log_folder(log_folder_path) :
+    """
+    Writes the next records to the log files of another folder (e.g. one folder per job of the job service),
+    the records logged so far are flushed to the current folder first.
+
+    Args:
+        log_folder_path (str): The folder of the log files, created if needed.
+    """
+    stop_logging()
+    os.makedirs(log_folder_path, exist_ok=True)
+    with _setup_lock :
+        LOGGING_SETTINGS.LOG_FOLDER_PATH = log_folder_path
+
+def configure_logging(json_lines = None, max_value_length = None) :
+    """
+    Changes the logging format.
+
+    Args:
+        json_lines (bool): If True, the records are written as JSON lines, otherwise as text.
+        max_value_length (int): Length above which the logged values are truncated and hashed.
+    """
+    with _setup_lock :
+        if json_lines is not None :
+            LOGGING_SETTINGS.JSON_LINES = json_lines
+        if max_value_length is not None :
+            LOGGING_SETTINGS.MAX_VALUE_LENGTH = max_value_length
+        for handler in _output_handlers :
+            handler.setFormatter(_get_formatter())
 
 def get_logger(filename):
     """
     Set up and get a logger, the associated log file : logger_name.log.
+    Calling it again for the same file returns the same logger without adding handlers.
 
     Args:
         filename (str): The name of the file.
@@ -13,34 +165,64 @@ def get_logger(filename):
         logging.Logger: The configured logger object.
     """
 
-    LOG_FOLDER_PATH = 'logging_output'
     logger_name = os.path.basename(filename)
-    logger = logging.getLogger(logger_name) 
-    logger.setLevel(logging.INFO)  
+    logger = logging.getLogger(logger_name)
+
+    with _setup_lock :
+        if not any(isinstance(handler, logging.handlers.QueueHandler) for handler in logger.handlers) :
+            logger.setLevel(logging.INFO)
+            logger.addHandler(_LazyQueueHandler(_queue))
+            logger.propagate = False
+
+    return logger
 
-    # Create a file handler that logs to a file named after the module
-    log_file_name = f"{logger_name}.log"  
-    file_handler = logging.FileHandler(os.path.join(LOG_FOLDER_PATH, log_file_name))
-    file_handler.setLevel(logging.INFO)
+def _is_secret(name, value) :
+    return name in LOGGING_SETTINGS.SECRET_ARGUMENT_NAMES or (isinstance(value, str) and value.startswith(LOGGING_SETTINGS.SECRET_PREFIXES))
 
-    # Create a console handler for output to console
-    console_handler = logging.StreamHandler() 
-    console_handler.setLevel(logging.INFO) 
+def summarize_value(value) :
+    """
+    Returns a loggable representation of a value: short values are kept as-is, long strings and reprs are truncated
+    and identified by their length and hash, collections are summarized element by element.
+
+    Args:
+        value: The value to summarize.
 
-    # Create a logging format
-    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-    file_handler.setFormatter(formatter)
-    console_handler.setFormatter(formatter)  
+    Returns:
+        The summary (str, number, bool, None, list or dict).
+    """
+    if value is None or isinstance(value, (bool, int, float)) :
+        return value
+    if isinstance(value, (list, tuple)) and len(value) <= 10 :
+        return [summarize_value(element) for element in value]
+    if isinstance(value, (list, tuple, set, dict)) and len(value) > 10 :
+        return f'<{type(value).__name__} of {len(value)} elements>'
+    if isinstance(value, dict) :
+        return {str(key): '***' if _is_secret(str(key), element) else summarize_value(element) for key, element in value.items()}
 
-    # Add the handlers to the logger
-    logger.addHandler(file_handler) 
-    logger.addHandler(console_handler)  
+    text = value if isinstance(value, str) else repr(value)
+    if isinstance(value, str) and _is_secret('', value) :
+        return '***'
+    if len(text) <= LOGGING_SETTINGS.MAX_VALUE_LENGTH :
+        return text
+    digest = hashlib.sha256(text.encode('utf-8', 'replace')).hexdigest()[:12]
+    return f'{text[:LOGGING_SETTINGS.MAX_VALUE_LENGTH]}... <{len(text)} chars, sha256 {digest}>'
 
-    return logger 
+def _summarize_arguments(signature, args, kwargs) :
+    try :
+        arguments = signature.bind_partial(*args, **kwargs).arguments
+    except TypeError :
+        arguments = {**{f'arg{index}': arg for index, arg in enumerate(args)}, **kwargs}
+    return {name: '***' if _is_secret(name, value) else summarize_value(value) for name, value in arguments.items()}
 
 def log_function_call(logger):
     """
-    Decorator for logging function calls, inputs, and outputs.
+    Decorator for logging function calls, inputs, outputs and durations.
+    The inputs and outputs are summarized (see summarize_value) and the secrets (API keys) are never logged.
+    Each call is measured as a stage named after the function (see src.metrics), the counters added during the call of a
+    private function (named _...) stay attributed to the stage of its caller.
+    Coroutine functions are supported, their awaited result is logged.
+    Generator functions are supported too: the call is measured from its start to the end of the iteration, the counters
+    added while the generator runs are attributed to it, and the number of yielded items is logged.
 
     Args:
         logger (logging.Logger): The logger object to be used for logging.
@@ -49,18 +231,81 @@ def log_function_call(logger):
         function: Decorator function for logging function calls.
     """
     def decorator(wrapped_fun):
-        @functools.wraps(wrapped_fun)
-        def wrapper(*args, **kwargs):
-            # Log function input
-            logger.info(f"\n Called function: {wrapped_fun.__name__}")
-            logger.info(f"Input arguments: args={args}, kwargs={kwargs}") 
+        signature = inspect.signature(wrapped_fun)
+        name = wrapped_fun.__name__
+        own_counters = not name.startswith('_')
+
+        def log_call(args, kwargs):
+            if not logger.isEnabledFor(logging.INFO):
+                return
+            arguments = _summarize_arguments(signature, args, kwargs)
+            logger.info(f"Called function: {name} - arguments: {arguments}", extra={'function': name, 'event': 'call', 'arguments': arguments})
+
+        def log_result(result, started_at):
+            if not logger.isEnabledFor(logging.INFO):
+                return
+            duration = time.perf_counter() - started_at
+            output = summarize_value(result)
+            logger.info(f"Finished function: {name} in {duration:.3f}s - output: {output}", extra={'function': name, 'event': 'return', 'duration_seconds': round(duration, 6), 'output': output})
 
-            # Call the original function
-            result = wrapped_fun(*args, **kwargs)
+        def log_error(error, started_at):
+            duration = time.perf_counter() - started_at
+            logger.error(f"Failed function: {name} after {duration:.3f}s - error: {error!r}", extra={'function': name, 'event': 'error', 'duration_seconds': round(duration, 6), 'error': repr(error)})
 
-            # Log function output
-            logger.info(f"Output: {result} \n")
+        if inspect.iscoroutinefunction(wrapped_fun):
+            @functools.wraps(wrapped_fun)
+            async def async_wrapper(*args, **kwargs):
+                log_call(args, kwargs)
+                started_at = time.perf_counter()
+                try:
+                    with measure_stage(name, own_counters):
+                        result = await wrapped_fun(*args, **kwargs)
+                except Exception as e:
+                    log_error(e, started_at)
+                    raise
+                log_result(result, started_at)
+                return result
+            return async_wrapper
 
+        if inspect.isgeneratorfunction(wrapped_fun):
+            @functools.wraps(wrapped_fun)
+            def generator_wrapper(*args, **kwargs):
+                log_call(args, kwargs)
+                started_at = time.perf_counter()
+                generator = wrapped_fun(*args, **kwargs)
+                items = 0
+                failed = False
+                try:
+                    while True:
+                        # the consumer code between the items is not part of the stage
+                        with attribute_counters(name) if own_counters else contextlib.nullcontext():
+                            try:
+                                item = next(generator)
+                            except StopIteration:
+                                break
+                        items += 1
+                        yield item
+                except Exception as e:
+                    failed = True
+                    log_error(e, started_at)
+                    raise
+                finally:
+                    generator.close()
+                    record_latency(name, time.perf_counter() - started_at, failed)
+                log_result(f'{items} yielded items', started_at)
+            return generator_wrapper
+
+        @functools.wraps(wrapped_fun)
+        def wrapper(*args, **kwargs):
+            log_call(args, kwargs)
+            started_at = time.perf_counter()
+            try:
+                with measure_stage(name, own_counters):
+                    result = wrapped_fun(*args, **kwargs)
+            except Exception as e:
+                log_error(e, started_at)
+                raise
+            log_result(result, started_at)
             return result
         return wrapper
-    return decorator
\ No newline at end of file
+    return decorator
@@ -0,0 +1,225 @@
+import collections
+import contextlib
+import contextvars
+import json
+import math
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+"""
+This file contains the per-stage instrumentation of the pipeline.
+Every function decorated with log_function_call is a stage: its latency is recorded, and the counters added while it runs
+(tokens, bytes, images, characters, retries...) are attributed to it, unless it is private (its name starts with _),
+then they stay attributed to the public stage calling it. The metrics are recorded in the process-wide recorder
+(exported in the Prometheus text format for long-running workers) and in the recorder of the current run, if any,
+which is written as a JSON report with the p50/p95 latency of each stage.
+"""
+
+class MetricsRecorder :
+    """
+    Thread-safe recorder of the latencies and counters of each stage.
+
+    Args:
+        max_samples (int): Number of latest latencies kept per stage for the percentiles (the count and sum cover all of them).
+    """
+    def __init__(self, max_samples = 10000) :
+        self.max_samples = max_samples
+        self._latencies = collections.defaultdict(lambda : collections.deque(maxlen=self.max_samples))
+        self._latency_counts = collections.Counter()
+        self._latency_sums = collections.Counter()
+        self._counters = collections.defaultdict(collections.Counter)
+        self._lock = threading.Lock()
+        self.started_at = time.time()
+
+    def record_latency(self, stage, latency_seconds, failed = False) :
+        with self._lock :
+            self._latencies[stage].append(latency_seconds)
+            self._latency_counts[stage] += 1
+            self._latency_sums[stage] += latency_seconds
+            if failed :
+                self._counters[stage]['errors'] += 1
+
+    def add_counters(self, stage, counters) :
+        with self._lock :
+            self._counters[stage].update(counters)
+
+    def get_report(self) :
+        """
+        Returns:
+            dict: For each stage, its number of calls, total/p50/p95/max latency in seconds and its counters.
+        """
+        with self._lock :
+            stages = {}
+            for stage in set(self._latency_counts) | set(self._counters) :
+                latencies = sorted(self._latencies.get(stage, ()))
+                stages[stage] = {
+                    'calls': self._latency_counts[stage],
+                    'total_seconds': round(self._latency_sums[stage], 6),
+                    'p50_seconds': _percentile(latencies, 50),
+                    'p95_seconds': _percentile(latencies, 95),
+                    'max_seconds': latencies[-1] if latencies else None,
+                    **dict(self._counters.get(stage, {}))
+                }
+        return {'started_at': self.started_at, 'duration_seconds': round(time.time() - self.started_at, 6), 'stages': stages}
+
+    def write_report(self, report_path) :
+        """
+        Writes the report as JSON.
+
+        Args:
+            report_path (str): Path of the report file.
+        """
+        os.makedirs(os.path.dirname(report_path) or '.', exist_ok=True)
+        with open(report_path, 'w') as report_file :
+            json.dump(self.get_report(), report_file, indent=2)
+
+    def to_prometheus_text(self, prefix = 'plot2video') :
+        """
+        Returns:
+            str: The metrics in the Prometheus text exposition format (a latency summary and one counter per counter name).
+        """
+        report = self.get_report()['stages']
+        lines = [f'# TYPE {prefix}_stage_duration_seconds summary']
+        for stage, metrics in sorted(report.items()) :
+            for quantile, key in (('0.5', 'p50_seconds'), ('0.95', 'p95_seconds')) :
+                if metrics[key] is not None :
+                    lines.append(f'{prefix}_stage_duration_seconds{{stage="{stage}",quantile="{quantile}"}} {metrics[key]}')
+            lines.append(f'{prefix}_stage_duration_seconds_sum{{stage="{stage}"}} {metrics["total_seconds"]}')
+            lines.append(f'{prefix}_stage_duration_seconds_count{{stage="{stage}"}} {metrics["calls"]}')
+
+        with self._lock :
+            counter_names = sorted({name for counters in self._counters.values() for name in counters})
+            for name in counter_names :
+                lines.append(f'# TYPE {prefix}_{name}_total counter')
+                for stage, counters in sorted(self._counters.items()) :
+                    if name in counters :
+                        lines.append(f'{prefix}_{name}_total{{stage="{stage}"}} {counters[name]}')
+        return '\n'.join(lines) + '\n'
+
+def _percentile(sorted_values, percentile) :
+    if not sorted_values :
+        return None
+    rank = math.ceil(percentile / 100 * len(sorted_values))
+    return sorted_values[max(rank, 1) - 1]
+
+_process_metrics = MetricsRecorder()
+_run_metrics = contextvars.ContextVar('run_metrics', default=None)
+_current_stage = contextvars.ContextVar('current_stage', default=None)
+
+def get_process_metrics() :
+    """
+    Returns:
+        MetricsRecorder: The recorder of all the stages run by the process.
+    """
+    return _process_metrics
+
+def _get_recorders() :
+    run_metrics = _run_metrics.get()
+    return (_process_metrics, run_metrics) if run_metrics else (_process_metrics,)
+
+@contextlib.contextmanager
+def record_run() :
+    """
+    Context manager recording the stages run in the current context (and the threads started with
+    src.concurrency.submit_in_context) in a new recorder.
+
+    Yields:
+        MetricsRecorder: The recorder of the run.
+    """
+    run_metrics = MetricsRecorder()
+    token = _run_metrics.set(run_metrics)
+    try :
+        yield run_metrics
+    finally :
+        _run_metrics.reset(token)
+
+@contextlib.contextmanager
+def attribute_counters(stage) :
+    """
+    Context manager attributing the counters added while it runs to a stage, without recording a latency
+    (e.g. for each step of a generator, whose latency is recorded once it is exhausted, see record_latency).
+
+    Args:
+        stage (str): The name of the stage.
+    """
+    token = _current_stage.set(stage)
+    try :
+        yield
+    finally :
+        _current_stage.reset(token)
+
+def record_latency(stage, latency_seconds, failed = False) :
+    """
+    Records a latency of a stage.
+
+    Args:
+        stage (str): The name of the stage.
+        latency_seconds (float): The latency in seconds.
+        failed (bool): If True, an error of the stage is counted too.
+    """
+    for recorder in _get_recorders() :
+        recorder.record_latency(stage, latency_seconds, failed)
+
+@contextlib.contextmanager
+def measure_stage(stage, own_counters = True) :
+    """
+    Context manager recording the latency of a stage, the counters added while it runs are attributed to it.
+
+    Args:
+        stage (str): The name of the stage.
+        own_counters (bool): If False, the counters stay attributed to the stage it runs in (e.g. for a private helper
+                             making the requests of the public stages, whose token usage must stay theirs).
+    """
+    started_at = time.perf_counter()
+    failed = False
+    try :
+        with attribute_counters(stage) if own_counters else contextlib.nullcontext() :
+            yield
+    except BaseException :
+        failed = True
+        raise
+    finally :
+        record_latency(stage, time.perf_counter() - started_at, failed)
+
+def add_counters(**counters) :
+    """
+    Adds counters (e.g. prompt_tokens=120, bytes=2048) to the stage running in the current context.
+    """
+    stage = _current_stage.get() or 'other'
+    counters = {name: value for name, value in counters.items() if value}
+    if not counters :
+        return
+    for recorder in _get_recorders() :
+        recorder.add_counters(stage, counters)
+
+def start_prometheus_server(port, host = '0.0.0.0') :
+    """
+    Serves the process metrics in the Prometheus text format on http://host:port/metrics from a daemon thread.
+
+    Args:
+        port (int): The port.
+        host (str): The interface to listen on.
+
+    Returns:
+        ThreadingHTTPServer: The server.
+    """
+    class MetricsHandler(BaseHTTPRequestHandler) :
+        def do_GET(self) :
+            if self.path.rstrip('/') != '/metrics' :
+                self.send_error(404)
+                return
+            body = _process_metrics.to_prometheus_text().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args) :
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -0,0 +1,261 @@
+import base64
+import io
+import json
+import random
+import subprocess
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import imageio_ffmpeg
+from PIL import Image
+from src.gpt_system_constants import GPT_SYSTEM_COMMAND_PROMPTS
+
+"""
+This file contains a local fake of the OpenAI chat completions, images and audio speech endpoints, used to benchmark
+the pipeline offline. It answers every GPT worker with canned outputs in the formats the pipeline expects (a story of
+the configured number of segments, with `Segment` and `Voice VoiceName: [text]` annotations), generated PNG images and
+silent MP3 files, with configurable latencies and error rates. Streamed chat completions are sent line by line.
+Point the OpenAI clients to it with the OPENAI_BASE_URL environment variable (see MockOpenAIServer.base_url).
+"""
+
+VOICES = ('Nova', 'Onyx', 'Shimmer')
+
+class MockOpenAISettings :
+    """
+    Behaviour of the mock server, can be changed while it runs.
+
+    Args:
+        segments (int): Number of segments of the generated stories.
+        lines_per_segment (int): Number of speech lines of each segment.
+        chat_latency (float): Latency of the chat completions in seconds.
+        image_latency (float): Latency of the image generations in seconds.
+        speech_latency (float): Latency of the speeches in seconds.
+        error_rate (float): Probability of answering a request with a retryable error (500 or 429).
+        speech_duration (float): Duration of the generated MP3 files in seconds.
+    """
+    def __init__(self, segments = 3, lines_per_segment = 2, chat_latency = 0, image_latency = 0, speech_latency = 0, error_rate = 0, speech_duration = 2) :
+        self.segments = segments
+        self.lines_per_segment = lines_per_segment
+        self.chat_latency = chat_latency
+        self.image_latency = image_latency
+        self.speech_latency = speech_latency
+        self.error_rate = error_rate
+        self.speech_duration = speech_duration
+
+def _get_speech_line(segment, line) :
+    return f'Line {line + 1} of part {segment + 1}, the heroes keep walking through the quiet valley.'
+
+def _get_story(settings) :
+    return '\n\n'.join(
+        ' '.join(_get_speech_line(segment, line) for line in range(settings.lines_per_segment))
+        for segment in range(settings.segments)
+    )
+
+def _get_voice_lines(settings, segment) :
+    return [f'Voice {VOICES[line % len(VOICES)]}: [{_get_speech_line(segment, line)}]' for line in range(settings.lines_per_segment)]
+
+def _get_speech_annotated_story(settings) :
+    return '\n\n'.join(line for segment in range(settings.segments) for line in _get_voice_lines(settings, segment))
+
+def _get_segment_annotated_story(settings) :
+    return '\n'.join(
+        f'Segment{segment + 1}: ' + ' '.join(_get_voice_lines(settings, segment)) + '\nPlace: The valley\nCharacters: The heroes'
+        for segment in range(settings.segments)
+    )
+
+def _get_structured_story(settings) :
+    return json.dumps({
+        'segments': [
+            {
+                'place': 'The valley',
+                'characters': ['The heroes'],
+                'lines': [{'voice': VOICES[line % len(VOICES)], 'text': _get_speech_line(segment, line)} for line in range(settings.lines_per_segment)]
+            }
+            for segment in range(settings.segments)
+        ],
+        'characters': [{'name': 'The heroes', 'description': 'Two young travellers in green cloaks.', 'references': ['the heroes']}],
+        'places': [{'name': 'The valley', 'description': 'A quiet green valley under a pale sky.'}]
+    })
+
+def get_chat_output(settings, system_command, input_command) :
+    """
+    Returns the canned output of the GPT worker identified by its system command.
+
+    Args:
+        settings (MockOpenAISettings): The settings of the server.
+        system_command (str): The system command of the request.
+        input_command (str): The input command of the request.
+
+    Returns:
+        str: The output of the worker.
+    """
+    outputs = {
+        GPT_SYSTEM_COMMAND_PROMPTS.GENERATE_STORY: lambda : _get_story(settings),
+        GPT_SYSTEM_COMMAND_PROMPTS.ALLOCATE_VOICES: lambda : _get_speech_annotated_story(settings),
+        GPT_SYSTEM_COMMAND_PROMPTS.TEXT_SEGMENTATION: lambda : _get_segment_annotated_story(settings),
+        GPT_SYSTEM_COMMAND_PROMPTS.STRUCTURED_STORY: lambda : _get_structured_story(settings),
+        GPT_SYSTEM_COMMAND_PROMPTS.VISUAL_DESCRIPTIONS: lambda : 'The heroes: two young travellers in green cloaks (the heroes). The valley: a quiet green valley under a pale sky.',
+        GPT_SYSTEM_COMMAND_PROMPTS.DALL_E: lambda : f'A cartoon scene of two young travellers in green cloaks walking through a quiet green valley, variation {uuid.uuid4().hex[:8]}.'
+    }
+    return outputs.get(system_command, lambda : input_command)()
+
+def _generate_png(seed) :
+    color = random.Random(seed).choices(range(256), k=3)
+    buffer = io.BytesIO()
+    Image.new('RGB', (1024, 1024), tuple(color)).save(buffer, format='PNG')
+    return buffer.getvalue()
+
+def _generate_silent_mp3(duration) :
+    result = subprocess.run(
+        [imageio_ffmpeg.get_ffmpeg_exe(), '-hide_banner', '-loglevel', 'error', '-f', 'lavfi', '-i', 'anullsrc=r=24000:cl=mono',
+         '-t', str(duration), '-c:a', 'libmp3lame', '-b:a', '32k', '-f', 'mp3', 'pipe:1'],
+        capture_output=True, check=True
+    )
+    return result.stdout
+
+class _MockOpenAIHandler(BaseHTTPRequestHandler) :
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args) :
+        pass
+
+    def _send(self, status, body, content_type = 'application/json', headers = None) :
+        if not isinstance(body, bytes) :
+            body = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items() :
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_stream(self, model, output, latency) :
+        # server-sent events, one chunk per line of the output, the latency is spread over the chunks
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        completion_id = f'chatcmpl-{uuid.uuid4().hex}'
+        lines = output.splitlines(keepends=True) or ['']
+
+        def send_event(data) :
+            event = f'data: {data}\n\n'.encode('utf-8')
+            self.wfile.write(f'{len(event):x}\r\n'.encode('ascii') + event + b'\r\n')
+            self.wfile.flush()
+
+        for line in lines :
+            time.sleep(latency / len(lines))
+            send_event(json.dumps({
+                'id': completion_id, 'object': 'chat.completion.chunk', 'created': int(time.time()), 'model': model,
+                'choices': [{'index': 0, 'delta': {'role': 'assistant', 'content': line}, 'finish_reason': None, 'logprobs': None}]
+            }))
+        send_event(json.dumps({
+            'id': completion_id, 'object': 'chat.completion.chunk', 'created': int(time.time()), 'model': model, 'choices': [],
+            'usage': {'prompt_tokens': 0, 'completion_tokens': len(output) // 4, 'total_tokens': len(output) // 4}
+        }))
+        send_event('[DONE]')
+        self.wfile.write(b'0\r\n\r\n')
+
+    def _send_error_if_unlucky(self) :
+        if random.random() >= self.server.settings.error_rate :
+            return False
+        if random.random() < 0.5 :
+            self._send(429, {'error': {'message': 'Rate limit reached (mock)', 'type': 'requests', 'code': 'rate_limit_exceeded'}},
+                       headers={'retry-after': '1', 'x-ratelimit-reset-requests': '1s'})
+        else :
+            self._send(500, {'error': {'message': 'Internal error (mock)', 'type': 'server_error', 'code': None}})
+        return True
+
+    def do_GET(self) :
+        image_id = self.path.rsplit('/', 1)[-1].split('.')[0]
+        if not self.path.startswith('/files/') :
+            self._send(404, {'error': {'message': 'Not found'}})
+            return
+        self._send(200, self.server.get_png(image_id), content_type='image/png')
+
+    def do_POST(self) :
+        request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        settings = self.server.settings
+        self.server.count_request(self.path)
+
+        if self.path.endswith('/chat/completions') :
+            if self._send_error_if_unlucky() :
+                return
+            messages = request['messages']
+            output = get_chat_output(settings, messages[0]['content'], messages[-1]['content'])
+            if request.get('stream') :
+                self._send_stream(request['model'], output, settings.chat_latency)
+                return
+            time.sleep(settings.chat_latency)
+            prompt_tokens = sum(len(message['content']) for message in messages) // 4
+            self._send(200, {
+                'id': f'chatcmpl-{uuid.uuid4().hex}', 'object': 'chat.completion', 'created': int(time.time()), 'model': request['model'],
+                'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': output}, 'finish_reason': 'stop', 'logprobs': None}],
+                'usage': {'prompt_tokens': prompt_tokens, 'completion_tokens': len(output) // 4, 'total_tokens': prompt_tokens + len(output) // 4}
+            })
+        elif self.path.endswith('/images/generations') :
+            time.sleep(settings.image_latency)
+            if self._send_error_if_unlucky() :
+                return
+            image_id = uuid.uuid4().hex
+            if request.get('response_format') == 'b64_json' :
+                image_data = {'b64_json': base64.b64encode(self.server.get_png(image_id)).decode('ascii')}
+            else :
+                image_data = {'url': f'{self.server.root_url}/files/{image_id}.png'}
+            self._send(200, {'created': int(time.time()), 'data': [image_data]})
+        elif self.path.endswith('/audio/speech') :
+            time.sleep(settings.speech_latency)
+            if self._send_error_if_unlucky() :
+                return
+            self._send(200, self.server.get_mp3(), content_type='audio/mpeg')
+        else :
+            self._send(404, {'error': {'message': f'Unknown endpoint {self.path}'}})
+
+class MockOpenAIServer(ThreadingHTTPServer) :
+    """
+    Local fake OpenAI server, serving from a daemon thread once started.
+
+    Args:
+        settings (MockOpenAISettings): The behaviour of the server.
+        port (int): The port, 0 for a free one.
+    """
+    daemon_threads = True
+
+    def __init__(self, settings = None, port = 0) :
+        super().__init__(('127.0.0.1', port), _MockOpenAIHandler)
+        self.settings = settings or MockOpenAISettings()
+        self.request_counts = {}
+        self._lock = threading.Lock()
+        self._mp3 = {}
+
+    @property
+    def root_url(self) :
+        return f'http://127.0.0.1:{self.server_address[1]}'
+
+    @property
+    def base_url(self) :
+        return f'{self.root_url}/v1'
+
+    def count_request(self, path) :
+        with self._lock :
+            self.request_counts[path] = self.request_counts.get(path, 0) + 1
+
+    def get_png(self, image_id) :
+        return _generate_png(image_id)
+
+    def get_mp3(self) :
+        duration = self.settings.speech_duration
+        with self._lock :
+            if duration not in self._mp3 :
+                self._mp3[duration] = _generate_silent_mp3(duration)
+            return self._mp3[duration]
+
+    def start(self) :
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self) :
+        self.shutdown()
+        self.server_close()
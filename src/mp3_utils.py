@@ -0,0 +1,158 @@
+import os
+
+"""
+This file contains the MP3 helpers of the audio assembly.
+The MP3 files (the text-to-speech outputs) are read as a sequence of frames from their 4 bytes frame headers, without
+decoding them and without spawning any process: the duration of a file is the sum of the durations of its frames, and
+files with the same parameters are concatenated by writing their frames one after another.
+"""
+
+class MP3_FRAME_TABLES :
+    # bitrates in kbps by (MPEG version is 1, layer) then bitrate index
+    BITRATES = {
+        (True, 1): (0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448),
+        (True, 2): (0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384),
+        (True, 3): (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+        (False, 1): (0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256),
+        (False, 2): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+        (False, 3): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160)
+    }
+    # sample rates by version bits (0: MPEG 2.5, 2: MPEG 2, 3: MPEG 1) then sample rate index
+    SAMPLE_RATES = {0: (11025, 12000, 8000), 2: (22050, 24000, 16000), 3: (44100, 48000, 32000)}
+    LAYERS = {1: 3, 2: 2, 3: 1}
+
+class Mp3Frame :
+    """
+    A frame of a MP3 file.
+
+    Args:
+        offset (int): Offset of the frame in the file.
+        length (int): Length of the frame in bytes.
+        samples (int): Number of samples per channel of the frame.
+        sample_rate (int): The sample rate in Hz.
+        is_info (bool): True for the Xing/Info frame at the start of the file, it holds metadata and no audio.
+    """
+    __slots__ = ('offset', 'length', 'samples', 'sample_rate', 'is_info')
+
+    def __init__(self, offset, length, samples, sample_rate, is_info = False) :
+        self.offset = offset
+        self.length = length
+        self.samples = samples
+        self.sample_rate = sample_rate
+        self.is_info = is_info
+
+    @property
+    def duration(self) :
+        return self.samples / self.sample_rate
+
+def _parse_frame_header(data, offset) :
+    if offset + 4 > len(data) or data[offset] != 0xFF or data[offset + 1] & 0xE0 != 0xE0 :
+        return None
+    version_bits = (data[offset + 1] >> 3) & 3
+    layer = MP3_FRAME_TABLES.LAYERS.get((data[offset + 1] >> 1) & 3)
+    bitrate_index = data[offset + 2] >> 4
+    sample_rate_index = (data[offset + 2] >> 2) & 3
+    if version_bits == 1 or layer is None or bitrate_index in (0, 15) or sample_rate_index == 3 :
+        return None
+
+    is_mpeg1 = version_bits == 3
+    bitrate = MP3_FRAME_TABLES.BITRATES[(is_mpeg1, layer)][bitrate_index] * 1000
+    sample_rate = MP3_FRAME_TABLES.SAMPLE_RATES[version_bits][sample_rate_index]
+    padding = (data[offset + 2] >> 1) & 1
+    if layer == 1 :
+        samples = 384
+        length = (12 * bitrate // sample_rate + padding) * 4
+    else :
+        samples = 1152 if layer == 2 or is_mpeg1 else 576
+        length = samples // 8 * bitrate // sample_rate + padding
+    return Mp3Frame(offset, length, samples, sample_rate)
+
+def _is_info_frame(data, frame) :
+    # the Xing/Info tag follows the side information of the first frame
+    is_mpeg1 = (data[frame.offset + 1] >> 3) & 3 == 3
+    is_mono = data[frame.offset + 3] >> 6 == 3
+    side_information_length = (17 if is_mono else 32) if is_mpeg1 else (9 if is_mono else 17)
+    tag_offset = frame.offset + 4 + side_information_length
+    return data[tag_offset:tag_offset + 4] in (b'Xing', b'Info')
+
+def _skip_id3v2(data) :
+    if data[:3] != b'ID3' or len(data) < 10 :
+        return 0
+    size = (data[6] << 21) | (data[7] << 14) | (data[8] << 7) | data[9]
+    has_footer = data[5] & 0x10
+    return 10 + size + (10 if has_footer else 0)
+
+def iter_mp3_frames(data) :
+    """
+    Iterates over the frames of MP3 data, skipping the ID3 tags and any garbage between frames.
+
+    Args:
+        data (bytes): The content of a MP3 file.
+
+    Yields:
+        Mp3Frame: The frames, in order.
+    """
+    offset = _skip_id3v2(data)
+    is_first_frame = True
+    while offset + 4 <= len(data) :
+        if data[offset:offset + 3] == b'TAG' and len(data) - offset == 128 :
+            # ID3v1 tag at the end of the file
+            return
+        frame = _parse_frame_header(data, offset)
+        if frame is None or offset + frame.length > len(data) :
+            # lost sync, look for the next frame header
+            offset = data.find(b'\xff', offset + 1)
+            if offset == -1 :
+                return
+            continue
+        if is_first_frame :
+            frame.is_info = _is_info_frame(data, frame)
+            is_first_frame = False
+        yield frame
+        offset += frame.length
+
+def get_mp3_duration(mp3_path) :
+    """
+    Reads the duration of a MP3 file from its frame headers (the encoder delay and padding, a few milliseconds, are included).
+
+    Args:
+        mp3_path (str): Path to the MP3 file.
+
+    Returns:
+        float: The duration in seconds.
+    """
+    with open(mp3_path, 'rb') as mp3_file :
+        data = mp3_file.read()
+    return sum(frame.duration for frame in iter_mp3_frames(data) if not frame.is_info)
+
+def concatenate_mp3(mp3_paths, output_path) :
+    """
+    Concatenates MP3 files with the same parameters (e.g. the speeches of a segment) into one MP3 file without re-encoding:
+    their audio frames are written one after another, their tags and Xing/Info frames are left out.
+    Each file is read once.
+
+    Args:
+        mp3_paths (list): Paths to the MP3 files, in order.
+        output_path (str): Path to the output MP3 file.
+
+    Returns:
+        float: The duration of the output file in seconds.
+
+    Raises:
+        ValueError: If a file has no MP3 frame.
+    """
+    duration = 0
+    tmp_path = output_path + '.tmp'
+    with open(tmp_path, 'wb') as output_file :
+        for mp3_path in mp3_paths :
+            with open(mp3_path, 'rb') as mp3_file :
+                data = mp3_file.read()
+            frames = [frame for frame in iter_mp3_frames(data) if not frame.is_info]
+            if not frames :
+                raise ValueError(f'No MP3 frame found in {mp3_path}')
+            view = memoryview(data)
+            for frame in frames :
+                output_file.write(view[frame.offset:frame.offset + frame.length])
+                duration += frame.duration
+    os.replace(tmp_path, output_path)
+    return duration
@@ -0,0 +1,115 @@
+import asyncio
+import threading
+
+"""
+This file contains the shared OpenAI clients.
+Creating a client opens a new httpx connection pool (and a new TLS handshake for every request made with it),
+so one long-lived pooled client is kept per API key and reused by every request.
+httpx and the openai SDK are imported when the first client is created, not when the module is imported.
+The SDK retries are disabled, the retries are handled by src.rate_limiter.
+"""
+
+class CLIENT_POOL_SETTINGS :
+    MAX_CONNECTIONS = 20
+    MAX_KEEPALIVE_CONNECTIONS = 10
+    KEEPALIVE_EXPIRY = 60
+    TIMEOUT = 600
+    CONNECT_TIMEOUT = 10
+
+_clients = {}
+_async_clients = {}
+_http_client = None
+_lock = threading.Lock()
+
+def _get_timeout() :
+    import httpx
+    return httpx.Timeout(CLIENT_POOL_SETTINGS.TIMEOUT, connect=CLIENT_POOL_SETTINGS.CONNECT_TIMEOUT)
+
+def _get_limits() :
+    import httpx
+    return httpx.Limits(
+        max_connections=CLIENT_POOL_SETTINGS.MAX_CONNECTIONS,
+        max_keepalive_connections=CLIENT_POOL_SETTINGS.MAX_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry=CLIENT_POOL_SETTINGS.KEEPALIVE_EXPIRY
+    )
+
+def get_client(open_ai_api_key) :
+    """
+    Gets the shared OpenAI client of an API key, creating it on first use.
+
+    Args:
+        open_ai_api_key (str): The API key for OpenAI.
+
+    Returns:
+        openai.OpenAI: The pooled client.
+    """
+    with _lock :
+        client = _clients.get(open_ai_api_key)
+        if client is None :
+            import httpx
+            from openai import OpenAI
+            http_client = httpx.Client(limits=_get_limits(), timeout=_get_timeout())
+            client = OpenAI(api_key=open_ai_api_key, http_client=http_client, max_retries=0)
+            _clients[open_ai_api_key] = client
+        return client
+
+def get_http_client() :
+    """
+    Gets the shared pooled httpx client used to download the generated assets, creating it on first use.
+
+    Returns:
+        httpx.Client: The pooled client.
+    """
+    global _http_client
+    with _lock :
+        if _http_client is None :
+            import httpx
+            _http_client = httpx.Client(limits=_get_limits(), timeout=_get_timeout(), follow_redirects=True)
+        return _http_client
+
+def get_async_client(open_ai_api_key) :
+    """
+    Gets the shared AsyncOpenAI client of an API key for the running event loop, creating it on first use.
+    An httpx async connection pool is bound to the event loop that created it, hence one client per (API key, loop).
+
+    Args:
+        open_ai_api_key (str): The API key for OpenAI.
+
+    Returns:
+        openai.AsyncOpenAI: The pooled async client.
+    """
+    loop = asyncio.get_running_loop()
+    with _lock :
+        client = _async_clients.get((open_ai_api_key, loop))
+        if client is None :
+            import httpx
+            from openai import AsyncOpenAI
+            http_client = httpx.AsyncClient(limits=_get_limits(), timeout=_get_timeout())
+            client = AsyncOpenAI(api_key=open_ai_api_key, http_client=http_client, max_retries=0)
+            _async_clients[(open_ai_api_key, loop)] = client
+        return client
+
+def close_clients() :
+    """
+    Closes the shared sync clients. Async clients should be closed with close_async_clients from their own event loop.
+    """
+    global _http_client
+    with _lock :
+        clients = list(_clients.values())
+        _clients.clear()
+        if _http_client is not None :
+            clients.append(_http_client)
+            _http_client = None
+    for client in clients :
+        client.close()
+
+async def close_async_clients() :
+    """
+    Closes the shared async clients of the running event loop.
+    """
+    loop = asyncio.get_running_loop()
+    with _lock :
+        keys = [key for key in _async_clients if key[1] is loop]
+        clients = [_async_clients.pop(key) for key in keys]
+    for client in clients :
+        await client.close()
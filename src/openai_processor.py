@@ -1,8 +1,16 @@
 import re 
-from openai import OpenAI
-import openai
+import asyncio
+import base64
+import hashlib
+import json
 from src.logger import get_logger, log_function_call
-from src.gpt_system_constants import GPT_SYSTEM_COMMAND_PROMPTS
+from src.openai_client import get_client, get_async_client
+from src.response_cache import get_cache
+from src.asset_index import get_asset_index, estimate_text_cost, normalize_text, ASSET_COSTS
+from src.rate_limiter import call_with_retries, call_with_retries_async, stream_with_retries
+from src.metrics import add_counters
+from src.gpt_system_constants import GPT_SYSTEM_COMMAND_PROMPTS, GPT_RESPONSE_FORMATS
+from src.story_parser import Segment, iter_segments, parse_segments
 from src.video_utils import *
 import os
 import argparse
@@ -14,10 +22,141 @@ This file contains functions to interact with the OpenAI API for text processing
 It includes functions for making requests to the GPT-4 model, generating a story for comic creation,
 adding segment annotations, generating character and place descriptions, creating DALL-E prompts, adding speech annotations,
 generating image URLs using the DALL-E model, and generating speech audio from text data.
+Every request function has an async counterpart (suffixed with _async) based on AsyncOpenAI.
+The segment annotations can also be streamed, each segment is parsed as soon as it is generated (see stream_segment_annotations),
+the stream is retried if it fails midway.
+All the requests go through the shared pooled clients of src.openai_client.
+The requests are rate limited per model and retried on retryable errors (see src.rate_limiter).
+When a cache is set (see src.response_cache), the responses are looked up by a hash of the model, parameters and inputs
+before any request is made.
+When an asset index is set (see src.asset_index), the visual descriptions, DALL-E prompts and images generated for
+previous stories are reused for the same (or similar) texts.
 """
 
+DISABLE_INPUT_ENHANCING_PROMPT = "I NEED to test how the tool works with extremely simple prompts. DO NOT add any detail, just use it AS-IS:"
+
+def _get_gpt4_request_params(system_command, input_command, response_format = None, max_tokens = 4000) :
+    params = dict(
+        model='gpt-4o',
+        messages=[
+            {"role": "system", "content": system_command},
+            {"role": "user", "content": input_command}
+        ],
+        temperature=0,
+        max_tokens=max_tokens
+    )
+    if response_format :
+        params['response_format'] = response_format
+    return params
+
+def _estimate_gpt4_request_tokens(params) :
+    # about 4 characters per token for the prompt, the completion is counted as max_tokens like the API does
+    prompt_characters = sum(len(message['content']) for message in params['messages'])
+    return prompt_characters // 4 + params['max_tokens']
+
+def _get_image_request_params(prompt) :
+    return dict(
+        model="dall-e-3",
+        prompt = (DISABLE_INPUT_ENHANCING_PROMPT + prompt).strip(),
+        n= 1,
+        size= "1024x1024"
+    )
+
+def _get_speech_request_params(speech_data) :
+    return dict(
+        model="tts-1",
+        voice=speech_data[0].lower(),
+        input=speech_data[1]
+    )
+
+def _add_usage_counters(response) :
+    if response.usage :
+        add_counters(prompt_tokens=response.usage.prompt_tokens, completion_tokens=response.usage.completion_tokens)
+
+def _get_image_scope(params) :
+    return f"{params['model']} {params['size']}"
+
+def _store_generated_image(image_data, cache, key, output_folder_path, prompt) :
+    add_counters(images=1)
+    asset_index = get_asset_index()
+    if image_data.b64_json :
+        image = base64.b64decode(image_data.b64_json)
+        add_counters(bytes=len(image))
+    elif cache or asset_index :
+        # the URL expires after a while, the image itself is cached
+        image = download_asset(image_data.url)
+    else :
+        return image_data.url
+
+    index_path = asset_index.add('image', prompt, data=image, suffix='.png', scope=_get_image_scope(_get_image_request_params(prompt)), cost=ASSET_COSTS.IMAGE) if asset_index else None
+    if cache :
+        return cache.set(key, image, '.png')
+    if index_path and not output_folder_path :
+        return index_path
+    output_path = os.path.join(output_folder_path, str(uuid.uuid4()) + '.png')
+    with open(output_path, 'wb') as output_file :
+        output_file.write(image)
+    return output_path
+
+def _get_indexed_text(kind, text, scope = '') :
+    asset_index = get_asset_index()
+    entry = asset_index.lookup(kind, text, scope) if asset_index else None
+    return entry['value'] if entry else None
+
+def _index_text(kind, text, model_input, model_output, scope = '') :
+    asset_index = get_asset_index()
+    if asset_index :
+        asset_index.add(kind, text, value=model_output, scope=scope, cost=estimate_text_cost(model_input, model_output))
+
+def _get_dall_e_prompt_scope(theme, visual_descriptions) :
+    # the prompt describes the characters and places of its story, it is only reused with the same descriptions
+    descriptions_hash = hashlib.sha256(normalize_text(visual_descriptions).encode('utf-8')).hexdigest()
+    return f'{theme} {descriptions_hash}'
+
+def _get_indexed_image(prompt) :
+    asset_index = get_asset_index()
+    entry = asset_index.lookup('image', prompt, _get_image_scope(_get_image_request_params(prompt))) if asset_index else None
+    return entry['file'] if entry else None
+
+def _get_cached_text(cache, key) :
+    cached_output = cache.get(key, '.txt') if cache else None
+    if cached_output is None :
+        return None
+    add_counters(cache_hits=1)
+    return cached_output.decode('utf-8')
+
+def _get_cached_speech(cache, key, output_path) :
+    cached_audio = cache.get(key, '.mp3') if cache else None
+    if cached_audio is None :
+        return False
+    add_counters(cache_hits=1)
+    with open(output_path, 'wb') as output_file :
+        output_file.write(cached_audio)
+    return True
+
+def _on_speech_generated(params, cache, key, output_path) :
+    add_counters(characters=len(params['input']), bytes=os.path.getsize(output_path))
+    if cache :
+        with open(output_path, 'rb') as output_file :
+            cache.set(key, output_file.read(), '.mp3')
+
+def _get_dall_e_model_input(story_segment, theme, visual_descriptions) :
+    return f'Story part : {story_segment} \n\n Theme : {theme}. : {visual_descriptions}'
+
+def _get_story_model_input(plot, geo_time_setting, additional_keywords, content_restrictions) :
+    prompt = f'Plot : {plot}'
+    if geo_time_setting : 
+        prompt += f'Geo-Time settings : {geo_time_setting}'
+    
+    if additional_keywords : 
+        prompt += f'Additional Plot Keywords  : {additional_keywords}'
+    
+    if content_restrictions : 
+        prompt += f'Content restrictions : {content_restrictions}'
+    return prompt
+
 @log_function_call(logger)
-def _make_gpt4_request(open_ai_api_key, system_command, input_command) :
+def _make_gpt4_request(open_ai_api_key, system_command, input_command, response_format = None, max_tokens = 4000) :
     """
     Makes a request to the OpenAI gpt-4o model with the specified system command and input command.
 
@@ -25,20 +164,113 @@ def _make_gpt4_request(open_ai_api_key, system_command, input_command) :
         open_ai_api_key (str): The API key for OpenAI.
         system_command (str): The system command for the gpt-4 model.
         input_command (str): The input command for the model.
+        response_format (dict): Optional. The response format of the request (e.g. a JSON schema).
+        max_tokens (int): Maximum number of tokens of the response.
 
     Returns:
         str: The response from the OpenAI API.
     """
-    response = OpenAI(api_key =open_ai_api_key).chat.completions.create(
-        model='gpt-4o',
-        messages=[
-            {"role": "system", "content": system_command},
-            {"role": "user", "content": input_command}
-        ],
-        temperature=0,
-        max_tokens=4000
+    params = _get_gpt4_request_params(system_command, input_command, response_format, max_tokens)
+    cache = get_cache()
+    key = cache.make_key('chat.completions', params) if cache else None
+    cached_output = _get_cached_text(cache, key)
+    if cached_output is not None :
+        return cached_output
+
+    response = call_with_retries(
+        params['model'],
+        lambda : get_client(open_ai_api_key).chat.completions.with_raw_response.create(**params),
+        _estimate_gpt4_request_tokens(params)
+    )
+    _add_usage_counters(response)
+    model_output = str(response.choices[0].message.content).strip()
+    if cache :
+        cache.set(key, model_output.encode('utf-8'), '.txt')
+    return model_output
+
+@log_function_call(logger)
+async def _make_gpt4_request_async(open_ai_api_key, system_command, input_command, response_format = None, max_tokens = 4000) :
+    """
+    Async version of _make_gpt4_request.
+    """
+    params = _get_gpt4_request_params(system_command, input_command, response_format, max_tokens)
+    cache = get_cache()
+    key = cache.make_key('chat.completions', params) if cache else None
+    cached_output = _get_cached_text(cache, key)
+    if cached_output is not None :
+        return cached_output
+
+    response = await call_with_retries_async(
+        params['model'],
+        lambda : get_async_client(open_ai_api_key).chat.completions.with_raw_response.create(**params),
+        _estimate_gpt4_request_tokens(params)
     )
-    return str(response.choices[0].message.content).strip()
+    _add_usage_counters(response)
+    model_output = str(response.choices[0].message.content).strip()
+    if cache :
+        cache.set(key, model_output.encode('utf-8'), '.txt')
+    return model_output
+
+@log_function_call(logger)
+def _stream_gpt4_request(open_ai_api_key, system_command, input_command) :
+    """
+    Streaming version of _make_gpt4_request, yields the response text as it is generated.
+    A cached response is yielded at once, the streamed response is cached once complete
+    (under the same key as the non streamed request).
+    If the stream fails midway, the request is retried and the text already yielded is skipped in the new response.
+    Temperature 0 is not fully deterministic: if the new response does not start with the text already yielded,
+    a RuntimeError is raised (nothing is cached).
+    """
+    params = _get_gpt4_request_params(system_command, input_command)
+    cache = get_cache()
+    key = cache.make_key('chat.completions', params) if cache else None
+    cached_output = _get_cached_text(cache, key)
+    if cached_output is not None :
+        yield cached_output
+        return
+
+    stream = stream_with_retries(
+        params['model'],
+        lambda : get_client(open_ai_api_key).chat.completions.with_raw_response.create(**params, stream=True, stream_options={'include_usage': True}),
+        _estimate_gpt4_request_tokens(params)
+    )
+    yielded_text = ''
+    current_attempt, attempt_text = 0, ''
+    for attempt, chunk in stream :
+        if attempt != current_attempt :
+            current_attempt, attempt_text = attempt, ''
+        if chunk.usage :
+            _add_usage_counters(chunk)
+        if chunk.choices and chunk.choices[0].delta.content :
+            start = len(attempt_text)
+            attempt_text += chunk.choices[0].delta.content
+            # the part of the chunk covering the text already yielded must be the same
+            overlap = yielded_text[start:len(attempt_text)]
+            if attempt_text[start:start + len(overlap)] != overlap :
+                raise RuntimeError(f"The retried {params['model']} stream differs from the text already yielded")
+            if len(attempt_text) > len(yielded_text) :
+                new_text = attempt_text[len(yielded_text):]
+                yielded_text += new_text
+                yield new_text
+    if len(attempt_text) < len(yielded_text) :
+        raise RuntimeError(f"The retried {params['model']} stream ended before the text already yielded")
+    if cache :
+        cache.set(key, yielded_text.strip().encode('utf-8'), '.txt')
+
+@log_function_call(logger)
+def stream_segment_annotations(story, open_ai_api_key, parser = None) :
+    """
+    Streaming version of add_segment_annotations: the segment annotated story is parsed while it is generated.
+
+    Args:
+        story (str): The story with speech annotations.
+        open_ai_api_key (str): The API key for OpenAI.
+        parser (SegmentParser): Optional. The parser to use, its text is the whole segment annotated story once the stream ends.
+
+    Yields:
+        Segment: Each segment of the story as soon as it is complete.
+    """
+    yield from iter_segments(_stream_gpt4_request(open_ai_api_key, GPT_SYSTEM_COMMAND_PROMPTS.TEXT_SEGMENTATION, story), parser)
 
 @log_function_call(logger)
 def add_segment_annotations(story, open_ai_api_key) :
@@ -55,6 +287,13 @@ def add_segment_annotations(story, open_ai_api_key) :
     model_output = _make_gpt4_request(open_ai_api_key, GPT_SYSTEM_COMMAND_PROMPTS.TEXT_SEGMENTATION ,story)
     return model_output
 
+@log_function_call(logger)
+async def add_segment_annotations_async(story, open_ai_api_key) :
+    """
+    Async version of add_segment_annotations.
+    """
+    return await _make_gpt4_request_async(open_ai_api_key, GPT_SYSTEM_COMMAND_PROMPTS.TEXT_SEGMENTATION, story)
+
 @log_function_call(logger)
 def get_visual_descriptions(story, open_ai_api_key) :
     """
@@ -67,7 +306,23 @@ def get_visual_descriptions(story, open_ai_api_key) :
     Returns:
         str: The visual descriptions of characters.
     """
+    indexed_output = _get_indexed_text('visual_descriptions', story)
+    if indexed_output is not None :
+        return indexed_output
     model_output = _make_gpt4_request(open_ai_api_key, GPT_SYSTEM_COMMAND_PROMPTS.VISUAL_DESCRIPTIONS ,story)
+    _index_text('visual_descriptions', story, story, model_output)
+    return model_output
+
+@log_function_call(logger)
+async def get_visual_descriptions_async(story, open_ai_api_key) :
+    """
+    Async version of get_visual_descriptions.
+    """
+    indexed_output = _get_indexed_text('visual_descriptions', story)
+    if indexed_output is not None :
+        return indexed_output
+    model_output = await _make_gpt4_request_async(open_ai_api_key, GPT_SYSTEM_COMMAND_PROMPTS.VISUAL_DESCRIPTIONS, story)
+    _index_text('visual_descriptions', story, story, model_output)
     return model_output
 
 
@@ -85,8 +340,28 @@ def get_dall_e_prompt(story_segment, theme, visual_descriptions, open_ai_api_key
     Returns:
         str: The generated DALL-E prompt.
     """
-    model_input = f'Story part : {story_segment} \n\n Theme : {theme}. : {visual_descriptions}'
+    # reused for the same segment text in the same style with the same character and place descriptions
+    scope = _get_dall_e_prompt_scope(theme, visual_descriptions)
+    indexed_output = _get_indexed_text('dall_e_prompt', story_segment, scope)
+    if indexed_output is not None :
+        return indexed_output
+    model_input = _get_dall_e_model_input(story_segment, theme, visual_descriptions)
     model_output = _make_gpt4_request(open_ai_api_key, GPT_SYSTEM_COMMAND_PROMPTS.DALL_E , model_input)
+    _index_text('dall_e_prompt', story_segment, model_input, model_output, scope)
+    return model_output
+
+@log_function_call(logger)
+async def get_dall_e_prompt_async(story_segment, theme, visual_descriptions, open_ai_api_key) :
+    """
+    Async version of get_dall_e_prompt.
+    """
+    scope = _get_dall_e_prompt_scope(theme, visual_descriptions)
+    indexed_output = _get_indexed_text('dall_e_prompt', story_segment, scope)
+    if indexed_output is not None :
+        return indexed_output
+    model_input = _get_dall_e_model_input(story_segment, theme, visual_descriptions)
+    model_output = await _make_gpt4_request_async(open_ai_api_key, GPT_SYSTEM_COMMAND_PROMPTS.DALL_E, model_input)
+    _index_text('dall_e_prompt', story_segment, model_input, model_output, scope)
     return model_output
 
 @log_function_call(logger)
@@ -105,24 +380,64 @@ def add_speech_annotations(story, open_ai_api_key) :
     return model_output
 
 @log_function_call(logger)
-def get_generated_image_url(prompt, open_ai_api_key) :
+async def add_speech_annotations_async(story, open_ai_api_key) :
+    """
+    Async version of add_speech_annotations.
+    """
+    return await _make_gpt4_request_async(open_ai_api_key, GPT_SYSTEM_COMMAND_PROMPTS.ALLOCATE_VOICES, story)
+
+@log_function_call(logger)
+def get_generated_image_url(prompt, open_ai_api_key, output_folder_path = None) :
     """
     Generates an image URL using the DALL-E model based on the given prompt.
+    If an output folder is given, the image is requested as base64 JSON and written in the folder,
+    which saves the second round-trip needed to download it from its URL.
 
     Args:
         prompt (str): The DALL-E prompt to generate the image.
         open_ai_api_key (str): The API key for OpenAI.
+        output_folder_path (str): Optional. Folder where to write the image.
 
     Returns:
-        str: The URL of the generated image.
+        str: The URL of the generated image, or the path of the image file when it was written in the output folder
+             or when a cache or an asset index is set.
     """
-    disable_input_enhancing_prompt = "I NEED to test how the tool works with extremely simple prompts. DO NOT add any detail, just use it AS-IS:"
-    response  = OpenAI(api_key =open_ai_api_key).images.generate(model="dall-e-3",
-    prompt = (disable_input_enhancing_prompt + prompt).strip(),
-    n= 1,
-    size= "1024x1024"
-    )
-    return response.data[0].url
+    indexed_path = _get_indexed_image(prompt)
+    if indexed_path :
+        return indexed_path
+    params = _get_image_request_params(prompt)
+    cache = get_cache()
+    key = cache.make_key('images.generate', params) if cache else None
+    cached_path = cache.get_path(key, '.png') if cache else None
+    if cached_path :
+        add_counters(cache_hits=1)
+        return cached_path
+
+    if output_folder_path :
+        params['response_format'] = 'b64_json'
+    response  = call_with_retries(params['model'], lambda : get_client(open_ai_api_key).images.with_raw_response.generate(**params))
+    return _store_generated_image(response.data[0], cache, key, output_folder_path, prompt)
+
+@log_function_call(logger)
+async def get_generated_image_url_async(prompt, open_ai_api_key, output_folder_path = None) :
+    """
+    Async version of get_generated_image_url.
+    """
+    indexed_path = _get_indexed_image(prompt)
+    if indexed_path :
+        return indexed_path
+    params = _get_image_request_params(prompt)
+    cache = get_cache()
+    key = cache.make_key('images.generate', params) if cache else None
+    cached_path = cache.get_path(key, '.png') if cache else None
+    if cached_path :
+        add_counters(cache_hits=1)
+        return cached_path
+
+    if output_folder_path :
+        params['response_format'] = 'b64_json'
+    response = await call_with_retries_async(params['model'], lambda : get_async_client(open_ai_api_key).images.with_raw_response.generate(**params))
+    return await asyncio.to_thread(_store_generated_image, response.data[0], cache, key, output_folder_path, prompt)
 
 @log_function_call(logger)
 def generate_speech(speech_data, open_ai_api_key, output_folder_path) :
@@ -137,14 +452,35 @@ def generate_speech(speech_data, open_ai_api_key, output_folder_path) :
     Returns:
         str: The filename of the generated speech audio file.
     """
-    response = OpenAI(api_key=open_ai_api_key).audio.speech.create(
-    model="tts-1",
-    voice=speech_data[0].lower(),
-    input=speech_data[1]
-    )
-   
+    params = _get_speech_request_params(speech_data)
+    output_filename = str(uuid.uuid4()) + '.mp3'
+    output_path = os.path.join(output_folder_path, output_filename)
+    cache = get_cache()
+    key = cache.make_key('audio.speech', params) if cache else None
+    if _get_cached_speech(cache, key, output_path) :
+        return output_filename
+
+    response = call_with_retries(params['model'], lambda : get_client(open_ai_api_key).audio.speech.with_raw_response.create(**params))
+    response.stream_to_file(output_path)
+    _on_speech_generated(params, cache, key, output_path)
+    return output_filename
+
+@log_function_call(logger)
+async def generate_speech_async(speech_data, open_ai_api_key, output_folder_path) :
+    """
+    Async version of generate_speech.
+    """
+    params = _get_speech_request_params(speech_data)
     output_filename = str(uuid.uuid4()) + '.mp3'
-    response.stream_to_file(os.path.join(output_folder_path, output_filename))
+    output_path = os.path.join(output_folder_path, output_filename)
+    cache = get_cache()
+    key = cache.make_key('audio.speech', params) if cache else None
+    if _get_cached_speech(cache, key, output_path) :
+        return output_filename
+
+    response = await call_with_retries_async(params['model'], lambda : get_async_client(open_ai_api_key).audio.speech.with_raw_response.create(**params))
+    await response.astream_to_file(output_path)
+    _on_speech_generated(params, cache, key, output_path)
     return output_filename
 
 @log_function_call(logger)
@@ -163,19 +499,87 @@ def generate_story(open_ai_api_kei, plot, geo_time_setting = None, additional_ke
         str: The generated story.
 
     """
-    prompt = f'Plot : {plot}'
-    if geo_time_setting : 
-        prompt += f'Geo-Time settings : {geo_time_setting}'
-    
-    if additional_keywords : 
-        prompt += f'Additional Plot Keywords  : {additional_keywords}'
-    
-    if content_restrictions : 
-        prompt += f'Content restrictions : {content_restrictions}'
-    
+    prompt = _get_story_model_input(plot, geo_time_setting, additional_keywords, content_restrictions)
     model_output = _make_gpt4_request(open_ai_api_kei, GPT_SYSTEM_COMMAND_PROMPTS.GENERATE_STORY, prompt)
     return model_output
 
+@log_function_call(logger)
+async def generate_story_async(open_ai_api_key, plot, geo_time_setting = None, additional_keywords = None, content_restrictions = None) :
+    """
+    Async version of generate_story.
+    """
+    prompt = _get_story_model_input(plot, geo_time_setting, additional_keywords, content_restrictions)
+    return await _make_gpt4_request_async(open_ai_api_key, GPT_SYSTEM_COMMAND_PROMPTS.GENERATE_STORY, prompt)
+
+def _parse_structured_story(model_output) :
+    try :
+        return json.loads(model_output)
+    except json.JSONDecodeError :
+        # refusals and truncated responses do not follow the schema
+        raise ValueError(f'The structured story response is not valid JSON : {model_output[:200]}')
+
+@log_function_call(logger)
+def generate_structured_story(open_ai_api_key, plot, geo_time_setting = None, additional_keywords = None, content_restrictions = None) :
+    """
+    Generates a story already split into segments, with the voice of each line and the descriptions of the characters and places,
+    in a single request constrained by a JSON schema (GPT_RESPONSE_FORMATS.STRUCTURED_STORY).
+    It replaces the generate_story, add_speech_annotations, add_segment_annotations and get_visual_descriptions requests,
+    the story text is only generated once.
+
+    Parameters:
+        open_ai_api_key (str): The API key for OpenAI.
+        plot (str): A concise sentence describing the central theme or mood of the story.
+        geo_time_setting (Optional[str]): Optional. The geographical and temporal setting of the story.
+        additional_keywords (Optional[List[str]]): Optional. Additional plot keywords or elements to incorporate into the story.
+        content_restrictions (Optional[str]): Optional. Content restrictions or limitations for the story.
+
+    Returns:
+        dict: The structured story (segments with their place, characters and lines, characters and places), see get_structured_story_outputs.
+
+    Raises:
+        ValueError: If the response does not follow the schema.
+    """
+    prompt = _get_story_model_input(plot, geo_time_setting, additional_keywords, content_restrictions)
+    model_output = _make_gpt4_request(open_ai_api_key, GPT_SYSTEM_COMMAND_PROMPTS.STRUCTURED_STORY, prompt, GPT_RESPONSE_FORMATS.STRUCTURED_STORY, 16000)
+    return _parse_structured_story(model_output)
+
+@log_function_call(logger)
+async def generate_structured_story_async(open_ai_api_key, plot, geo_time_setting = None, additional_keywords = None, content_restrictions = None) :
+    """
+    Async version of generate_structured_story.
+    """
+    prompt = _get_story_model_input(plot, geo_time_setting, additional_keywords, content_restrictions)
+    model_output = await _make_gpt4_request_async(open_ai_api_key, GPT_SYSTEM_COMMAND_PROMPTS.STRUCTURED_STORY, prompt, GPT_RESPONSE_FORMATS.STRUCTURED_STORY, 16000)
+    return _parse_structured_story(model_output)
+
+@log_function_call(logger)
+def get_structured_story_outputs(structured_story) :
+    """
+    Converts a structured story into the outputs of the unstructured requests.
+
+    Args:
+        structured_story (dict): The output of generate_structured_story.
+
+    Returns:
+        tuple: The story text (str), the segments (list of Segment, as returned by parse_segments) and the visual descriptions (str).
+    """
+    story = '\n\n'.join(' '.join(line['text'] for line in segment['lines']) for segment in structured_story['segments'])
+
+    segments = []
+    for index, segment in enumerate(structured_story['segments']) :
+        speech_annotations = ' '.join(f"Voice {line['voice']}: [{line['text']}]" for line in segment['lines'])
+        characters = ', '.join(segment['characters'])
+        segments.append(Segment(
+            index, f"{speech_annotations} Place: [{segment['place']}] Characters: [{characters}]", segment['place'], characters,
+            [(line['voice'], line['text']) for line in segment['lines']]
+        ))
+
+    visual_descriptions = '\n'.join(
+        [f"{character['name']}: {character['description']} ({', '.join(character['references'])})" for character in structured_story['characters']] +
+        [f"{place['name']}: {place['description']}" for place in structured_story['places']]
+    )
+    return story, segments, visual_descriptions
+
 @log_function_call(logger)
 def extract_segments(segment_annotated_story) :
     """
@@ -185,17 +589,9 @@ def extract_segments(segment_annotated_story) :
         segment_annotated_story (str): The story with segment annotations.
 
     Returns:
-        list: A list of processed segments from the story.
+        list: A list of processed segments from the story (the text of each Segment returned by parse_segments).
     """
-    segments = segment_annotated_story.strip().split("Segment")[1:]
-    processed_segments = []
-
-    for segment in segments:
-        segment = segment.strip()
-        if segment:
-            processed_segments.append(' '.join(segment.split()[2:]))
-    
-    return processed_segments
+    return [segment.text for segment in parse_segments(segment_annotated_story)]
 
 
 @log_function_call(logger)
@@ -0,0 +1,301 @@
+import asyncio
+import random
+import re
+import threading
+import time
+from src.logger import get_logger
+from src.concurrency import concurrency_slot
+from src.metrics import add_counters
+
+logger = get_logger(__file__)
+
+"""
+This file contains the rate limiting and retry layer of the OpenAI requests.
+Each model has a shared limiter made of a requests per minute and a tokens per minute token bucket, adjusted with the
+x-ratelimit-* headers of the responses. Retryable errors (rate limits, connection errors, timeouts, server errors)
+are retried with jittered exponential backoff, a streamed request is also retried when its stream fails midway.
+"""
+
+class RATE_LIMITS :
+    # (requests per minute, tokens per minute), the buckets are adjusted to the x-ratelimit-limit-* headers of the responses
+    # (the limits configured with configure_rate_limit are only lowered by them)
+    DEFAULTS = {
+        'gpt-4o': (500, 30000),
+        'dall-e-3': (5, None),
+        'tts-1': (50, None)
+    }
+    FALLBACK = (60, None)
+    MAX_RETRIES = 6
+    MAX_BACKOFF = 60
+
+class TokenBucket :
+    """
+    Thread-safe token bucket refilled continuously up to its capacity every minute.
+
+    Args:
+        capacity_per_minute (int): Number of tokens refilled every minute (and maximum number of tokens).
+        max_capacity_per_minute (int): Upper bound of the capacity adjusted by update, None if the capacity can grow.
+    """
+    def __init__(self, capacity_per_minute, max_capacity_per_minute = None) :
+        self.capacity = capacity_per_minute
+        self.max_capacity = max_capacity_per_minute
+        self.tokens = capacity_per_minute
+        self._updated_at = time.monotonic()
+        self._paused_until = 0
+        self._lock = threading.Lock()
+
+    def _refill(self, now) :
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated_at) * self.capacity / 60)
+        self._updated_at = now
+
+    def try_acquire(self, amount = 1) :
+        """
+        Takes tokens from the bucket if there are enough.
+
+        Args:
+            amount (int): Number of tokens to take (capped to the capacity).
+
+        Returns:
+            float: 0 if the tokens were taken, otherwise the number of seconds to wait before trying again.
+        """
+        amount = min(amount, self.capacity)
+        with self._lock :
+            now = time.monotonic()
+            if now < self._paused_until :
+                return self._paused_until - now
+            self._refill(now)
+            if self.tokens >= amount :
+                self.tokens -= amount
+                return 0
+            return (amount - self.tokens) * 60 / self.capacity
+
+    def acquire(self, amount = 1) :
+        """
+        Takes tokens from the bucket, waiting until there are enough.
+        """
+        wait_seconds = self.try_acquire(amount)
+        while wait_seconds :
+            time.sleep(wait_seconds)
+            wait_seconds = self.try_acquire(amount)
+
+    async def acquire_async(self, amount = 1) :
+        """
+        Async version of acquire.
+        """
+        wait_seconds = self.try_acquire(amount)
+        while wait_seconds :
+            await asyncio.sleep(wait_seconds)
+            wait_seconds = self.try_acquire(amount)
+
+    def update(self, limit = None, remaining = None) :
+        """
+        Adjusts the bucket to the state reported by the server, the capacity never exceeds its upper bound.
+
+        Args:
+            limit (int): The capacity per minute of the account.
+            remaining (int): The number of tokens left.
+        """
+        with self._lock :
+            self._refill(time.monotonic())
+            if limit :
+                self.capacity = min(limit, self.max_capacity) if self.max_capacity else limit
+                self.tokens = min(self.tokens, self.capacity)
+            if remaining is not None :
+                self.tokens = min(self.tokens, remaining)
+
+    def pause(self, seconds) :
+        """
+        Empties the bucket and blocks it for the given number of seconds (e.g. after a rate limit error).
+        """
+        with self._lock :
+            self.tokens = 0
+            self._updated_at = time.monotonic()
+            self._paused_until = max(self._paused_until, self._updated_at + seconds)
+
+def _parse_int(value) :
+    try :
+        return int(value)
+    except (TypeError, ValueError) :
+        return None
+
+def _parse_duration(value) :
+    """
+    Parses a duration of the x-ratelimit-reset-* headers (e.g. '20ms', '1s', '6m0s') in seconds.
+    """
+    units = {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600}
+    matches = re.findall(r'(\d+(?:\.\d+)?)(ms|s|m|h)', value or '')
+    return sum(float(number) * units[unit] for number, unit in matches) if matches else None
+
+class ModelRateLimiter :
+    """
+    Rate limiter of a model: a requests per minute bucket and an optional tokens per minute bucket.
+
+    Args:
+        requests_per_minute (int): Maximum number of requests per minute.
+        tokens_per_minute (int): Maximum number of tokens per minute, None if the model is not limited in tokens.
+        is_upper_bound (bool): If True, the limits of the account reported by the server can only lower these limits
+                               (e.g. to keep a process under a share of the quota), otherwise they replace them.
+    """
+    def __init__(self, requests_per_minute, tokens_per_minute = None, is_upper_bound = False) :
+        self.requests = TokenBucket(requests_per_minute, requests_per_minute if is_upper_bound else None)
+        self.tokens = TokenBucket(tokens_per_minute, tokens_per_minute if is_upper_bound else None) if tokens_per_minute else None
+
+    def acquire(self, estimated_tokens = 0) :
+        self.requests.acquire()
+        if self.tokens and estimated_tokens :
+            self.tokens.acquire(estimated_tokens)
+
+    async def acquire_async(self, estimated_tokens = 0) :
+        await self.requests.acquire_async()
+        if self.tokens and estimated_tokens :
+            await self.tokens.acquire_async(estimated_tokens)
+
+    def update_from_headers(self, headers) :
+        """
+        Adjusts the buckets to the x-ratelimit-* headers of a response.
+        """
+        self.requests.update(_parse_int(headers.get('x-ratelimit-limit-requests')), _parse_int(headers.get('x-ratelimit-remaining-requests')))
+        if self.tokens :
+            self.tokens.update(_parse_int(headers.get('x-ratelimit-limit-tokens')), _parse_int(headers.get('x-ratelimit-remaining-tokens')))
+
+    def on_rate_limited(self, headers, delay) :
+        """
+        Blocks the limiter after a rate limit error, until the reset time reported by the server (or the backoff delay).
+        """
+        reset_seconds = max(
+            _parse_duration(headers.get('x-ratelimit-reset-requests')) or 0,
+            _parse_duration(headers.get('x-ratelimit-reset-tokens')) or 0,
+            delay
+        )
+        self.requests.pause(reset_seconds)
+
+_limiters = {}
+_lock = threading.Lock()
+
+def configure_rate_limit(model, requests_per_minute, tokens_per_minute = None) :
+    """
+    Sets the rate limits of a model, the x-ratelimit-limit-* headers of the responses can only lower them.
+
+    Args:
+        model (str): The OpenAI model.
+        requests_per_minute (int): Maximum number of requests per minute.
+        tokens_per_minute (int): Maximum number of tokens per minute (optional).
+    """
+    with _lock :
+        _limiters[model] = ModelRateLimiter(requests_per_minute, tokens_per_minute, is_upper_bound=True)
+
+def get_rate_limiter(model) :
+    """
+    Gets the shared rate limiter of a model, created with its default limits on first use.
+
+    Args:
+        model (str): The OpenAI model.
+
+    Returns:
+        ModelRateLimiter: The rate limiter of the model.
+    """
+    with _lock :
+        if model not in _limiters :
+            _limiters[model] = ModelRateLimiter(*RATE_LIMITS.DEFAULTS.get(model, RATE_LIMITS.FALLBACK))
+        return _limiters[model]
+
+def _get_retry_delay(error, attempt) :
+    """
+    Returns the number of seconds to wait before retrying, None if the error is not retryable.
+    """
+    # imported on the first error only, the SDK is already loaded by then if the request was made with it
+    import httpx
+    import openai
+
+    # a streamed response failing midway raises the httpx error itself
+    if not isinstance(error, (openai.RateLimitError, openai.APIConnectionError, openai.APITimeoutError, openai.InternalServerError, httpx.TransportError)) :
+        return None
+    if isinstance(error, openai.RateLimitError) and error.code == 'insufficient_quota' :
+        return None
+
+    backoff = min(RATE_LIMITS.MAX_BACKOFF, 2 ** attempt)
+    delay = backoff / 2 + random.uniform(0, backoff / 2)
+    response = getattr(error, 'response', None)
+    retry_after = _parse_int(response.headers.get('retry-after')) if response is not None else None
+    return max(delay, retry_after or 0)
+
+def _on_error(limiter, model, error, attempt, max_retries) :
+    delay = _get_retry_delay(error, attempt)
+    if delay is None or attempt == max_retries :
+        raise error
+    import openai
+
+    if isinstance(error, openai.RateLimitError) :
+        limiter.on_rate_limited(error.response.headers, delay)
+        add_counters(retries=1, rate_limited=1)
+    else :
+        add_counters(retries=1)
+    logger.warning(f'{model} request failed (attempt {attempt + 1}/{max_retries + 1}), retrying in {delay:.1f}s : {error}')
+    return delay
+
+def call_with_retries(model, request, estimated_tokens = 0, max_retries = RATE_LIMITS.MAX_RETRIES) :
+    """
+    Makes an OpenAI request through the rate limiter of its model, retrying the retryable errors.
+
+    Args:
+        model (str): The OpenAI model.
+        request (callable): Function without argument making the request with_raw_response.
+        estimated_tokens (int): Estimated number of tokens of the request (prompt and completion).
+        max_retries (int): Maximum number of retries.
+
+    Returns:
+        The parsed response.
+    """
+    limiter = get_rate_limiter(model)
+    for attempt in range(max_retries + 1) :
+        limiter.acquire(estimated_tokens)
+        try :
+            with concurrency_slot() :
+                raw_response = request()
+        except Exception as e :
+            time.sleep(_on_error(limiter, model, e, attempt, max_retries))
+            continue
+        limiter.update_from_headers(raw_response.headers)
+        return raw_response.parse()
+
+def stream_with_retries(model, request, estimated_tokens = 0, max_retries = RATE_LIMITS.MAX_RETRIES) :
+    """
+    Streaming version of call_with_retries: the events of a streamed response are yielded as they are received, and the
+    request is made again if it fails before or during the stream.
+
+    Args:
+        model (str): The OpenAI model.
+        request (callable): Function without argument making the streamed request with_raw_response.
+        estimated_tokens (int): Estimated number of tokens of the request (prompt and completion).
+        max_retries (int): Maximum number of retries.
+
+    Yields:
+        tuple: The attempt number and an event of its stream, a new attempt streams the response from its start again.
+    """
+    limiter = get_rate_limiter(model)
+    for attempt in range(max_retries + 1) :
+        limiter.acquire(estimated_tokens)
+        try :
+            with concurrency_slot() :
+                raw_response = request()
+            limiter.update_from_headers(raw_response.headers)
+            for event in raw_response.parse() :
+                yield attempt, event
+            return
+        except Exception as e :
+            time.sleep(_on_error(limiter, model, e, attempt, max_retries))
+
+async def call_with_retries_async(model, request, estimated_tokens = 0, max_retries = RATE_LIMITS.MAX_RETRIES) :
+    """
+    Async version of call_with_retries, request is a coroutine function.
+    """
+    limiter = get_rate_limiter(model)
+    for attempt in range(max_retries + 1) :
+        await limiter.acquire_async(estimated_tokens)
+        try :
+            raw_response = await request()
+        except Exception as e :
+            await asyncio.sleep(_on_error(limiter, model, e, attempt, max_retries))
+            continue
+        limiter.update_from_headers(raw_response.headers)
+        return raw_response.parse()
@@ -0,0 +1,170 @@
+import hashlib
+import json
+import os
+import threading
+import uuid
+
+"""
+This file contains a content-addressed on-disk cache for the OpenAI responses (GPT outputs, images, speech audio).
+Entries are keyed by a hash of the model, the request parameters and the inputs, and evicted in least recently used
+order once the cache folder grows over its maximum size.
+"""
+
+class ResponseCache :
+    """
+    On-disk cache with size-based LRU eviction, hit/miss counters and a bypass flag.
+    The last access time of an entry is its file modification time, refreshed on every hit.
+
+    Args:
+        cache_folder_path (str): Folder where the entries are stored.
+        max_size_bytes (int): Maximum total size of the entries, the least recently used ones are evicted above it.
+        bypass (bool): If True, lookups always miss but the new responses are still stored.
+    """
+    def __init__(self, cache_folder_path, max_size_bytes = 1024 * 1024 * 1024, bypass = False) :
+        self.cache_folder_path = cache_folder_path
+        self.max_size_bytes = max_size_bytes
+        self.bypass = bypass
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(cache_folder_path, exist_ok=True)
+        self._size_bytes = sum(os.path.getsize(path) for path in self._entry_paths())
+
+    @staticmethod
+    def make_key(*parts) :
+        """
+        Builds the key of an entry from its parts (model, parameters, inputs...), which must be JSON serializable.
+
+        Returns:
+            str: The sha256 hex digest of the parts.
+        """
+        serialized = json.dumps(parts, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(serialized.encode('utf-8')).hexdigest()
+
+    def _entry_paths(self) :
+        for folder_path, _, filenames in os.walk(self.cache_folder_path) :
+            for filename in filenames :
+                if not filename.endswith('.tmp') :
+                    yield os.path.join(folder_path, filename)
+
+    def _get_entry_path(self, key, suffix) :
+        return os.path.join(self.cache_folder_path, key[:2], key + suffix)
+
+    def get_path(self, key, suffix = '') :
+        """
+        Looks up an entry and returns the path of its file.
+
+        Args:
+            key (str): The key of the entry.
+            suffix (str): The file extension the entry was stored with.
+
+        Returns:
+            str: The path of the entry file, None on a miss.
+        """
+        with self._lock :
+            if self.bypass :
+                self.misses += 1
+                return None
+            entry_path = self._get_entry_path(key, suffix)
+            try :
+                os.utime(entry_path)
+            except FileNotFoundError :
+                self.misses += 1
+                return None
+            self.hits += 1
+            return entry_path
+
+    def get(self, key, suffix = '') :
+        """
+        Looks up an entry and returns its content.
+
+        Args:
+            key (str): The key of the entry.
+            suffix (str): The file extension the entry was stored with.
+
+        Returns:
+            bytes: The content of the entry, None on a miss.
+        """
+        entry_path = self.get_path(key, suffix)
+        if entry_path is None :
+            return None
+        try :
+            with open(entry_path, 'rb') as entry_file :
+                return entry_file.read()
+        except FileNotFoundError :
+            # evicted by another thread in the meantime
+            return None
+
+    def set(self, key, data, suffix = '') :
+        """
+        Stores an entry, then evicts the least recently used entries if the cache is over its maximum size.
+
+        Args:
+            key (str): The key of the entry.
+            data (bytes): The content of the entry.
+            suffix (str): The file extension of the entry.
+
+        Returns:
+            str: The path of the entry file.
+        """
+        entry_path = self._get_entry_path(key, suffix)
+        os.makedirs(os.path.dirname(entry_path), exist_ok=True)
+        tmp_path = f'{entry_path}.{uuid.uuid4()}.tmp'
+        with open(tmp_path, 'wb') as tmp_file :
+            tmp_file.write(data)
+
+        with self._lock :
+            previous_size = os.path.getsize(entry_path) if os.path.exists(entry_path) else 0
+            os.replace(tmp_path, entry_path)
+            self._size_bytes += len(data) - previous_size
+            if self._size_bytes > self.max_size_bytes :
+                self._evict(keep_path=entry_path)
+        return entry_path
+
+    def _evict(self, keep_path) :
+        entries = []
+        for path in self._entry_paths() :
+            try :
+                stat = os.stat(path)
+            except FileNotFoundError :
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        self._size_bytes = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries) :
+            if self._size_bytes <= self.max_size_bytes :
+                break
+            if path == keep_path :
+                continue
+            try :
+                os.remove(path)
+            except FileNotFoundError :
+                pass
+            self._size_bytes -= size
+
+    def get_stats(self) :
+        """
+        Returns:
+            dict: The hit and miss counters and the current size of the cache.
+        """
+        with self._lock :
+            return {'hits': self.hits, 'misses': self.misses, 'size_bytes': self._size_bytes}
+
+_cache = None
+
+def set_cache(cache) :
+    """
+    Sets the cache used by the OpenAI requests of src.openai_processor.
+
+    Args:
+        cache (ResponseCache): The cache, None disables caching.
+    """
+    global _cache
+    _cache = cache
+
+def get_cache() :
+    """
+    Returns:
+        ResponseCache: The cache used by the OpenAI requests, None if caching is disabled.
+    """
+    return _cache
@@ -0,0 +1,103 @@
+import hashlib
+import threading
+from src.concurrency import submit_in_context
+from src.logger import get_logger
+from src.metrics import add_counters
+
+logger = get_logger(__file__)
+
+"""
+This file contains the deduplication of the text-to-speech requests of a story.
+The speech lines of all the segments go through one SpeechDeduplicator: a line with the same voice and text as a line
+already submitted (a repeated narrator phrase, a refrain) reuses its audio file instead of being synthesized again.
+Optionally, consecutive lines of the same voice in a segment are merged into one request first: the speeches of a
+segment are played one after another in a single clip, so the merged audio does not need to be split back.
+The identical lines of different stories are reused through the response cache.
+"""
+
+class SPEECH_LIMITS :
+    # maximum input length of a text-to-speech request
+    MAX_CHARACTERS = 4096
+
+def get_speech_key(speech_line) :
+    """
+    Returns:
+        str: The key of a (voice, text) speech line, the same for lines differing only by case of the voice or by whitespace.
+    """
+    voice, text = speech_line
+    normalized_line = voice.lower() + '\n' + ' '.join(text.split())
+    return hashlib.sha1(normalized_line.encode('utf-8')).hexdigest()[:16]
+
+def merge_speech_lines(speech_lines, max_characters = SPEECH_LIMITS.MAX_CHARACTERS) :
+    """
+    Merges the consecutive lines of the same voice, as long as the merged text fits in one request.
+
+    Args:
+        speech_lines (list): The (voice, text) lines of a segment, in order.
+        max_characters (int): Maximum length of a merged text.
+
+    Returns:
+        list: The merged (voice, text) lines, in order.
+    """
+    merged_lines = []
+    for voice, text in speech_lines :
+        text = ' '.join(text.split())
+        if merged_lines and merged_lines[-1][0].lower() == voice.lower() and len(merged_lines[-1][1]) + 1 + len(text) <= max_characters :
+            merged_lines[-1] = (merged_lines[-1][0], merged_lines[-1][1] + ' ' + text)
+        else :
+            merged_lines.append((voice, text))
+    return merged_lines
+
+class SpeechDeduplicator :
+    """
+    Thread-safe submitter of the speech lines of a story, each distinct line is synthesized once.
+
+    Args:
+        executor (concurrent.futures.Executor): Executor of the text-to-speech requests.
+        synthesize (callable): Called with the key (see get_speech_key) and the (voice, text) line, returns its audio filename.
+        merge_lines (bool): If True, the consecutive lines of the same voice of a segment are merged (see merge_speech_lines).
+    """
+    def __init__(self, executor, synthesize, merge_lines = False) :
+        self.executor = executor
+        self.synthesize = synthesize
+        self.merge_lines = merge_lines
+        self._futures = {}
+        self._lock = threading.Lock()
+        self.submitted_lines = 0
+
+    def submit_lines(self, speech_lines) :
+        """
+        Submits the speech lines of a segment.
+
+        Args:
+            speech_lines (list): The (voice, text) lines of the segment, in order.
+
+        Returns:
+            list: The futures of the audio filenames, in order (the same future for identical lines).
+        """
+        if self.merge_lines :
+            merged_lines = merge_speech_lines(speech_lines)
+            add_counters(merged_speech_lines=len(speech_lines) - len(merged_lines))
+            speech_lines = merged_lines
+        futures = []
+        with self._lock :
+            for speech_line in speech_lines :
+                key = get_speech_key(speech_line)
+                self.submitted_lines += 1
+                if key in self._futures :
+                    add_counters(deduplicated_speech_lines=1)
+                else :
+                    self._futures[key] = submit_in_context(self.executor, self.synthesize, key, speech_line)
+                futures.append(self._futures[key])
+        return futures
+
+    @property
+    def requested_lines(self) :
+        """
+        Returns:
+            int: The number of distinct lines synthesized.
+        """
+        return len(self._futures)
+
+    def log_summary(self) :
+        logger.info(f'Speech lines : {self.submitted_lines} submitted, {self.requested_lines} synthesized, {self.submitted_lines - self.requested_lines} reused')
@@ -0,0 +1,128 @@
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from src.concurrency import submit_in_context
+from src.logger import get_logger
+
+logger = get_logger(__file__)
+
+"""
+This file contains the dependency graph runner of the pipeline stages.
+Each stage is started in a thread as soon as the stages it depends on are completed, so independent stages
+(e.g. the visual descriptions and the annotations of a story) overlap. Once the graph is run, the critical path
+(the chain of stages which determined the total duration) is logged.
+Stages run outside of the graph (e.g. a streamed stage consumed while the next stages already run) can be recorded in it,
+so that they are part of the logged critical path.
+"""
+
+class StageGraph :
+    """
+    Graph of stages, each stage is a function called with the outputs of the stages it depends on.
+
+    Args:
+        name (str): Name of the graph, used in the logs.
+    """
+    def __init__(self, name = 'stages') :
+        self.name = name
+        self._stages = {}
+        self.timings = {}
+        self.started_at = time.perf_counter()
+
+    def add_stage(self, name, function, dependencies = ()) :
+        """
+        Adds a stage, its dependencies must already be added (which rules cycles out).
+
+        Args:
+            name (str): The name of the stage.
+            function (callable): Called with the outputs of the dependencies, in order.
+            dependencies (tuple): The names of the stages it depends on.
+
+        Raises:
+            ValueError: If the name is already used or a dependency is unknown.
+        """
+        if name in self._stages :
+            raise ValueError(f'Stage {name} is already in the graph')
+        unknown_dependencies = [dependency for dependency in dependencies if dependency not in self._stages]
+        if unknown_dependencies :
+            raise ValueError(f'Unknown dependencies of stage {name} : {", ".join(unknown_dependencies)}')
+        self._stages[name] = (function, tuple(dependencies))
+
+    def run(self, max_workers = None) :
+        """
+        Runs all the stages, each one as soon as its dependencies are completed, then logs the critical path.
+        If a stage fails, no other stage is started and its error is raised once the running stages are done.
+
+        Args:
+            max_workers (int): Maximum number of stages running at the same time (default: no limit).
+
+        Returns:
+            dict: The output of each stage.
+        """
+        outputs = {}
+        pending = dict(self._stages)
+        running = {}
+        self.timings = {}
+        self.started_at = started_at = time.perf_counter()
+
+        with ThreadPoolExecutor(max_workers=max_workers or max(len(pending), 1)) as executor :
+            while pending or running :
+                for name, (function, dependencies) in list(pending.items()) :
+                    if all(dependency in outputs for dependency in dependencies) :
+                        del pending[name]
+                        self.timings[name] = [time.perf_counter() - started_at, None]
+                        future = submit_in_context(executor, function, *(outputs[dependency] for dependency in dependencies))
+                        running[future] = name
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done :
+                    name = running.pop(future)
+                    self.timings[name][1] = time.perf_counter() - started_at
+                    if future.exception() is not None :
+                        pending.clear()
+                        wait(running)
+                        raise future.exception()
+                    outputs[name] = future.result()
+
+        self.log_critical_path()
+        return outputs
+
+    def record_stage(self, name, started_at, ended_at, dependencies = ()) :
+        """
+        Records a stage run outside of the graph, its dependencies must already be added or recorded.
+
+        Args:
+            name (str): The name of the stage.
+            started_at (float): The time.perf_counter() value when the stage started.
+            ended_at (float): The time.perf_counter() value when the stage ended.
+            dependencies (tuple): The names of the stages it depended on.
+        """
+        self.add_stage(name, None, dependencies)
+        self.timings[name] = [started_at - self.started_at, ended_at - self.started_at]
+
+    def get_critical_path(self) :
+        """
+        Returns:
+            list: The stages of the critical path of the last run, in order: starting from the last completed stage,
+                  each stage is preceded by its latest completed dependency.
+        """
+        if not self.timings :
+            return []
+        name = max(self.timings, key=lambda stage : self.timings[stage][1])
+        critical_path = [name]
+        while self._stages[name][1] :
+            name = max(self._stages[name][1], key=lambda stage : self.timings[stage][1])
+            critical_path.append(name)
+        return critical_path[::-1]
+
+    def log_critical_path(self) :
+        """
+        Logs the critical path of the last run (or of the recorded stages) with the duration of each of its stages.
+        """
+        critical_path = self.get_critical_path()
+        if not critical_path :
+            return
+        total_duration = self.timings[critical_path[-1]][1]
+        breakdown = ' -> '.join(f'{name} ({self.timings[name][1] - self.timings[name][0]:.2f}s)' for name in critical_path)
+        off_path = ', '.join(
+            f'{name} ({start:.2f}s-{end:.2f}s)' for name, (start, end) in self.timings.items() if name not in critical_path
+        )
+        logger.info(f'Critical path of {self.name} ({total_duration:.2f}s) : {breakdown}' + (f' | overlapped : {off_path}' if off_path else ''))
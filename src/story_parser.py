@@ -0,0 +1,191 @@
+import re
+
+"""
+This file contains the parser of the segment annotated stories (see GPT_SYSTEM_COMMAND_PROMPTS.TEXT_SEGMENTATION):
+
+    Segment1: Voice Nova: [text] Voice Onyx: [text]
+    Place: [place]
+    Characters: [characters]
+    Segment2: ...
+
+The text is parsed in a single pass, line by line, as it is fed: the parser can read a streamed response and returns
+each segment as soon as it is complete (when the next segment starts or the text ends).
+A segment starts with `SegmentN:` at the beginning of a line, so the word Segment in the story text does not split it.
+"""
+
+SEGMENT_HEADER_PATTERN = re.compile(r'^[\s*#]*Segment\s*\d+[\s*]*:[\s*]*', re.IGNORECASE)
+METADATA_PATTERN = re.compile(r'^[\s*]*(Place|Characters)[\s*]*:\s*(.*)$', re.IGNORECASE)
+ANNOTATION_PATTERN = re.compile(r'(\w+):\s*\[')
+
+class Segment :
+    """
+    A segment of the story, illustrated by one image.
+
+    Args:
+        index (int): The index of the segment in the story.
+        text (str): The text of the segment with its voice annotations and metadata (`Voice VoiceName: [text] ... Place: [place]
+                    Characters: [characters]`), used for the DALL-E prompt.
+        place (str): The place where the segment takes place (None if not given).
+        characters (str): The characters involved in the segment (None if not given).
+        speech_lines (list): The (voice, text) pairs of the segment, in order.
+    """
+    __slots__ = ('index', 'text', 'place', 'characters', 'speech_lines')
+
+    def __init__(self, index, text, place = None, characters = None, speech_lines = None) :
+        self.index = index
+        self.text = text
+        self.place = place
+        self.characters = characters
+        self.speech_lines = speech_lines if speech_lines is not None else []
+
+    def __repr__(self) :
+        return f'Segment({self.index}, {len(self.speech_lines)} speech lines, {self.text[:80]!r})'
+
+class SegmentParser :
+    """
+    Incremental parser of a segment annotated story, the text fed so far is kept (see text).
+    """
+    def __init__(self) :
+        self._chunks = []
+        self._buffer = ''
+        self._segment = None
+        self._lines = []
+        self._voice = None
+        self._speech_parts = []
+        self._count = 0
+
+    def feed(self, chunk) :
+        """
+        Parses a chunk of the text.
+
+        Args:
+            chunk (str): The next chunk of the text (of any size).
+
+        Returns:
+            list: The segments completed by this chunk.
+        """
+        self._chunks.append(chunk)
+        self._buffer += chunk
+        if '\n' not in chunk :
+            return []
+        lines = self._buffer.split('\n')
+        # the last line is incomplete until its newline is received
+        self._buffer = lines.pop()
+        completed_segments = []
+        for line in lines :
+            completed_segments.extend(self._parse_line(line))
+        return completed_segments
+
+    @property
+    def text(self) :
+        """
+        Returns:
+            str: The text fed so far.
+        """
+        return ''.join(self._chunks)
+
+    def close(self) :
+        """
+        Parses the end of the text.
+
+        Returns:
+            list: The segments completed by the end of the text.
+        """
+        completed_segments = self._parse_line(self._buffer)
+        self._buffer = ''
+        if self._segment is not None :
+            completed_segments.append(self._finish_segment())
+        return completed_segments
+
+    def _parse_line(self, line) :
+        header = SEGMENT_HEADER_PATTERN.match(line)
+        completed_segments = []
+        if header :
+            if self._segment is not None :
+                completed_segments.append(self._finish_segment())
+            self._segment = Segment(self._count, '')
+            self._count += 1
+            line = line[header.end():]
+        if self._segment is None :
+            # text before the first segment
+            return completed_segments
+
+        metadata = METADATA_PATTERN.match(line) if self._voice is None else None
+        if metadata :
+            value = metadata.group(2).strip().strip('[]').strip()
+            setattr(self._segment, metadata.group(1).lower(), value or None)
+            # kept in the text sent to DALL-E (for the place descriptions), not parsed as speech
+            self._lines.append(line)
+            return completed_segments
+
+        self._lines.append(line)
+        self._parse_speech(line)
+        return completed_segments
+
+    def _parse_speech(self, line) :
+        position = 0
+        while position < len(line) :
+            if self._voice is not None :
+                end = line.find(']', position)
+                if end == -1 :
+                    # the speech continues on the next line
+                    self._speech_parts.append(line[position:])
+                    return
+                self._speech_parts.append(line[position:end])
+                self._segment.speech_lines.append((self._voice, ' '.join(part.strip() for part in self._speech_parts if part.strip())))
+                self._voice = None
+                position = end + 1
+            else :
+                annotation = ANNOTATION_PATTERN.search(line, position)
+                if annotation is None :
+                    return
+                name = annotation.group(1)
+                if name.lower() in ('place', 'characters') :
+                    # metadata written on the same line as the speech
+                    end = line.find(']', annotation.end())
+                    end = len(line) if end == -1 else end
+                    setattr(self._segment, name.lower(), line[annotation.end():end].strip() or None)
+                    position = end + 1
+                    continue
+                self._voice = name
+                self._speech_parts = []
+                position = annotation.end()
+
+    def _finish_segment(self) :
+        segment = self._segment
+        if self._voice is not None :
+            # unclosed speech at the end of the segment
+            segment.speech_lines.append((self._voice, ' '.join(part.strip() for part in self._speech_parts if part.strip())))
+            self._voice = None
+        segment.text = ' '.join(' '.join(self._lines).split())
+        self._segment = None
+        self._lines = []
+        return segment
+
+def iter_segments(chunks, parser = None) :
+    """
+    Parses a segment annotated story given as chunks (e.g. a streamed response), yielding each segment as soon as it is complete.
+
+    Args:
+        chunks (iterable): The chunks of text.
+        parser (SegmentParser): The parser to use, e.g. to read its text afterwards (a new one if None).
+
+    Yields:
+        Segment: The segments, in order.
+    """
+    parser = parser or SegmentParser()
+    for chunk in chunks :
+        yield from parser.feed(chunk)
+    yield from parser.close()
+
+def parse_segments(segment_annotated_story) :
+    """
+    Parses a complete segment annotated story.
+
+    Args:
+        segment_annotated_story (str): The story with segment annotations.
+
+    Returns:
+        list: The segments (Segment).
+    """
+    return list(iter_segments([segment_annotated_story]))
@@ -1,62 +1,402 @@
-from moviepy.editor import *
+import base64
+import imageio_ffmpeg
+import io
+import re
+import subprocess
+import time
 import uuid
 import os
 import shutil
 from src.logger import get_logger, log_function_call
+from src.openai_client import get_http_client
+from src.concurrency import concurrency_slot
+from src.metrics import add_counters
+from src.mp3_utils import concatenate_mp3
 
 logger = get_logger(__file__)
 
+def _verify_image(data):
+    from PIL import Image
+
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            image.verify()
+    except Exception as e:
+        raise ValueError(f'Invalid image data : {e}')
+
+def download_asset(url, timeout = 60, retries = 3, validate = None):
+    """
+    Downloads an asset with the shared pooled HTTP client.
+    Transport errors, server errors and invalid contents are retried with exponential backoff.
+
+    Args:
+        url (str): URL of the asset.
+        timeout (float): Timeout of each attempt in seconds.
+        retries (int): Maximum number of attempts.
+        validate (callable): Optional function raising ValueError if the downloaded content is invalid.
+
+    Returns:
+        bytes: The content of the asset.
+    """
+    import httpx
+
+    for attempt in range(retries):
+        try:
+            with concurrency_slot():
+                response = get_http_client().get(url, timeout=timeout)
+            response.raise_for_status()
+            if validate:
+                validate(response.content)
+            add_counters(bytes=len(response.content))
+            return response.content
+        except (httpx.TransportError, httpx.HTTPStatusError, ValueError) as e:
+            if isinstance(e, httpx.HTTPStatusError) and e.response.status_code < 500:
+                raise
+            if attempt == retries - 1:
+                raise
+            logger.warning(f'Download of {url} failed (attempt {attempt + 1}/{retries}) : {e}')
+            add_counters(retries=1)
+            time.sleep(2 ** attempt)
+
+@log_function_call(logger)
+def save_image(image_url, output_folder, timeout = 60, retries = 3):
+    """
+    Saves an image in a folder. The image is downloaded (and verified) if it is a URL, decoded if it is a base64 data URL,
+    copied if it is a local file, and left in place if it is already in the folder.
+
+    Args:
+        image_url (str): URL, data URL or local path of the image.
+        output_folder (str): Folder where to save the image.
+        timeout (float): Timeout of each download attempt in seconds.
+        retries (int): Maximum number of download attempts.
+
+    Returns:
+        str: Filename of the saved image.
+    """
+    if os.path.isfile(image_url):
+        if os.path.dirname(os.path.abspath(image_url)) == os.path.abspath(output_folder):
+            return os.path.basename(image_url)
+        output_filename = str(uuid.uuid4()) + '.png'
+        shutil.copyfile(image_url, os.path.join(output_folder, output_filename))
+        return output_filename
+
+    if image_url.startswith('data:'):
+        image = base64.b64decode(image_url.split(',', 1)[1])
+        _verify_image(image)
+    else:
+        image = download_asset(image_url, timeout, retries, validate=_verify_image)
+
+    output_filename = str(uuid.uuid4()) + '.png'
+    with open(os.path.join(output_folder, output_filename), 'wb') as output_file:
+        output_file.write(image)
+    return output_filename
+
+class EncodingProfile:
+    """
+    ffmpeg settings of the segment videos (and of the story render), tuned for a still image over speech: the image is encoded once
+    (libx264 with the stillimage tune and a long keyframe interval, at 1 frame per second) and the speech is only
+    concatenated and encoded to AAC (the MP3 files are not decoded through Python).
+
+    Args:
+        preset (str): The libx264 preset (e.g. ultrafast, veryfast, medium), faster presets use less CPU for bigger files.
+        crf (int): The libx264 constant rate factor, higher values give smaller files of lower quality.
+        threads (int): Number of threads of each encode, 0 for automatic (the encodes already run in parallel processes).
+        keyframe_interval (int): Maximum number of frames (seconds) between two keyframes.
+        audio_bitrate (str): The AAC bitrate.
+    """
+    PRESETS = ('ultrafast', 'superfast', 'veryfast', 'faster', 'fast', 'medium', 'slow', 'slower', 'veryslow', 'placebo')
+    MAX_CRF = 51
+
+    def __init__(self, preset = 'veryfast', crf = 28, threads = 1, keyframe_interval = 300, audio_bitrate = '64k'):
+        self.preset = preset
+        self.crf = crf
+        self.threads = threads
+        self.keyframe_interval = keyframe_interval
+        self.audio_bitrate = audio_bitrate
+
+_encoding_profile = EncodingProfile()
+
+def set_encoding_profile(profile):
+    """
+    Sets the default encoding profile of merge_image_audio, render_video_story and of the re-encoding of merge_video_segments.
+
+    Args:
+        profile (EncodingProfile): The profile.
+    """
+    global _encoding_profile
+    _encoding_profile = profile
+
+def get_encoding_profile():
+    """
+    Returns:
+        EncodingProfile: The default encoding profile of merge_image_audio and render_video_story (pass it explicitly to the encode worker processes).
+    """
+    return _encoding_profile
+
+def _write_concat_list(paths, concat_list_path, durations = ()):
+    # durations, if given, are the durations of the first files in the concatenation
+    with open(concat_list_path, 'w') as concat_list:
+        for index, path in enumerate(paths):
+            escaped_path = os.path.abspath(path).replace("'", "'\\''")
+            concat_list.write(f"file '{escaped_path}'\n")
+            if index < len(durations):
+                concat_list.write(f"duration {durations[index]:.3f}\n")
+
 @log_function_call(logger)
-def merge_image_audio(image_path, audio_paths, output_folder):
+def merge_image_audio(image_path, audio_paths, output_folder, profile = None):
     """
     Merge an image with multiple audio files into a mp4 video.
+    The image is displayed while the audio files are played one after another, plus one second.
 
     Args:
         image_path (str): Path to the image file.
         audio_paths (list): List of paths to audio files.
         output_folder_path (str): Folder where to save the mp4 file.
+        profile (EncodingProfile): The encoding settings (default: the profile set with set_encoding_profile).
 
     Returns:
         str: Filename of the merged video.
     """
+    profile = profile or _encoding_profile
+    output_filename = str(uuid.uuid4()) + '.mp4'
+    # the speeches are joined frame by frame, which also gives their duration without probing each file
+    speech_path = os.path.join(output_folder, output_filename + '.speech.mp3')
+    duration = concatenate_mp3(audio_paths, speech_path)
+
+    try:
+        with concurrency_slot():
+            result = _run_ffmpeg([
+                '-y', '-loglevel', 'error',
+                '-framerate', '1', '-i', image_path,
+                '-i', speech_path,
+                '-map', '0:v', '-map', '1:a',
+                # the image is decoded and converted once, then repeated at 1 frame per second
+                '-vf', 'scale=trunc(iw/2)*2:trunc(ih/2)*2,format=yuv420p,loop=loop=-1:size=1,setpts=N/TB', '-r', '1',
+                '-c:v', 'libx264', '-preset', profile.preset, '-tune', 'stillimage', '-crf', str(profile.crf),
+                # the keyframes are at the multiples of the interval, the clip can be cut into chunks of that duration (see split_transport_stream)
+                '-g', str(profile.keyframe_interval), '-force_key_frames', f'expr:gte(t,n_forced*{profile.keyframe_interval})', '-threads', str(profile.threads),
+                # the speech is followed by one second of silence
+                '-af', 'apad', '-c:a', 'aac', '-b:a', profile.audio_bitrate,
+                '-t', f'{duration + 1:.3f}', '-movflags', '+faststart', os.path.join(output_folder, output_filename)
+            ])
+    finally:
+        os.remove(speech_path)
+    if result.returncode != 0:
+        raise RuntimeError(f'ffmpeg segment encode failed : {result.stderr.strip()}')
+    return output_filename
+
+def _get_even_image_size(image_path):
+    from PIL import Image
+
+    # only the header is read
+    with Image.open(image_path) as image:
+        width, height = image.size
+    return width // 2 * 2, height // 2 * 2
+
+def _get_fit_filter(width, height):
+    # scales the frames into the output size, keeping their aspect ratio (black borders)
+    return f'scale={width}:{height}:force_original_aspect_ratio=decrease,pad={width}:{height}:(ow-iw)/2:(oh-ih)/2,setsar=1'
+
+@log_function_call(logger)
+def render_video_story(segments_media, output_file, profile = None):
+    """
+    Render the whole story into a single mp4 video in one encoding pass, without intermediate segment videos.
+    Each segment image is displayed while its audio files are played (plus one second), like merge_image_audio does.
+    A single ffmpeg process reads the images and the speeches one segment at a time through the concat demuxer and
+    writes the output as it goes, so its memory use and open files do not grow with the number of segments.
+
+    Args:
+        segments_media (list): List of (image path, list of audio paths) tuples, in story order.
+        output_file (str): Path to the output video file.
+        profile (EncodingProfile): The encoding settings (default: the profile set with set_encoding_profile).
+    """
+    profile = profile or _encoding_profile
+    # the images are fitted into the size of the first one, the encoder can not change size midstream
+    width, height = _get_even_image_size(segments_media[0][0])
+    images_list_path = output_file + '.images.txt'
+    speeches_list_path = output_file + '.speeches.txt'
+    speech_paths = []
+    try:
+        segment_durations = []
+        for image_path, audio_paths in segments_media:
+            speech_path = os.path.splitext(output_file)[0] + f'.{len(speech_paths)}.speech.mp3'
+            speech_paths.append(speech_path)
+            segment_durations.append(concatenate_mp3(audio_paths, speech_path) + 1)
 
-    img = ImageClip(image_path)
-    
-    total_duration = sum(AudioFileClip(path).duration for path in audio_paths)
-    
-    img = img.set_duration(total_duration + 1)
-    
-    audio_clips = []
-    
-    for path in audio_paths:
-        audio_clip = AudioFileClip(path)
-        audio_clips.append(audio_clip)
+        # each file lasts the duration of its segment, the gap after each speech is filled with silence (aresample async),
+        # the last image is listed twice for its duration to be applied
+        image_paths = [image_path for image_path, _ in segments_media]
+        _write_concat_list(image_paths + image_paths[-1:], images_list_path, segment_durations)
+        _write_concat_list(speech_paths, speeches_list_path, segment_durations)
 
-    final_audio = concatenate_audioclips(audio_clips)
-    
-    img = img.set_audio(final_audio)
+        with concurrency_slot():
+            result = _run_ffmpeg([
+                '-y', '-loglevel', 'error',
+                '-f', 'concat', '-safe', '0', '-i', images_list_path,
+                '-f', 'concat', '-safe', '0', '-i', speeches_list_path,
+                '-map', '0:v', '-map', '1:a',
+                '-vf', f'{_get_fit_filter(width, height)},format=yuv420p,fps=1,tpad=stop_mode=clone:stop=-1', '-r', '1',
+                '-c:v', 'libx264', '-preset', profile.preset, '-tune', 'stillimage', '-crf', str(profile.crf),
+                '-g', str(profile.keyframe_interval), '-threads', str(profile.threads),
+                '-af', 'aresample=async=1:first_pts=0,apad', '-c:a', 'aac', '-b:a', profile.audio_bitrate,
+                '-t', f'{sum(segment_durations):.3f}', '-movflags', '+faststart', output_file
+            ])
+    finally:
+        for path in [images_list_path, speeches_list_path, *speech_paths]:
+            if os.path.exists(path):
+                os.remove(path)
+    if result.returncode != 0:
+        raise RuntimeError(f'ffmpeg story render failed : {result.stderr.strip()}')
 
-    output_filename = str(uuid.uuid4()) + '.mp4'
-    
-    img.write_videofile(os.path.join(output_folder ,output_filename), fps=1)  
-    return output_filename
+def _run_ffmpeg(arguments):
+    return subprocess.run([imageio_ffmpeg.get_ffmpeg_exe(), '-hide_banner', *arguments], capture_output=True, text=True)
+
+def get_stream_signature(video_path):
+    """
+    Reads the stream parameters that have to match for videos to be concatenated without re-encoding
+    (codec, pixel format, resolution and frame rate of the video streams, codec, sample rate and channels of the audio streams).
+
+    Args:
+        video_path (str): Path to the video file.
+
+    Returns:
+        tuple: The parameters of each stream of the file, None if the file could not be probed.
+    """
+    # ffmpeg without output file prints the stream descriptions and exits with an error, no decoding is done
+    probe_output = _run_ffmpeg(['-i', video_path]).stderr
+    signature = []
+    for stream_type, description in re.findall(r'Stream #\d+:\d+.*?: (Video|Audio): (.*)', probe_output):
+        codec = description.split()[0]
+        if stream_type == 'Video':
+            pixel_format = re.match(r'[^,]*, (\w+)', description)
+            resolution = re.search(r', (\d+x\d+)', description)
+            fps = re.search(r'([\d.]+) fps', description)
+            parameters = [pixel_format, resolution, fps]
+        else:
+            sample_rate = re.search(r'(\d+) Hz', description)
+            channels = re.search(r'Hz, ([^,]+)', description)
+            parameters = [sample_rate, channels]
+        signature.append((stream_type, codec, *[parameter.group(1) if parameter else None for parameter in parameters]))
+    return tuple(signature) or None
+
+def get_media_duration(media_path):
+    """
+    Reads the duration of a media file from its container metadata, without decoding it.
+
+    Args:
+        media_path (str): Path to the media file.
+
+    Returns:
+        float: The duration in seconds, None if it could not be read.
+    """
+    duration = re.search(r'Duration: (\d+):(\d+):([\d.]+)', _run_ffmpeg(['-i', media_path]).stderr)
+    if duration is None:
+        return None
+    hours, minutes, seconds = duration.groups()
+    return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+
+@log_function_call(logger)
+def split_transport_stream(video_path, output_folder, chunk_duration, start_number = 0, offset = 0):
+    """
+    Remuxes a mp4 video (H.264/AAC) into MPEG-TS chunks of at most chunk_duration seconds without re-encoding, e.g. to serve
+    them as HLS chunks. The chunks are cut on keyframes, the video needs a keyframe every chunk_duration seconds.
+
+    Args:
+        video_path (str): Path to the mp4 video.
+        output_folder (str): Folder of the chunks (segment_<number>.ts).
+        chunk_duration (float): Duration of the chunks in seconds (the last one can be shorter).
+        start_number (int): Number of the first chunk.
+        offset (float): Offset of the timestamps in seconds, the start time of the video in the stream.
+
+    Returns:
+        list: The (file name, duration in seconds) of each chunk, in order.
+    """
+    chunk_list_path = os.path.join(output_folder, f'segment_{start_number:05d}.csv')
+    # the timestamps are not shifted to be non negative (the B-frames delay the first ones),
+    # otherwise the first chunk of a stream would not start at the same offset as the next ones
+    result = _run_ffmpeg(['-y', '-loglevel', 'error', '-i', video_path, '-c', 'copy', '-bsf:v', 'h264_mp4toannexb',
+                          '-avoid_negative_ts', 'disabled', '-f', 'segment', '-initial_offset', str(offset),
+                          '-segment_format', 'mpegts', '-segment_time', str(chunk_duration),
+                          '-segment_start_number', str(start_number), '-segment_list', chunk_list_path, '-segment_list_type', 'csv',
+                          os.path.join(output_folder, 'segment_%05d.ts')])
+    try:
+        if result.returncode != 0:
+            raise RuntimeError(f'ffmpeg transport stream split failed : {result.stderr.strip()}')
+        # one line per chunk : file name, start time, end time
+        with open(chunk_list_path) as chunk_list:
+            return [(name, float(end) - float(start)) for name, start, end in (line.strip().split(',') for line in chunk_list if line.strip())]
+    finally:
+        if os.path.exists(chunk_list_path):
+            os.remove(chunk_list_path)
+
+def _concatenate_stream_copy(video_paths, output_file):
+    concat_list_path = output_file + '.concat.txt'
+    _write_concat_list(video_paths, concat_list_path)
+    try:
+        with concurrency_slot():
+            result = _run_ffmpeg(['-y', '-loglevel', 'error', '-f', 'concat', '-safe', '0', '-i', concat_list_path, '-c', 'copy', '-movflags', '+faststart', output_file])
+    finally:
+        os.remove(concat_list_path)
+    if result.returncode != 0:
+        raise RuntimeError(f'ffmpeg concat failed : {result.stderr.strip()}')
+
+def _normalize_segment(video_path, output_file, width, height, fps, profile):
+    with concurrency_slot():
+        result = _run_ffmpeg([
+            '-y', '-loglevel', 'error', '-i', video_path,
+            '-vf', f'{_get_fit_filter(width, height)},format=yuv420p,fps={fps}',
+            '-c:v', 'libx264', '-preset', profile.preset, '-crf', str(profile.crf),
+            '-g', str(profile.keyframe_interval), '-threads', str(profile.threads),
+            '-c:a', 'aac', '-b:a', profile.audio_bitrate, '-ar', '44100', '-ac', '2', output_file
+        ])
+    if result.returncode != 0:
+        raise RuntimeError(f'ffmpeg segment normalization failed : {result.stderr.strip()}')
+
+def _concatenate_reencode(video_paths, output_file, profile = None):
+    profile = profile or _encoding_profile
+    # the size and frame rate of the first segment are kept
+    signature = get_stream_signature(video_paths[0]) or ()
+    video_stream = next((stream for stream in signature if stream[0] == 'Video'), None)
+    if video_stream is None or video_stream[3] is None or video_stream[4] is None:
+        raise RuntimeError(f'Could not read the video stream parameters of {video_paths[0]}')
+    width, height = (int(size) // 2 * 2 for size in video_stream[3].split('x'))
+    fps = video_stream[4]
+
+    normalized_folder = output_file + '.normalized'
+    os.makedirs(normalized_folder, exist_ok=True)
+    try:
+        normalized_paths = []
+        for index, path in enumerate(video_paths):
+            normalized_path = os.path.join(normalized_folder, f'{index:05d}.mp4')
+            _normalize_segment(path, normalized_path, width, height, fps, profile)
+            normalized_paths.append(normalized_path)
+        _concatenate_stream_copy(normalized_paths, output_file)
+    finally:
+        shutil.rmtree(normalized_folder, ignore_errors=True)
 
 @log_function_call(logger)
-def merge_video_segments(video_paths, output_file):
+def merge_video_segments(video_paths, output_file, stream_copy = True):
     """
     Merge multiple video segments into a single mp4 video.
+    If all the segments have the same stream parameters they are remuxed without re-encoding (ffmpeg concat demuxer),
+    otherwise (or if the remux fails) they are re-encoded one at a time to the parameters of the first segment,
+    then remuxed: one ffmpeg process runs at a time, the memory use does not grow with the number of segments.
 
     Args:
         video_paths (list): List of paths to video files.
         output_file (str): Path to the output video file.
+        stream_copy (bool): If False, always re-encode.
     """
 
-    video_clips = []
-    
-    for path in video_paths:
-        video_clip = VideoFileClip(path)
-        video_clips.append(video_clip)
-    
-    final_clip = concatenate_videoclips(video_clips)
-    
-    final_clip.write_videofile(output_file)
+    if stream_copy:
+        signatures = {get_stream_signature(path) for path in video_paths}
+        if len(signatures) == 1 and None not in signatures:
+            try:
+                _concatenate_stream_copy(video_paths, output_file)
+                return
+            except RuntimeError as e:
+                logger.warning(f'Stream copy concatenation failed, falling back to re-encoding : {e}')
+        else:
+            logger.info('Segments stream parameters differ, re-encoding')
+
+    _concatenate_reencode(video_paths, output_file)